@@ -0,0 +1,92 @@
+"""
+Micro-benchmark of the annotation id classification in MyChemQStringParser.
+
+Classifies a batch of mixed CURIEs and bare ids with the single-pass
+classifier and with the sequential ANNOTATION_ID_REGEX_LIST scan, both
+against a loaded mapping, as in a POST request.
+
+    python benchmarks/classifier.py --ids 1000
+"""
+import argparse
+import itertools
+import logging
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), os.pardir))
+
+from biothings.web.query.builder import QStringParser  # noqa: E402
+from biothings.web.services.metadata import BiothingsMetadata  # noqa: E402
+
+import config_web  # noqa: E402
+from web.pipeline import MyChemQStringParser  # noqa: E402
+
+IDS = [
+    "CHEMBL.COMPOUND:CHEMBL25",
+    "CHEMBL25",
+    "PUBCHEM.COMPOUND:2244",
+    "2244",
+    "CHEBI:15365",
+    "UNII:R16CO5Y76E",
+    "R16CO5Y76E",
+    "DRUGBANK:DB00945",
+    "DB00945",
+    "PA448497",
+    "sid:46504734",
+    "INCHIKEY:BSYNRYMUTXBXSQ-UHFFFAOYSA-N",
+    "BSYNRYMUTXBXSQ-UHFFFAOYSA-N",
+    "drugbank.name:aspirin",
+]
+
+
+def make_metadata():
+    metadata = BiothingsMetadata()
+    metadata.biothing_metadata["chem"] = {"_biothing": "chem"}
+    properties = {}
+    for _, fields in config_web.ANNOTATION_ID_REGEX_LIST:
+        for field in fields:
+            *parents, leaf = field.split(".")
+            node = properties
+            for parent in parents:
+                node = node.setdefault(parent, {"properties": {}})["properties"]
+            node[leaf] = {"type": "keyword"}
+    properties["drugbank"]["properties"]["name"] = {"type": "text"}
+    metadata.biothing_mappings["chem"] = properties
+    return metadata
+
+
+def measure(parser, ids, metadata, repeat):
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        for _id in ids:
+            parser.parse(_id, metadata)
+        timings.append(time.perf_counter() - start)
+    return min(timings)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--ids", type=int, default=1000)
+    parser.add_argument("--repeat", type=int, default=3)
+    args = parser.parse_args()
+
+    logging.disable(logging.WARNING)
+    ids = list(itertools.islice(itertools.cycle(IDS), args.ids))
+    metadata = make_metadata()
+    options = dict(
+        default_scopes=config_web.ANNOTATION_DEFAULT_SCOPES,
+        default_pattern=config_web.default_chem_regex_pattern,
+    )
+    print(f"{args.ids} mixed ids, best of {args.repeat}")
+    classifier = MyChemQStringParser(patterns=config_web.ANNOTATION_ID_REGEX_LIST, **options)
+    current = measure(classifier, ids, metadata, args.repeat)
+    print(f"  single-pass classifier: {current:.4f}s")
+    sequential = QStringParser(patterns=list(config_web.ANNOTATION_ID_REGEX_LIST), **options)
+    sequential = measure(sequential, ids, metadata, args.repeat)
+    print(f"  sequential patterns:    {sequential:.4f}s ({sequential / current:.1f}x)")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,168 @@
+"""
+Heap benchmark of concurrent fetch_all exports on a local Elasticsearch.
+
+Serves the API in process on the synthetic chem index of the web
+benchmark, loaded into --es, and runs --exports full fetch_all exports
+at the same time, once paging through points in time and once through
+scrolls, sampling the heap used by Elasticsearch and its open search
+contexts while they run.
+
+    python benchmarks/fetch_all.py --es http://localhost:9200 --docs 100000 --exports 50
+
+The results are saved as JSON, with the commit they were measured at,
+like the web benchmark.
+"""
+import argparse
+import asyncio
+import importlib.util
+import json
+import logging
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), os.pardir))
+
+from biothings.web.applications import TornadoBiothingsAPI  # noqa: E402
+from biothings.web.settings import configs  # noqa: E402
+from elasticsearch import Elasticsearch  # noqa: E402
+from tornado.httpclient import AsyncHTTPClient  # noqa: E402
+from tornado.httpserver import HTTPServer  # noqa: E402
+from tornado.netutil import bind_sockets  # noqa: E402
+
+# the web benchmark, which the web package would shadow on sys.path
+_spec = importlib.util.spec_from_file_location("web_benchmark", os.path.join(os.path.dirname(__file__), "web.py"))
+web_benchmark = importlib.util.module_from_spec(_spec)
+_spec.loader.exec_module(web_benchmark)
+
+BACKENDS = {
+    "pit": "web.pipeline.MyChemESQueryBackend",
+    "scroll": "biothings.web.query.AsyncESQueryBackend",
+}
+
+
+def make_app(es_url, backend, keep_alive):
+    config = configs.load("config_web")
+    config.ES_HOST = es_url
+    config.ES_INDICES = dict.fromkeys(config.ES_INDICES, web_benchmark.INDEX)
+    config.ES_QUERY_BACKEND = BACKENDS[backend]
+    config.ES_SCROLL_TIME = keep_alive
+    return TornadoBiothingsAPI.get_app(config)
+
+
+def node_stats(client):
+    """The heap used by the nodes and their open scrolls and points in time."""
+    nodes = client.nodes.stats(metric="jvm,indices", index_metric="search")["nodes"].values()
+    search = [node["indices"]["search"] for node in nodes]
+    return {
+        "heap_bytes": sum(node["jvm"]["mem"]["heap_used_in_bytes"] for node in nodes),
+        "scrolls": sum(stats.get("scroll_current", 0) for stats in search),
+        "pits": sum(stats.get("point_in_time_current", 0) for stats in search),
+        "open_contexts": sum(stats.get("open_contexts", 0) for stats in search),
+    }
+
+
+async def export(http, base_url, fields):
+    """Fetch all the documents, return their number and the number of pages."""
+    url = f"{base_url}/v1/query?q=__all__&fetch_all=true&fields={fields}"
+    hits = pages = 0
+    while True:
+        response = await http.fetch(url, raise_error=False)
+        body = json.loads(response.body)
+        if response.code != 200 or not body.get("hits"):
+            return hits, pages
+        hits += len(body["hits"])
+        pages += 1
+        url = f"{base_url}/v1/query?scroll_id={body['_scroll_id']}"
+
+
+async def sample(client, samples, interval):
+    while True:
+        samples.append(await asyncio.to_thread(node_stats, client))
+        await asyncio.sleep(interval)
+
+
+async def run(args, backend, client):
+    app = make_app(args.es, backend, args.keep_alive)
+    sockets = bind_sockets(0, "127.0.0.1")
+    server = HTTPServer(app)
+    server.add_sockets(sockets)
+    base_url = f"http://127.0.0.1:{sockets[0].getsockname()[1]}"
+    http = AsyncHTTPClient(max_clients=args.exports)
+
+    before = await asyncio.to_thread(node_stats, client)
+    samples = []
+    sampler = asyncio.create_task(sample(client, samples, args.interval))
+    start = time.perf_counter()
+    exports = await asyncio.gather(*(export(http, base_url, args.fields) for _ in range(args.exports)))
+    elapsed = time.perf_counter() - start
+    sampler.cancel()
+    after = await asyncio.to_thread(node_stats, client)
+    server.stop()
+
+    samples = samples or [after]
+    return {
+        "seconds": elapsed,
+        "hits": sum(hits for hits, _ in exports),
+        "pages": sum(pages for _, pages in exports),
+        "incomplete": sum(hits != args.docs for hits, _ in exports),
+        "heap_before_mb": before["heap_bytes"] / 2 ** 20,
+        "heap_peak_mb": max(s["heap_bytes"] for s in samples) / 2 ** 20,
+        "heap_mean_mb": sum(s["heap_bytes"] for s in samples) / len(samples) / 2 ** 20,
+        "contexts_peak": max(s["scrolls"] + s["pits"] for s in samples),
+        # left open until they expire after the exports
+        "contexts_after": after["scrolls"] + after["pits"],
+    }
+
+
+def print_result(name, result):
+    print(
+        f"  {name:<7} {result['seconds']:7.1f}s  heap {result['heap_before_mb']:7.1f}MB before,"
+        f" {result['heap_mean_mb']:7.1f}MB mean, {result['heap_peak_mb']:7.1f}MB peak"
+        f"  contexts {result['contexts_peak']} peak, {result['contexts_after']} after"
+    )
+    if result["incomplete"]:
+        print(f"          {result['incomplete']} incomplete exports")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--es", required=True, help="the Elasticsearch to load the index into")
+    parser.add_argument("--docs", type=int, default=100000)
+    parser.add_argument("--exports", type=int, default=50, help="concurrent fetch_all exports")
+    parser.add_argument("--fields", default="all", help="the fields of the exported documents")
+    parser.add_argument("--keep-alive", default="1m", help="ES_SCROLL_TIME")
+    parser.add_argument("--interval", type=float, default=0.5, help="seconds between the heap samples")
+    parser.add_argument("--backends", nargs="*", default=list(BACKENDS), help="pit or scroll")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--reuse-index", action="store_true", help="keep an index of the same size in --es")
+    parser.add_argument("--output", help="default: benchmarks/results/fetch_all-<commit>.json")
+    args = parser.parse_args()
+
+    logging.disable(logging.WARNING)
+    rng = random.Random(args.seed)
+    docs = [web_benchmark.make_doc(index, rng) for index in range(args.docs)]
+    web_benchmark.load_index(args.es, docs, args.reuse_index)
+    del docs
+    client = Elasticsearch(args.es)
+
+    commit = web_benchmark.current_commit()
+    print(f"{args.docs} docs on {args.es}, {args.exports} concurrent exports, keep-alive {args.keep_alive}")
+    results = {}
+    for backend in args.backends:
+        # the scrolls of a previous run still hold heap until they expire
+        client.clear_scroll(scroll_id="_all")
+        results[backend] = asyncio.run(run(args, backend, client))
+        print_result(backend, results[backend])
+
+    output = args.output or os.path.join(web_benchmark.RESULTS_DIR, f"fetch_all-{commit}.json")
+    os.makedirs(os.path.dirname(os.path.abspath(output)), exist_ok=True)
+    options = {key: value for key, value in vars(args).items() if key != "output"}
+    with open(output, "w") as file:
+        json.dump({"commit": commit, "time": time.time(), "options": options, "results": results}, file, indent=2)
+    print(f"saved to {output}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,102 @@
+"""
+Micro-benchmark of the list_filter transformation in MyChemESResultFormatter.
+
+Formats batches of synthetic hits, each carrying a long nested list,
+with the current formatter and with the former implementation, which
+re-parsed the filter at every node and removed items one by one.
+
+    python benchmarks/list_filter.py --hits 1000 --items 2000
+"""
+import argparse
+import copy
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), os.pardir))
+
+from biothings.web.query.formatter import ESResultFormatter  # noqa: E402
+
+from web.pipeline import MyChemESResultFormatter  # noqa: E402
+
+LIST_FILTER = "sider.meddra:type=PT|frequency=0.01"
+
+
+class LegacyFormatter(ESResultFormatter):
+    """The list_filter transformation as it was before it was compiled."""
+
+    def transform_hit(self, path, doc, hit, options):
+        super().transform_hit(path, doc, hit, options)
+        if options.list_filter:
+            list_field_path, sub_field_filters = options.list_filter.split(':')
+            parent_path, list_field = list_field_path.rsplit(".", maxsplit=1)
+            if path == parent_path and list_field in doc:
+                _list = doc[list_field]
+                if not isinstance(_list, list):
+                    _list = [_list]
+                sub_field_filters = [sub_field.split("=") for sub_field in sub_field_filters.split('|')]
+                sub_field_filters = [
+                    (fld.strip(), [v.strip() for v in val.split(",")]) for fld, val in sub_field_filters
+                ]
+                for item in list(_list):
+                    if isinstance(item, dict):
+                        for sub_field, val_list in sub_field_filters:
+                            if str(item.get(sub_field, '')) not in val_list:
+                                _list.remove(item)
+                                break
+                    else:
+                        _list.remove(item)
+                doc[list_field] = _list
+
+
+def make_response(hits, items):
+    meddra = [
+        {
+            "type": "PT" if index % 3 else "LLT",
+            "frequency": 0.01 if index % 10 == 0 else 0.1,
+            "umls_id": f"C{index:07}",
+        }
+        for index in range(items)
+    ]
+    return {
+        "took": 1,
+        "hits": {
+            "total": hits,
+            "max_score": 1.0,
+            "hits": [
+                {"_id": str(index), "_score": 1.0, "_source": {"sider": {"meddra": copy.deepcopy(meddra)}}}
+                for index in range(hits)
+            ],
+        },
+    }
+
+
+def measure(formatter, response, repeat):
+    timings = []
+    for _ in range(repeat):
+        batch = copy.deepcopy(response)
+        start = time.perf_counter()
+        formatter.transform(batch, list_filter=LIST_FILTER)
+        timings.append(time.perf_counter() - start)
+    return min(timings)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--hits", type=int, default=1000)
+    parser.add_argument("--items", type=int, default=2000)
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--skip-legacy", action="store_true")
+    args = parser.parse_args()
+
+    response = make_response(args.hits, args.items)
+    print(f"{args.hits} hits x {args.items} list items, best of {args.repeat}")
+    current = measure(MyChemESResultFormatter(), response, args.repeat)
+    print(f"  compiled list_filter: {current:.3f}s")
+    if not args.skip_legacy:
+        legacy = measure(LegacyFormatter(), response, args.repeat)
+        print(f"  legacy list_filter:   {legacy:.3f}s ({legacy / current:.1f}x)")
+
+
+if __name__ == "__main__":
+    main()
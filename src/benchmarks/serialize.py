@@ -0,0 +1,112 @@
+"""
+Micro-benchmark of the JSON serialization of the largest chem documents.
+
+Formats every document as the response of a /chem/<id> request and
+serializes it with MyChemESResultFormatter.to_json, with the biothings
+serializer, whose str Tornado encodes again, and with the standard
+encoder, reporting the CPU time per request of the transform and of
+each serialization. The documents are the largest of the synthetic
+ones of the web benchmark, or, with --es, of those of an index.
+
+    python benchmarks/serialize.py --largest 100
+    python benchmarks/serialize.py --es http://localhost:9200 --index mychem_current
+"""
+import argparse
+import copy
+import importlib.util
+import json
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), os.pardir))
+
+from biothings.utils import serializer  # noqa: E402
+from biothings.utils.common import BiothingsJSONEncoder  # noqa: E402
+from tornado.escape import utf8  # noqa: E402
+
+from web.pipeline import MyChemESResultFormatter  # noqa: E402
+
+# the web benchmark, which the web package would shadow on sys.path
+_spec = importlib.util.spec_from_file_location("web_benchmark", os.path.join(os.path.dirname(__file__), "web.py"))
+web_benchmark = importlib.util.module_from_spec(_spec)
+_spec.loader.exec_module(web_benchmark)
+
+ENCODERS = {
+    "to_json": MyChemESResultFormatter.to_json,
+    "biothings": lambda result: utf8(serializer.to_json(result)),
+    "stdlib": lambda result: json.dumps(result, cls=BiothingsJSONEncoder).encode(),
+}
+
+
+def synthetic_docs(count, seed):
+    rng = random.Random(seed)
+    return [web_benchmark.make_doc(index, rng) for index in range(count)]
+
+
+def index_docs(url, index, count):
+    from elasticsearch import Elasticsearch, helpers
+
+    client = Elasticsearch(url)
+    for hit in helpers.scan(client, index=index, size=1000):
+        yield {"_id": hit["_id"], **hit["_source"]}
+        count -= 1
+        if not count:
+            return
+
+
+def largest(docs, count):
+    sized = sorted(docs, key=lambda doc: len(serializer.to_json(doc, return_bytes=True)), reverse=True)
+    return sized[:count]
+
+
+def responses(docs):
+    for doc in docs:
+        source = {key: value for key, value in doc.items() if key != "_id"}
+        hit = {"_id": doc["_id"], "_score": 1.0, "_source": source}
+        yield {"took": 1, "hits": {"total": 1, "max_score": 1.0, "hits": [hit]}}
+
+
+def cpu_per_request(func, items, repeat):
+    """The CPU seconds of func per item, best of repeat."""
+    timings = []
+    for _ in range(repeat):
+        batch = copy.deepcopy(items)
+        start = time.process_time()
+        for item in batch:
+            func(item)
+        timings.append((time.process_time() - start) / len(batch))
+    return min(timings)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--largest", type=int, default=100, help="the number of documents serialized")
+    parser.add_argument("--docs", type=int, default=5000, help="the documents the largest are taken from")
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--es", help="take the documents from this Elasticsearch instead")
+    parser.add_argument("--index", default="mychem_current")
+    parser.add_argument("--encoders", nargs="*", default=list(ENCODERS), help="to_json, biothings or stdlib")
+    args = parser.parse_args()
+
+    docs = index_docs(args.es, args.index, args.docs) if args.es else synthetic_docs(args.docs, args.seed)
+    docs = largest(docs, args.largest)
+    size = sum(len(serializer.to_json(doc, return_bytes=True)) for doc in docs) / len(docs)
+    print(f"the {len(docs)} largest of {args.docs} documents, {size / 1024:.1f}KB on average, best of {args.repeat}")
+
+    formatter = MyChemESResultFormatter()
+    batch = list(responses(docs))
+    cpu = cpu_per_request(lambda response: formatter.transform(response, one=True), batch, args.repeat)
+    print(f"  {'transform':<10} {cpu * 1e6:9.1f}us CPU per request")
+    results = [formatter.transform(response, one=True) for response in batch]
+    baseline = None
+    for name in args.encoders:
+        cpu = cpu_per_request(ENCODERS[name], results, args.repeat)
+        baseline = baseline or cpu
+        print(f"  {name:<10} {cpu * 1e6:9.1f}us CPU per request ({cpu / baseline:.2f}x)")
+
+
+if __name__ == "__main__":
+    main()
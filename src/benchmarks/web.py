@@ -0,0 +1,401 @@
+"""
+Throughput benchmark of the web API on a synthetic chem index.
+
+Serves the API in process and drives /chem GET and POST, /query POST
+with scopes and with list_filter, reporting req/s and the p50, p95 and
+p99 latencies of every workload. The index is answered by an in-memory
+stand-in of Elasticsearch, whose responses go through JSON like the
+real transport, or, with --es, loaded into a local Elasticsearch.
+
+    python benchmarks/web.py --docs 10000 --requests 2000 --concurrency 16
+    python benchmarks/web.py --docs 100000 --es http://localhost:9200
+    python benchmarks/web.py --compare benchmarks/results/web-<commit>.json
+
+The results are saved as JSON, with the commit they were measured at,
+so that runs can be compared across commits with --compare.
+"""
+import argparse
+import asyncio
+import json
+import logging
+import os
+import random
+import string
+import subprocess
+import sys
+import time
+from urllib.parse import quote
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), os.pardir))
+
+from biothings.utils import serializer  # noqa: E402
+from biothings.web.applications import TornadoBiothingsAPI  # noqa: E402
+from biothings.web.services.metadata import BiothingsMetadata  # noqa: E402
+from biothings.web.settings import configs  # noqa: E402
+from elasticsearch.dsl import MultiSearch  # noqa: E402
+from tornado.httpclient import AsyncHTTPClient  # noqa: E402
+from tornado.httpserver import HTTPServer  # noqa: E402
+from tornado.netutil import bind_sockets  # noqa: E402
+
+INDEX = "mychem_benchmark"
+RESULTS_DIR = os.path.join(os.path.dirname(__file__), "results")
+LIST_FILTER = "sider.meddra:type=PT|frequency=0.01"
+
+KEYWORD = {"type": "keyword", "normalizer": "keyword_lowercase_normalizer"}
+PROPERTIES = {
+    "chembl": {
+        "properties": {
+            "molecule_chembl_id": KEYWORD,
+            "pref_name": {"type": "text"},
+            "drug_indications": {"properties": {"mesh_id": KEYWORD, "max_phase_for_ind": {"type": "integer"}}},
+        }
+    },
+    "drugbank": {
+        "properties": {
+            "id": KEYWORD,
+            "name": {"type": "text"},
+            "targets": {"properties": {"uniprot": KEYWORD, "actions": KEYWORD}},
+        }
+    },
+    "pubchem": {"properties": {"cid": {"type": "integer"}, "inchikey": KEYWORD}},
+    "unii": {"properties": {"unii": KEYWORD}},
+    "unichem": {"properties": {"drugbank": KEYWORD}},
+    "sider": {
+        "properties": {
+            "stitch": {"properties": {"flat": KEYWORD}},
+            "meddra": {
+                "type": "nested",
+                "properties": {"type": KEYWORD, "umls_id": KEYWORD, "frequency": {"type": "float"}},
+            },
+        }
+    },
+}
+INDEX_BODY = {
+    "settings": {
+        "analysis": {
+            "normalizer": {"keyword_lowercase_normalizer": {"type": "custom", "filter": ["lowercase"]}}
+        }
+    },
+    "mappings": {"_meta": {"biothing_type": "chem", "build_version": "benchmark"}, "properties": PROPERTIES},
+}
+
+
+def inchikey(rng):
+    blocks = (14, 10, 1)
+    return "-".join("".join(rng.choices(string.ascii_uppercase, k=size)) for size in blocks)
+
+
+def make_doc(index, rng):
+    """A chem document with lists of realistic lengths, some of them long."""
+    drugbank_id = f"DB{index:05}"
+    return {
+        "_id": inchikey(rng),
+        "chembl": {
+            "molecule_chembl_id": f"CHEMBL{index + 1}",
+            "pref_name": f"compound {index}",
+            "drug_indications": [
+                {"mesh_id": f"D{rng.randrange(10 ** 6):06}", "max_phase_for_ind": rng.randrange(5)}
+                for _ in range(rng.randrange(20))
+            ],
+        },
+        "drugbank": {
+            "id": drugbank_id,
+            "name": f"drug {index}",
+            "targets": [
+                {"uniprot": f"P{rng.randrange(10 ** 5):05}", "actions": rng.choice(["inhibitor", "agonist"])}
+                for _ in range(rng.randrange(10))
+            ],
+        },
+        "pubchem": {"cid": 1000 + index},
+        "unii": {"unii": "".join(rng.choices(string.ascii_uppercase + string.digits, k=10))},
+        "unichem": {"drugbank": drugbank_id},
+        "sider": {
+            "stitch": {"flat": f"CID{100000000 + index}"},
+            "meddra": [
+                {
+                    "type": rng.choice(["PT", "LLT"]),
+                    "umls_id": f"C{rng.randrange(10 ** 7):07}",
+                    "frequency": rng.choice([0.01, 0.1, 0.5]),
+                }
+                for _ in range(rng.choice([0, 5, 50, 500]))
+            ],
+        },
+    }
+
+
+def flatten(value, path=""):
+    """Yield the (field, value) leaves of a document, through the lists."""
+    if isinstance(value, dict):
+        for key, val in value.items():
+            yield from flatten(val, f"{path}.{key}" if path else key)
+    elif isinstance(value, list):
+        for val in value:
+            yield from flatten(val, path)
+    else:
+        yield path, value
+
+
+class StandInBackend:
+    """
+    Answer the searches of the query builder from an in-memory index:
+    multi_match, terms, ids and bool queries on exact values, matching
+    keywords case-insensitively, with _source includes and docvalues.
+    Every response is serialized to JSON and parsed back, as the real
+    transport would, so that only the Elasticsearch work is left out.
+    """
+
+    def __init__(self, docs):
+        self.docs = docs
+        self.values = []  # the {field: [lowercase values]} of every document
+        self.index = {}  # {field: {lowercase value: [position, ...]}}
+        for position, doc in enumerate(docs):
+            values = {}
+            for field, value in flatten(doc):
+                values.setdefault(field, []).append(str(value).lower())
+            values["_id"] = [doc["_id"].lower()]
+            self.values.append(values)
+            for field, field_values in values.items():
+                for value in set(field_values):
+                    self.index.setdefault(field, {}).setdefault(value, []).append(position)
+
+    def lookup(self, field, values):
+        positions = set()
+        field_index = self.index.get(field, {})
+        for value in values:
+            positions.update(field_index.get(str(value).lower(), ()))
+        return positions
+
+    def match(self, query):
+        (kind, params), = query.items()
+        if kind == "multi_match":
+            return set().union(*(self.lookup(field, [params["query"]]) for field in params["fields"]))
+        if kind == "terms":
+            (field, values), = params.items()
+            return self.lookup(field, values)
+        if kind == "ids":
+            return self.lookup("_id", params["values"])
+        if kind == "bool":
+            positions = None
+            for clause in params.get("must", []) + params.get("filter", []):
+                matched = self.match(clause)
+                positions = matched if positions is None else positions & matched
+            if params.get("should"):
+                matched = set().union(*(self.match(clause) for clause in params["should"]))
+                positions = matched if positions is None else positions & matched
+            return positions or set()
+        raise NotImplementedError(f"{kind} queries are not supported by the stand-in.")
+
+    def search(self, search):
+        positions = sorted(self.match(search["query"]))
+        includes = search.get("_source", {}).get("includes")
+        hits = []
+        for position in positions[: search.get("size", 10)]:
+            doc = self.docs[position]
+            source = {
+                key: value
+                for key, value in doc.items()
+                if key != "_id" and (not includes or any(field.split(".")[0] == key for field in includes))
+            }
+            hit = {"_index": INDEX, "_id": doc["_id"], "_score": 1.0, "_source": source}
+            if search.get("docvalue_fields"):
+                values = self.values[position]
+                hit["fields"] = {field: values[field] for field in search["docvalue_fields"] if field in values}
+            hits.append(hit)
+        total = {"value": len(positions), "relation": "eq"}
+        return {"took": 1, "timed_out": False, "hits": {"total": total, "max_score": 1.0, "hits": hits}}
+
+    async def execute(self, query, **options):
+        if isinstance(query, MultiSearch):
+            response = [self.search(search) for search in query.to_dict()[1::2]]
+        else:
+            response = self.search(query.to_dict())
+        return serializer.load_json(serializer.to_json(response))
+
+
+def make_metadata():
+    metadata = BiothingsMetadata()
+    metadata.biothing_metadata["chem"] = {"_biothing": "chem", "build_version": "benchmark"}
+    metadata.biothing_mappings["chem"] = PROPERTIES
+    return metadata
+
+
+def load_index(url, docs, reuse):
+    from elasticsearch import Elasticsearch, helpers
+
+    client = Elasticsearch(url)
+    if client.indices.exists(index=INDEX):
+        if reuse and client.count(index=INDEX)["count"] == len(docs):
+            return
+        client.indices.delete(index=INDEX)
+    client.indices.create(index=INDEX, **INDEX_BODY)
+    actions = ({"_index": INDEX, "_id": doc["_id"], **{k: v for k, v in doc.items() if k != "_id"}} for doc in docs)
+    helpers.bulk(client, actions, chunk_size=1000)
+    client.indices.refresh(index=INDEX)
+
+
+def make_app(docs, es_url):
+    config = configs.load("config_web")
+    if es_url:
+        config.ES_HOST = es_url
+        config.ES_INDICES = dict.fromkeys(config.ES_INDICES, INDEX)
+    app = TornadoBiothingsAPI.get_app(config)
+    if not es_url:
+        backend, metadata = StandInBackend(docs), make_metadata()
+        for pipeline in {id(p): p for p in (app.biothings.pipeline, app.biothings.db.pipeline)}.values():
+            pipeline.backend = backend
+            pipeline.builder.metadata = metadata
+    return app
+
+
+def workloads(docs, batch_size, rng):
+    """{name: a function returning the arguments of one request}"""
+
+    def some_id():
+        doc = rng.choice(docs)
+        return rng.choice(
+            [
+                doc["drugbank"]["id"],
+                f"DRUGBANK:{doc['drugbank']['id']}",
+                doc["chembl"]["molecule_chembl_id"],
+                f"CHEMBL.COMPOUND:{doc['chembl']['molecule_chembl_id']}",
+                f"PUBCHEM.COMPOUND:{doc['pubchem']['cid']}",
+                doc["_id"],
+                f"DB{rng.randrange(10 ** 5, 10 ** 6)}",  # not found
+            ]
+        )
+
+    def batch(ids):
+        return json.dumps({"ids": ids, "fields": "drugbank.id,chembl.molecule_chembl_id"})
+
+    def query(ids, **params):
+        return json.dumps({"q": ids, "scopes": ["drugbank.id", "unichem.drugbank"], **params})
+
+    def drugbank_ids():
+        return [rng.choice(docs)["drugbank"]["id"] for _ in range(batch_size)]
+
+    return {
+        "chem_get": lambda: ("GET", f"/v1/chem/{quote(some_id(), safe='')}", None),
+        "chem_post": lambda: ("POST", "/v1/chem", batch([some_id() for _ in range(batch_size)])),
+        "query_scopes": lambda: ("POST", "/v1/query", query(drugbank_ids(), fields="drugbank")),
+        "query_list_filter": lambda: (
+            "POST",
+            "/v1/query",
+            query(drugbank_ids(), fields="sider", list_filter=LIST_FILTER),
+        ),
+    }
+
+
+def percentile(timings, fraction):
+    return timings[round(fraction * (len(timings) - 1))]
+
+
+async def drive(base_url, make_request, requests, concurrency):
+    client = AsyncHTTPClient(max_clients=concurrency)
+    timings, errors = [], 0
+    queue = iter(range(requests))
+
+    async def worker():
+        nonlocal errors
+        for _ in queue:
+            method, path, body = make_request()
+            headers = {"Content-Type": "application/json"} if body else None
+            start = time.perf_counter()
+            response = await client.fetch(base_url + path, method=method, body=body, headers=headers, raise_error=False)
+            timings.append(time.perf_counter() - start)
+            errors += response.code not in (200, 404)  # some ids are not found on purpose
+
+    start = time.perf_counter()
+    await asyncio.gather(*(worker() for _ in range(concurrency)))
+    elapsed = time.perf_counter() - start
+    timings.sort()
+    return {
+        "requests": requests,
+        "errors": errors,
+        "req_per_s": requests / elapsed,
+        "p50_ms": percentile(timings, 0.50) * 1000,
+        "p95_ms": percentile(timings, 0.95) * 1000,
+        "p99_ms": percentile(timings, 0.99) * 1000,
+    }
+
+
+async def run(args, docs):
+    app = make_app(docs, args.es)
+    sockets = bind_sockets(0, "127.0.0.1")
+    server = HTTPServer(app)
+    server.add_sockets(sockets)
+    base_url = f"http://127.0.0.1:{sockets[0].getsockname()[1]}"
+
+    rng = random.Random(args.seed)
+    results = {}
+    for name, make_request in workloads(docs, args.batch_size, rng).items():
+        if args.workloads and name not in args.workloads:
+            continue
+        await drive(base_url, make_request, min(args.requests, 50), args.concurrency)  # warm up
+        results[name] = await drive(base_url, make_request, args.requests, args.concurrency)
+        print_result(name, results[name])
+    server.stop()
+    return results
+
+
+def print_result(name, result, baseline=None):
+    line = (
+        f"  {name:<18} {result['req_per_s']:9.1f} req/s  p50 {result['p50_ms']:8.2f}ms"
+        f"  p95 {result['p95_ms']:8.2f}ms  p99 {result['p99_ms']:8.2f}ms"
+    )
+    if result["errors"]:
+        line += f"  {result['errors']} errors"
+    if baseline:
+        line += f"  ({result['req_per_s'] / baseline['req_per_s']:.2f}x req/s)"
+    print(line)
+
+
+def current_commit():
+    try:
+        return subprocess.check_output(["git", "rev-parse", "--short", "HEAD"], text=True).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return "unknown"
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--docs", type=int, default=10000)
+    parser.add_argument("--requests", type=int, default=1000, help="per workload")
+    parser.add_argument("--concurrency", type=int, default=16)
+    parser.add_argument("--batch-size", type=int, default=100, help="ids of a POST request")
+    parser.add_argument("--workloads", nargs="*", help="chem_get, chem_post, query_scopes or query_list_filter")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--es", help="load the index into this Elasticsearch instead of the stand-in")
+    parser.add_argument("--reuse-index", action="store_true", help="keep an index of the same size in --es")
+    parser.add_argument("--output", help="default: benchmarks/results/web-<commit>.json")
+    parser.add_argument("--compare", help="the JSON results of another run to compare with")
+    args = parser.parse_args()
+
+    # without --es, the metadata of the app cannot be loaded, which is logged as an error
+    logging.disable(logging.WARNING if args.es else logging.CRITICAL)
+    rng = random.Random(args.seed)
+    docs = [make_doc(index, rng) for index in range(args.docs)]
+    if args.es:
+        load_index(args.es, docs, args.reuse_index)
+
+    commit = current_commit()
+    backend = args.es or "stand-in"
+    print(f"{args.docs} docs on {backend}, {args.requests} requests per workload, concurrency {args.concurrency}")
+    results = asyncio.run(run(args, docs))
+
+    output = args.output or os.path.join(RESULTS_DIR, f"web-{commit}.json")
+    os.makedirs(os.path.dirname(os.path.abspath(output)), exist_ok=True)
+    options = {key: value for key, value in vars(args).items() if key not in ("output", "compare")}
+    with open(output, "w") as file:
+        json.dump({"commit": commit, "time": time.time(), "options": options, "results": results}, file, indent=2)
+    print(f"saved to {output}")
+
+    if args.compare:
+        with open(args.compare) as file:
+            baseline = json.load(file)
+        print(f"compared with {baseline['commit']}:")
+        for name, result in results.items():
+            print_result(name, result, baseline["results"].get(name))
+
+
+if __name__ == "__main__":
+    main()
@@ -42,6 +42,8 @@ class MyChemHubServer(HubServer):
     def configure_commands(self):
         super().configure_commands() # keep all originals...
         # ... and enrich
+        from hub.datatransform.keylookup import print_paths
+        self.commands["keylookup_paths"] = print_paths
         self.commands["merge_demo"] = partial(self.managers["build_manager"].merge,"demo_drug")
         self.commands["es_sync_test"] = partial(self.managers["sync_manager_test"].sync,"es",
                                                 target_backend=(config.INDEX_CONFIG["env"]["local"]["host"],
@@ -62,6 +64,9 @@ class MyChemHubServer(HubServer):
 
 
 import hub.dataload
+from hub.datatransform.keylookup import plan_paths
+# the uploaders of every process share the paths planned once here
+plan_paths()
 # pass explicit list of datasources (no auto-discovery)
 server = MyChemHubServer(hub.dataload.__sources_dict__,name="MyChem.info")
 
@@ -38,6 +38,36 @@ INDEX_CONFIG = {
     },
 }
 
+# Folder the indexer writes "<index>.crosswalk" to after each index,
+# to be served by the /normalize endpoint (NORMALIZE_CROSSWALK in
+# config_web). None skips it.
+CROSSWALK_FOLDER = None
+
+# Folder the indexer writes "<index>.suggest" to after each index, the
+# names served by the /suggest endpoint (SUGGEST_FILE in config_web).
+# None skips it.
+SUGGEST_FOLDER = None
+
+# Folder the drugbank_full uploader writes "drugbank_full.interactions"
+# to, the adjacency of the drug interactions served by /interactions
+# (INTERACTIONS_FILE in config_web). None skips it.
+INTERACTIONS_FOLDER = None
+
+
+# The MongoDB edges of the key lookup graph read the lookup and target
+# fields of their whole collection at the first lookup of an upload, and
+# answer the lookups from memory, up to this many bytes for all the
+# edges of a hub process, estimated, see PreloadedMongoDBEdge. Edges
+# not fitting in it, or all of them with 0, query MongoDB for every
+# batch of ids.
+KEYLOOKUP_PRELOAD_MAX_BYTES = 512 * 1024 * 1024
+# SQLite file keeping the values the lookups found across uploads and
+# builds, until the collections they were read from are uploaded again.
+# None to look every id up again.
+KEYLOOKUP_CACHE = None
+# threads looking up the collections of an edge of several collections,
+# like smiles -> inchikey, concurrently. Below 2, one after another.
+KEYLOOKUP_EDGE_GROUP_THREADS = 4
 
 # Snapshot environment configuration
 SNAPSHOT_CONFIG = {
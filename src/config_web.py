@@ -7,7 +7,10 @@
 import copy
 import re
 
-from biothings.web.settings.default import ANNOTATION_KWARGS, QUERY_KWARGS
+from biothings.web.settings.default import ANNOTATION_DEFAULT_SCOPES, ANNOTATION_KWARGS, APP_LIST, QUERY_KWARGS
+
+from shared.crosswalk import CROSSWALK_FIELDS
+from web.classifier import AnnotationIdClassifier
 
 # *****************************************************************************
 # Elasticsearch variables
@@ -18,7 +21,12 @@ ES_INDICES = {
     "drug": "mychem_current",
     "compound": "mychem_current",
 }
-ES_SCROLL_TIME = "10m"
+# fetch_all pages through a point in time (see web.pipeline.MyChemESQueryBackend),
+# kept alive for ES_SCROLL_TIME after each page
+ES_SCROLL_TIME = "1m"
+# the secret signing the continuation tokens of fetch_all, the same for
+# all the workers answering the next pages. None scrolls instead.
+SCROLL_TOKEN_SECRET = None
 
 # *****************************************************************************
 # Endpoint Specifics
@@ -125,21 +133,211 @@ default_chem_fields = ()
 default_chem_regex_pattern = (default_chem_regex, default_chem_fields)
 
 
-ANNOTATION_ID_REGEX_LIST = [
-    *biolink_curie_regex_list,
-    *chem_prefix_handling,
-    default_chem_regex_pattern,
+# The prefixes of the ids above, with the term patterns that can follow
+# them, in the same order, so that ids are classified in a single pass.
+# A pattern without a term group searches the whole id.
+annotation_id_prefixes = {
+    biolink_prefix: [(mapping.get("regex_term_pattern") or "(?P<term>[^:]+)", mapping.get("field", []))]
+    for biolink_prefix, mapping in BIOLINK_MODEL_PREFIX_BIOTHINGS_CHEM_MAPPING.items()
+}
+annotation_id_prefixes["CHEBI"].append((r"[0-9]+", ["chebi.id", "chebi.secondary_chebi_id"]))
+annotation_id_prefixes.update(
+    {
+        "CHEMBL": [(r"(?P<term>chembl[0-9]+)", "chembl.molecule_chembl_id")],
+        "PHARMGKB.DRUG": [(r"(?P<term>pa[0-9]+)", "pharmgkb.id")],
+        "CID": [(r"(?P<term>[0-9]+)", ["pubchem.cid"])],
+        "SID": [(r"(?P<term>[0-9]+)", ["fda_orphan_drug.pubchem_sid"])],
+        "PUBCHEM.SUBSTANCE": [(r"(?P<term>[0-9]+)", ["fda_orphan_drug.pubchem_sid"])],
+    }
+)
+# The ids above without prefix, a bare number is a pubchem cid.
+annotation_bare_id_patterns = [
+    (r"chembl[0-9]+", "chembl.molecule_chembl_id"),
+    (r"[A-Z0-9]{10}", "unii.unii"),
+    (r"db[0-9]+", DRUGBANK_ID_FIELDS),
+    (r"pa[0-9]+", "pharmgkb.id"),
+    (r"[0-9]+", ["pubchem.cid"]),
 ]
 
+ANNOTATION_ID_REGEX_LIST = AnnotationIdClassifier(
+    [
+        *biolink_curie_regex_list,
+        *chem_prefix_handling,
+        default_chem_regex_pattern,
+    ],
+    prefixes=annotation_id_prefixes,
+    bare_patterns=annotation_bare_id_patterns,
+    default_pattern=default_chem_regex_pattern,
+    default_scopes=ANNOTATION_DEFAULT_SCOPES,
+)
+
 
 STATUS_CHECK = {
     "id": "USNINKBPBVKHHZ-CYUUQNCZSA-L",  # penicillin
     "index": "mychem_current",
 }
 
-_extra_kwargs = {"list_filter": {"type": str, "default": None}}
+_extra_kwargs = {
+    "list_filter": {"type": str, "default": None},
+    # page through the list at list_field, or the one of list_filter
+    "list_field": {"type": str, "default": None},
+    "list_offset": {"type": int, "default": 0},
+    "list_limit": {"type": int, "default": None},
+    # "es" executes list_filter in Elasticsearch when the list is mapped as nested,
+    # and the list paging when the list is not filtered
+    "list_filter_mode": {"type": str, "default": "python", "enum": ("python", "es")},
+}
 ANNOTATION_KWARGS = copy.deepcopy(ANNOTATION_KWARGS)
 ANNOTATION_KWARGS["*"].update(_extra_kwargs)
 QUERY_KWARGS = copy.deepcopy(QUERY_KWARGS)
 QUERY_KWARGS["*"].update(_extra_kwargs)
+# format=ndjson streams the results of a POST query, see MyChemQueryHandler
+QUERY_KWARGS["POST"]["format"] = dict(QUERY_KWARGS["*"]["format"], enum=(*QUERY_KWARGS["*"]["format"]["enum"], "ndjson"))
+# the number of queries searched at a time when streaming
+QUERY_STREAM_CHUNK_SIZE = 1000
+ES_QUERY_BUILDER = "web.pipeline.MyChemQueryBuilder"
+ES_QUERY_BACKEND = "web.pipeline.MyChemESQueryBackend"
+ES_QUERY_PIPELINE = "web.pipeline.MyChemQueryPipeline"
 ES_RESULT_TRANSFORM = "web.pipeline.MyChemESResultFormatter"
+
+_handler_overrides = {
+    "biothings.web.handlers.BiothingHandler": "web.handlers.MyChemBiothingHandler",
+    "biothings.web.handlers.MetadataSourceHandler": "web.handlers.MyChemMetadataSourceHandler",
+    "biothings.web.handlers.QueryHandler": "web.handlers.MyChemQueryHandler",
+    "biothings.web.handlers.StatusHandler": "web.handlers.MyChemStatusHandler",
+}
+APP_LIST = [(pattern, _handler_overrides.get(handler, handler), *rest) for pattern, handler, *rest in APP_LIST]
+APP_LIST.insert(
+    next(index for index, (pattern, *_) in enumerate(APP_LIST) if pattern == "/{pre}/status") + 1,
+    ("/{pre}/metrics", "web.handlers.MetricsHandler"),
+)
+APP_LIST.append(("/{pre}/{ver}/normalize(?:/([^/]+))?/?", "web.handlers.NormalizeHandler"))
+APP_LIST.append(("/{pre}/{ver}/interactions/?", "web.handlers.InteractionsHandler"))
+APP_LIST.append(("/{pre}/{ver}/suggest/?", "web.handlers.SuggestHandler"))
+APP_LIST.append(("/{pre}/{ver}/{typ}/skeleton/([^/]+)/?", "web.handlers.SkeletonHandler"))
+# before the annotation route, which would take "smiles" for an id
+APP_LIST.insert(
+    next(index for index, (_, handler, *_) in enumerate(APP_LIST) if handler == "web.handlers.MyChemBiothingHandler"),
+    ("/{pre}/{ver}/{typ}/smiles/?", "web.handlers.SmilesHandler"),
+)
+APP_LIST.insert(
+    next(index for index, (_, handler, *_) in enumerate(APP_LIST) if handler == "web.handlers.MyChemBiothingHandler"),
+    ("/{pre}/{ver}/{typ}/export/?", "web.handlers.ExportHandler"),
+)
+
+# *****************************************************************************
+# Annotation cache
+# *****************************************************************************
+# Cache the results of /chem annotation requests, at most this many
+# ids, 0 disables the cache. It is cleared when the STATUS_CHECK
+# document is read from another index, i.e. another build.
+ANNOTATION_CACHE_SIZE = 0
+ANNOTATION_CACHE_MAX_BYTES = 256 * 1024 * 1024  # of serialized results
+ANNOTATION_CACHE_TTL = 3600  # seconds
+ANNOTATION_CACHE_BUILD_CHECK_INTERVAL = 60  # seconds
+
+# Identical /chem annotation requests in flight at the same time share
+# one Elasticsearch query, keyed like the annotation cache.
+ANNOTATION_COALESCING = False
+
+# The /chem/<id> and GET /query responses are tagged with an ETag
+# computed from the build, i.e. the index the STATUS_CHECK document is
+# read from, checked every ANNOTATION_CACHE_BUILD_CHECK_INTERVAL, and
+# the request, so that revalidating a response costs no search. A 304
+# may be answered for the previous build for up to that interval after
+# a new one.
+BUILD_ETAGS = False
+
+# *****************************************************************************
+# Warm-up
+# *****************************************************************************
+# Warm every worker up, from its first /status check, before /status
+# reports it ready, with a 503 until then: open WARMUP_CONNECTIONS
+# connections to Elasticsearch, read the STATUS_CHECK document and the
+# metadata, and annotate the WARMUP_IDS, to be set to ids of the index.
+WARMUP = False
+WARMUP_CONNECTIONS = 10
+WARMUP_IDS = [
+    "USNINKBPBVKHHZ-CYUUQNCZSA-L",  # penicillin
+    "BSYNRYMUTXBXSQ-UHFFFAOYSA-N",  # aspirin
+    "CHEMBL25",
+    "DB00945",
+    "CHEBI:15365",
+]
+
+# *****************************************************************************
+# Stage metrics
+# *****************************************************************************
+# Time the id classification, Elasticsearch, result transform and
+# serialization stages of the /chem and /query requests, in histograms
+# served in the Prometheus text format at /metrics.
+STAGE_METRICS = False
+# Also report them in the Server-Timing header of the responses.
+STAGE_METRICS_SERVER_TIMING = False
+
+# *****************************************************************************
+# ID normalization
+# *****************************************************************************
+# /normalize maps the ids of these fields to the _id of their documents,
+# from the crosswalk file the hub writes next to each index, see
+# MyChemIndexer.post_index. None disables the endpoint.
+NORMALIZE_CROSSWALK = None
+NORMALIZE_FIELDS = CROSSWALK_FIELDS
+NORMALIZE_KWARGS = {
+    "GET": {"id": {"type": str, "path": 0, "required": True}},
+    "POST": {"id": {"type": list, "max": 10000, "required": True, "alias": "ids"}},
+}
+
+# /suggest completes the names of the chemicals from the suggestions
+# file the hub writes next to each index, see MyChemIndexer.post_index,
+# ranked by the number of sources naming them. None disables the
+# endpoint. The names are those of shared.suggest.SUGGEST_FIELDS.
+SUGGEST_FILE = None
+SUGGEST_KWARGS = {
+    "GET": {
+        "q": {"type": str, "required": True},
+        "size": {"type": int, "default": 10, "max": 20},
+    },
+}
+
+# /interactions tells which drugs interact among a few DrugBank ids,
+# every pair of them, from the adjacency file the drugbank_full
+# uploader writes (INTERACTIONS_FOLDER in config_hub). None disables the
+# endpoint.
+INTERACTIONS_FILE = None
+INTERACTIONS_KWARGS = {
+    "*": {"ids": {"type": list, "max": 100, "required": True}},
+}
+
+# /chem/skeleton/<block> finds the documents of an InChIKey first block,
+# with the paging and formatting parameters of /query, and protonation
+# to only keep one protonation flag.
+SKELETON_KWARGS = {
+    "*": copy.deepcopy(QUERY_KWARGS["*"]),
+    "GET": {
+        "block": {"type": str, "path": 0, "required": True},
+        "protonation": {"type": str},
+    },
+}
+
+# /chem/smiles finds the documents of a SMILES, or a batch of them with
+# POST, after its canonicalization, with the parameters of /query.
+SMILES_KWARGS = {
+    "*": copy.deepcopy(QUERY_KWARGS["*"]),
+    "GET": {"q": {"type": str, "required": True, "strict": False}},
+    "POST": {"q": {"type": list, "max": 1000, "required": True, "strict": False}},
+}
+
+# /chem/export streams the documents of the index as compressed JSON
+# lines, the fields projected and only those having all the fields of
+# "has", scanned EXPORT_SLICES slices at a time, EXPORT_PAGE_SIZE
+# documents per page.
+EXPORT_SLICES = 4
+EXPORT_PAGE_SIZE = 250
+EXPORT_KWARGS = {
+    "GET": {
+        "_source": copy.deepcopy(QUERY_KWARGS["*"]["_source"]),
+        "has": {"type": list, "max": 100},
+        "compression": {"type": str, "default": "gzip", "enum": ("gzip", "zstd")},
+    },
+}
@@ -1,6 +1,10 @@
+from pymongo import UpdateOne
+
 import biothings.utils.mongo as mongo
 import biothings.hub.databuild.builder as builder
 
+from shared.smiles import Chem, SMILES_FIELDS, doc_hashes
+
 class MyChemDataBuilder(builder.DataBuilder):
 
     def get_stats(self,sources,job_manager):
@@ -9,4 +13,25 @@ class MyChemDataBuilder(builder.DataBuilder):
         self.stats["total"] = tgt.count()
         return self.stats
 
-
+    def post_merge(self, source_names, batch_size, job_manager):
+        """
+        Set smiles_hash, the hashes of the SMILES of every document and
+        of their canonical forms, searched by /chem/smiles.
+        """
+        if Chem is None:
+            self.logger.warning("RDKit is not installed, smiles_hash will only match SMILES as they are")
+        tgt = mongo.get_target_db()[self.target_name]
+        query = {"$or": [{field: {"$exists": True}} for field in SMILES_FIELDS]}
+        projection = {field: 1 for field in SMILES_FIELDS}
+        updates, count = [], 0
+        for doc in tgt.find(query, projection, batch_size=10000):
+            hashes = doc_hashes(doc)
+            if hashes:
+                updates.append(UpdateOne({"_id": doc["_id"]}, {"$set": {"smiles_hash": hashes}}))
+            if len(updates) >= 10000:
+                count += tgt.bulk_write(updates, ordered=False).modified_count
+                updates = []
+        if updates:
+            count += tgt.bulk_write(updates, ordered=False).modified_count
+        self.logger.info("Set smiles_hash on %s documents", count)
+        return {"smiles_hash": count}
@@ -1,6 +1,14 @@
+import os
 from copy import deepcopy
+from functools import partial
 
+from biothings import config
 from biothings.hub.dataindex.indexer import Indexer
+from biothings.utils.mongo import DatabaseClient
+from elasticsearch import AsyncElasticsearch
+
+from shared.crosswalk import CROSSWALK_FIELDS, CrosswalkWriter
+from shared.suggest import SUGGEST_FIELDS, SuggestWriter
 
 DEFAULT_INDEX_MAPPINGS = {
     "properties": {
@@ -16,10 +24,38 @@ DEFAULT_INDEX_MAPPINGS = {
                 }
             },
             "copy_to": "all"
-        }
+        },
+        # the blocks of an InChIKey _id, set by INCHIKEY_BLOCKS_PIPELINE,
+        # to find the documents of the same skeleton with one term query.
+        "inchikey_skeleton": {"type": "keyword"},
+        "inchikey_protonation": {"type": "keyword"},
+        # set by MyChemDataBuilder.post_merge
+        "smiles_hash": {"type": "keyword"},
     }
 }
 
+# The ingest pipeline every document of an index goes through, setting
+# the connectivity block (first 14 characters) and the protonation flag
+# (last character) of its _id when it is a standard InChIKey.
+INCHIKEY_BLOCKS_PIPELINE = {
+    "id": "mychem_inchikey_blocks",
+    "description": "Set inchikey_skeleton and inchikey_protonation from an InChIKey _id",
+    "processors": [
+        {
+            "script": {
+                "lang": "painless",
+                "source": """
+                    String id = ctx._id;
+                    if (id != null && id.length() == 27 && id.indexOf('-') == 14 && id.lastIndexOf('-') == 25) {
+                        ctx.inchikey_skeleton = id.substring(0, 14);
+                        ctx.inchikey_protonation = id.substring(26);
+                    }
+                """,
+            }
+        }
+    ],
+}
+
 
 class MyChemIndexer(Indexer):
     def __init__(self, build_doc, indexer_env, index_name):
@@ -30,5 +66,55 @@ class MyChemIndexer(Indexer):
         self.es_index_mappings["properties"].update(
             new_mappings["properties"])
 
+        self.es_index_settings["default_pipeline"] = INCHIKEY_BLOCKS_PIPELINE["id"]
+
         self.logger.debug("Updated Index mappings: %s",
                           dict(self.es_index_mappings))
+
+    async def pre_index(self, *args, **kwargs):
+        # the pipeline must exist before the index refers to it
+        client = AsyncElasticsearch(**self.es_client_args)
+        try:
+            await client.ingest.put_pipeline(**INCHIKEY_BLOCKS_PIPELINE)
+        finally:
+            await client.close()
+        return await super().pre_index(*args, **kwargs)
+
+    async def post_index(self, job_manager, *args, **kwargs):
+        """
+        Write the files served next to the index, when their folder is
+        set: its crosswalk, "<index>.crosswalk" in CROSSWALK_FOLDER, which
+        /normalize answers from, and its names, "<index>.suggest" in
+        SUGGEST_FOLDER, which /suggest answers from.
+        """
+        result = {}
+        for name, folder, write, unit in (
+            ("crosswalk", getattr(config, "CROSSWALK_FOLDER", None), self.write_crosswalk, "keys"),
+            ("suggest", getattr(config, "SUGGEST_FOLDER", None), self.write_suggestions, "names"),
+        ):
+            if not folder:
+                continue
+            path = os.path.join(folder, f"{self.es_index_name}.{name}")
+            pinfo = self.pinfo.get_pinfo(name, path)
+            job = await job_manager.defer_to_thread(pinfo, partial(write, path))
+            count = await job
+            self.logger.info("Wrote %s %s to %s", count, unit, path)
+            result[name] = {"path": path, unit: count}
+        return result or None
+
+    def write_crosswalk(self, path):
+        client = DatabaseClient(**self.mongo_client_args)
+        collection = client[self.mongo_database_name][self.mongo_collection_name]
+        projection = {field: 1 for field in CROSSWALK_FIELDS if field != "_id"}
+        with CrosswalkWriter(path, CROSSWALK_FIELDS) as writer:
+            for doc in collection.find({}, projection, batch_size=10000):
+                writer.add_doc(doc)
+        return writer.keys
+
+    def write_suggestions(self, path):
+        client = DatabaseClient(**self.mongo_client_args)
+        collection = client[self.mongo_database_name][self.mongo_collection_name]
+        with SuggestWriter(path, SUGGEST_FIELDS) as writer:
+            for doc in collection.find({}, dict.fromkeys(SUGGEST_FIELDS, 1), batch_size=10000):
+                writer.add_doc(doc)
+        return writer.names
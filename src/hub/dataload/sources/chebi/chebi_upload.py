@@ -75,7 +75,7 @@ class ChebiUploader(BaseDrugUploader):
         chebi_parser = ChebiParser(compound_reader, ontology_reader)
 
         # KeyLookup is disabled due to duplicate key errors
-        return self.exclude_fields(self.keylookup(chebi_parser.parse, debug=True))()
+        return self.exclude_fields(self.keylookup(chebi_parser.parse, debug=True, report=self.keylookup_report()))()
         # return self.exclude_fields(load_data)(input_file)
 
     def post_update_data(self, *args, **kwargs):
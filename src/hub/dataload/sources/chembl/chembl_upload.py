@@ -80,7 +80,10 @@ class ChemblUploader(BaseDrugUploader, ParallelizedSourceUploader):
         self.logger.info("Load data from file '%s'" %
                          mol_data_loader.molecule_filepath)
 
-        return self.keylookup(load_chembl_data, debug=True)(mol_data_loader, aux_data_loader)
+        # one report per molecule file
+        job = os.path.basename(mol_data_loader.molecule_filepath).rsplit(".", 1)[0]
+        report = self.keylookup_report(job)
+        return self.keylookup(load_chembl_data, debug=True, report=report)(mol_data_loader, aux_data_loader)
 
     def post_update_data(self, *args, **kwargs):
         """create indexes following an update"""
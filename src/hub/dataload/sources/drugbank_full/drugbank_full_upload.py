@@ -8,11 +8,13 @@ import os
 
 import biothings.hub.dataload.storage as storage
 import pymongo
+from biothings import config
 from biothings.utils.common import unzipall
 from biothings.utils.exclude_ids import ExcludeFieldsById
 
 from hub.dataload.uploader import BaseDrugUploader
 from hub.datatransform.keylookup import MyChemKeyLookup
+from shared.interactions import InteractionsWriter
 
 from .drugbank_full_mapping import drugbank_full_mapping
 from .drugbank_full_parser import load_data
@@ -66,7 +68,28 @@ class DrugBankFullUploader(BaseDrugUploader):
         input_file = xmlfiles.pop()
         if not os.path.exists(input_file):
             raise FileNotFoundError("Can't find input file '%s'" % input_file)
-        return self.exclude_fields(self.keylookup(load_data, debug=True))(input_file)
+        return self.exclude_fields(self.write_interactions(self.keylookup(load_data, debug=True, report=self.keylookup_report())))(input_file)
+
+    def write_interactions(self, load):
+        """
+        Wrap load to write the drug interactions of the documents, before
+        exclude_fields drops those of the largest, to
+        "drugbank_full.interactions" in INTERACTIONS_FOLDER when it is set,
+        which /interactions answers from.
+        """
+        folder = getattr(config, "INTERACTIONS_FOLDER", None)
+        if not folder:
+            return load
+        path = os.path.join(folder, f"{self.name}.interactions")
+
+        def wrapped(*args):
+            with InteractionsWriter(path) as writer:
+                for doc in load(*args):
+                    writer.add_doc(doc)
+                    yield doc
+            self.logger.info("Wrote %s interactions of %s drugs to %s", writer.interactions, writer.drugs, path)
+
+        return wrapped
 
     def post_update_data(self, *args, **kwargs):
         # pylint: disable=W0613
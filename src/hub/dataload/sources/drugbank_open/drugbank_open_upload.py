@@ -68,7 +68,7 @@ class DrugBankOpenUploader(BaseDrugUploader):
         input_file = csvfiles.pop()
         if not os.path.exists(input_file):
             raise FileNotFoundError("Can't find input file '%s'" % input_file)
-        return self.exclude_fields(self.keylookup(load_data, debug=True))(input_file)
+        return self.exclude_fields(self.keylookup(load_data, debug=True, report=self.keylookup_report()))(input_file)
 
     def post_update_data(self, *args, **kwargs):
         """create indexes following upload"""
@@ -38,7 +38,7 @@ class DrugCentralUploader(BaseDrugUploader):
     )
 
     def load_data(self, data_folder):
-        return self.keylookup(load_data)(data_folder)
+        return self.keylookup(load_data, report=self.keylookup_report())(data_folder)
 
     def post_update_data(self, *args, **kwargs):
         """Create indexes used when DrugCentral supplies keylookup mappings."""
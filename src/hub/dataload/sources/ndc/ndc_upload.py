@@ -35,7 +35,7 @@ class NDCUploader(BaseDrugUploader):
 
     def load_data(self, data_folder):
         """load data from the data source"""
-        return self.exclude_fields(self.keylookup(load_data))(data_folder)
+        return self.exclude_fields(self.keylookup(load_data, report=self.keylookup_report()))(data_folder)
 
     @classmethod
     def get_mapping(cls):
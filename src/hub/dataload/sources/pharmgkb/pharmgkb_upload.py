@@ -44,7 +44,7 @@ class PharmGkbUploader(BaseDrugUploader):
         input_file = os.path.join(data_folder, "drugs.tsv")
         assert os.path.exists(
             input_file), "Can't find input file '%s'" % input_file
-        return self.keylookup(load_data)(input_file)
+        return self.keylookup(load_data, report=self.keylookup_report())(input_file)
 
     def post_update_data(self, *args, **kwargs):
         field = "pharmgkb.id"
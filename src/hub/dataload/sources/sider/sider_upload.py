@@ -81,7 +81,7 @@ class SiderUploader(BaseDrugUploader):
         """load_data method"""
         input_file = os.path.join(data_folder, "merged_freq_all_se_indications.tsv")
         self.logger.info("Load data from file '%s'" % input_file)
-        docs = self.keylookup(load_data)(input_file)
+        docs = self.keylookup(load_data, report=self.keylookup_report())(input_file)
         for doc in docs:
             # sort the 'sider' list by "sider.side_effect.frequency" and "sider.side_effect.name"
             # pylint: disable=W0108
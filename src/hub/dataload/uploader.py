@@ -1,6 +1,19 @@
+import os
 
 import biothings.hub.dataload.uploader as uploader
 
 class BaseDrugUploader(uploader.BaseSourceUploader):
 
     keep_archive = 1
+
+    def keylookup_report(self, job=None):
+        """
+        Return the path of the key lookup report of load_data, next to the
+        upload log, one per job of a parallelized upload, or None without log.
+        """
+        if not self.logfile:
+            return None
+        path = os.path.splitext(self.logfile)[0]
+        if job:
+            path += "_" + job
+        return path + "_keylookup.json"
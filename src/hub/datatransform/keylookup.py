@@ -1,29 +1,348 @@
+import os
 import re
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from functools import wraps
 
 import networkx as nx
+from biothings import config
 from biothings.hub.datatransform import (
     CIMongoDBEdge,
     DataTransformEdge,
     DataTransformMDB,
+    IDStruct,
     MongoDBEdge,
+    nested_lookup,
 )
+from biothings.utils import hub_db, mongo
+
+from hub.datatransform.keylookup_cache import KeyLookupCache
+from hub.datatransform.keylookup_report import KeyLookupReport
+
+
+_pools = {}
+
+
+def edge_group_pool():
+    """
+    Return the thread pool of KEYLOOKUP_EDGE_GROUP_THREADS running the
+    edges of the MongoDBEdgeGroups of this process, or None below 2.
+    """
+    threads = getattr(config, "KEYLOOKUP_EDGE_GROUP_THREADS", 0) or 0
+    if threads < 2:
+        return None
+    key = (threads, os.getpid())
+    if key not in _pools:
+        _pools[key] = ThreadPoolExecutor(threads, thread_name_prefix="keylookup")
+    return _pools[key]
 
 
 class MongoDBEdgeGroup(DataTransformEdge):
-    """Run parallel MongoDB mappings represented by one edge in a DiGraph."""
+    """
+    Run parallel MongoDB mappings represented by one edge in a DiGraph.
+
+    The edges are looked up concurrently on the edge_group_pool, with
+    collections of one MongoDB client, and their results merged in their
+    order, as when they run one after another, without the pool. The
+    times of the group and of each of its edges are summed in the
+    KeyLookupReport of the upload.
+    """
 
     def __init__(self, edges, weight=1, label=None):
         super().__init__(label=label)
         self.edges = tuple(edges)
         self.weight = weight
 
+    def prepare_collections(self):
+        db = None
+        for edge in self.edges:
+            if isinstance(edge, MongoDBEdge) and edge._state["collection"] is None:
+                db = db if db is not None else mongo.get_src_db()
+                edge._state["collection"] = db[edge.collection_name]
+
+    def member_lookup(self, edge, keylookup_obj, id_strct, debug):
+        start = time.time()
+        result = edge.edge_lookup(keylookup_obj, id_strct, debug)
+        report = getattr(keylookup_obj, "report", None)
+        if report is not None:
+            name = "%s [%s]" % (keylookup_obj.edge_name(self), edge.label)
+            report.add_edge(name, len(id_strct), len(result), time.time() - start)
+        return result
+
     def edge_lookup(self, keylookup_obj, id_strct, debug=False):
+        if not len(id_strct):
+            return keylookup_obj.idstruct_class()
+        pool = edge_group_pool()
+        if pool:
+            self.prepare_collections()
+            futures = [
+                pool.submit(self.member_lookup, edge, keylookup_obj, id_strct, debug)
+                for edge in self.edges
+            ]
+            results = [future.result() for future in futures]
+        else:
+            results = [
+                self.member_lookup(edge, keylookup_obj, id_strct, debug)
+                for edge in self.edges
+            ]
         result = keylookup_obj.idstruct_class()
-        for edge in self.edges:
-            result += edge.edge_lookup(keylookup_obj, id_strct, debug)
+        for edge_result in results:
+            result += edge_result
         return result
 
 
+def collection_version(collection_name):
+    """
+    Return the version of the last successful upload of a collection,
+    from src_dump, or None if it is being uploaded or was never uploaded.
+    """
+    for src in hub_db.get_src_dump().find():
+        job = ((src.get("upload") or {}).get("jobs") or {}).get(collection_name)
+        if job:
+            if job.get("status") != "success":
+                return None
+            return "%s|%s" % (job.get("release"), job.get("started_at"))
+    return None
+
+
+_caches = {}
+
+
+def keylookup_cache():
+    """
+    Return the KeyLookupCache of KEYLOOKUP_CACHE for this process and
+    thread, or None.
+    """
+    path = getattr(config, "KEYLOOKUP_CACHE", None)
+    if not path:
+        return None
+    # a SQLite connection cannot be shared with forked processes or threads
+    key = (path, os.getpid(), threading.get_ident())
+    if key not in _caches:
+        _caches[key] = KeyLookupCache(path)
+    return _caches[key]
+
+
+class PreloadBudget:
+    """
+    The bytes of KEYLOOKUP_PRELOAD_MAX_BYTES held by the preloaded maps
+    of all the edges of a process, reserved as the maps are read, and
+    the collection versions whose maps were found not to fit, so that
+    they are not read again while no more bytes are available.
+    """
+
+    def __init__(self):
+        self.used = 0
+        self.too_large = {}  # {(edge key, version): bytes they needed at least}
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def max_bytes():
+        return getattr(config, "KEYLOOKUP_PRELOAD_MAX_BYTES", 0) or 0
+
+    def available(self):
+        return max(self.max_bytes() - self.used, 0)
+
+    def fits(self, key):
+        with self._lock:
+            return self.too_large.get(key, 0) <= self.available()
+
+    def reserve(self, size):
+        with self._lock:
+            if size > self.available():
+                return False
+            self.used += size
+            return True
+
+    def release(self, size):
+        with self._lock:
+            self.used = max(self.used - size, 0)
+
+    def too_large_for(self, key, size):
+        with self._lock:
+            self.too_large[key] = size
+
+
+preload_budget = PreloadBudget()
+
+
+class PreloadedMongoDBEdge(MongoDBEdge):
+    """
+    MongoDBEdge answering the lookups of an upload from a map of the
+    lookup values to the field values of the whole collection, read at
+    once by its first lookup, instead of one query per batch of ids.
+
+    The maps of all the edges of a process are kept within the
+    KEYLOOKUP_PRELOAD_MAX_BYTES of the preload_budget, estimated. An edge
+    whose map does not fit, or when it is 0 or the collection cannot be
+    read, queries MongoDB like a MongoDBEdge, and its map is not read
+    again for this version of the collection until more bytes are
+    available. MyChemKeyLookup drops the maps when an upload ends.
+
+    With KEYLOOKUP_CACHE, the values found are also kept in that SQLite
+    file across uploads and builds, for the version of the collection
+    they were read from, so that only the ids never looked up since the
+    collection was last uploaded are looked up, and the map is not read
+    at all when there are none.
+    """
+
+    # the memory of a dict entry and of its list, besides the values
+    ENTRY_BYTES = 150
+    # the bytes reserved from the preload_budget ahead of the map
+    RESERVE_BYTES = 1024 * 1024
+
+    def init_state(self):
+        super().init_state()
+        self._state["table"] = None  # until loaded, then the map, or False
+        self._state["version"] = None  # until read, then the version, or False
+        self._state["reserved"] = 0  # bytes of the preload_budget
+
+    def __getstate__(self):
+        # the map is loaded again by each process
+        state = self.__dict__.copy()
+        state["_state"] = dict(self._state, table=None, version=None, reserved=0)
+        return state
+
+    def reset(self):
+        self._state["table"] = None
+        self._state["version"] = None
+        preload_budget.release(self._state["reserved"])
+        self._state["reserved"] = 0
+
+    @property
+    def cache_key(self):
+        return "%s:%s:%s" % (self.collection_name, self.lookup, self.field)
+
+    def version(self):
+        if self._state["version"] is None:
+            try:
+                version = collection_version(self.collection_name)
+            except Exception as exc:  # pylint: disable=W0703
+                self.logger.warning(
+                    "Cannot read the version of %s: %s", self.collection_name, exc
+                )
+                version = None
+            self._state["version"] = version or False
+        return self._state["version"]
+
+    def table(self):
+        if self._state["table"] is None:
+            key = (self.cache_key, self.version())
+            table = None
+            if preload_budget.max_bytes() and preload_budget.fits(key):
+                try:
+                    table = self.load_table()
+                except Exception as exc:  # pylint: disable=W0703
+                    self.logger.warning(
+                        "Cannot preload %s -> %s: %s", self.lookup, self.field, exc
+                    )
+                if table is None:
+                    # not even kept until the end of the upload
+                    preload_budget.release(self._state["reserved"])
+                    self._state["reserved"] = 0
+            self._state["table"] = table if table is not None else False
+        return self._state["table"]
+
+    def reserve(self, size):
+        """Reserve bytes of the preload_budget for a map of size bytes."""
+        missing = size - self._state["reserved"]
+        if missing <= 0:
+            return True
+        # ahead when possible, not to take the lock for every document
+        for amount in (missing + self.RESERVE_BYTES, missing):
+            if preload_budget.reserve(amount):
+                self._state["reserved"] += amount
+                return True
+        return False
+
+    def doc_values(self, doc):
+        """Yield the (lookup value, field value) pairs of a document."""
+        value = nested_lookup(doc, self.field)
+        if not value:
+            return
+        keys = nested_lookup(doc, self.lookup)
+        for key in keys if isinstance(keys, list) else [keys]:
+            if key and isinstance(key, (str, int, float)):
+                yield key, value
+
+    def load_table(self):
+        """
+        Return the map of the lookup values to the lists of field values,
+        None if it does not fit in the preload_budget.
+        """
+        table = {}
+        size = 0
+        docs = self.collection.find(
+            {self.lookup: {"$exists": True}}, {self.lookup: 1, self.field: 1}
+        )
+        for doc in docs:
+            for key, value in self.doc_values(doc):
+                if key not in table:
+                    table[key] = []
+                    size += sys.getsizeof(key) + self.ENTRY_BYTES
+                table[key].append(value)
+                size += sys.getsizeof(value) + 8
+            if not self.reserve(size):
+                self.logger.info(
+                    "Not preloading %s -> %s of %s, %s bytes already read, "
+                    "above the preload budget of the process",
+                    self.lookup, self.field, self.collection_name, size,
+                )
+                preload_budget.too_large_for((self.cache_key, self.version()), size)
+                return None
+        # the bytes reserved ahead and not needed
+        preload_budget.release(self._state["reserved"] - size)
+        self._state["reserved"] = size
+        self.logger.info(
+            "Preloaded %s %s -> %s of %s, about %s bytes",
+            len(table), self.lookup, self.field, self.collection_name, size,
+        )
+        return table
+
+    def find_values(self, id_lst):
+        """Return the map of the ids found to their lists of field values."""
+        table = self.table()
+        if table is not False:
+            return {_id: table[_id] for _id in id_lst if _id in table}
+        found = {}
+        wanted = set(id_lst)
+        for doc in self.collection_find(id_lst, self.lookup, self.field):
+            for key, value in self.doc_values(doc):
+                if key in wanted:
+                    found.setdefault(key, []).append(value)
+        return found
+
+    def edge_lookup(self, keylookup_obj, id_strct, debug=False):
+        res_id_strct = IDStruct()
+        if debug:
+            res_id_strct.import_debug(id_strct)
+        id_lst = [_id for _id in id_strct.id_lst if isinstance(_id, (str, int, float))]
+        cache = keylookup_cache()
+        version = self.version() if cache else False
+        found = cache.get_many(self.cache_key, version, id_lst) if version else {}
+        missing = [_id for _id in id_lst if _id not in found]
+        if missing:
+            values = self.find_values(missing)
+            if version:
+                # the ids found nowhere too, not to look them up again
+                cache.put_many(
+                    self.cache_key,
+                    version,
+                    {_id: values.get(_id, []) for _id in missing},
+                )
+            found.update(values)
+        # the same pairs as MongoDBEdge, from the documents holding each id
+        for current_id in id_lst:
+            for value in found.get(current_id, ()):
+                for orig_id in id_strct.find_right(current_id):
+                    res_id_strct.add(orig_id, value)
+                    if debug:
+                        res_id_strct.set_debug(orig_id, self.label, value)
+        return res_id_strct
+
+
 class RegExFilterEdge(DataTransformEdge):
     """Retain only identifiers that fully match a regular expression."""
 
@@ -72,14 +391,14 @@ graph_mychem.add_edge(
 graph_mychem.add_edge(
     "inchi",
     "chembl",
-    object=MongoDBEdge("chembl", "chembl.inchi", "chembl.molecule_chembl_id"),
+    object=PreloadedMongoDBEdge("chembl", "chembl.inchi", "chembl.molecule_chembl_id"),
     weight=1.0,
 )
 
 graph_mychem.add_edge(
     "inchi",
     "drugbank",
-    object=MongoDBEdge("drugbank_full", "drugbank.inchi", "drugbank.id"),
+    object=PreloadedMongoDBEdge("drugbank_full", "drugbank.inchi", "drugbank.id"),
     # TODO
     #   object=MongoDBEdge(
     #       'drugbank_full', 'drugbank.inchi', 'drugbank.id'),
@@ -89,14 +408,16 @@ graph_mychem.add_edge(
 graph_mychem.add_edge(
     "inchi",
     "pubchem",
-    object=MongoDBEdge("pubchem", "pubchem.inchi", "pubchem.cid"),
+    object=PreloadedMongoDBEdge("pubchem", "pubchem.inchi", "pubchem.cid"),
     weight=1.2,
 )
 
 graph_mychem.add_edge(
     "chembl",
     "inchikey",
-    object=MongoDBEdge("chembl", "chembl.molecule_chembl_id", "chembl.inchi_key"),
+    object=PreloadedMongoDBEdge(
+        "chembl", "chembl.molecule_chembl_id", "chembl.inchi_key"
+    ),
     weight=1.0,
 )
 
@@ -104,21 +425,21 @@ graph_mychem.add_edge(
     "drugbank",
     "inchikey",
     #   TODO drugbank_open
-    object=MongoDBEdge("drugbank", "drugbank.id", "drugbank.inchi_key"),
+    object=PreloadedMongoDBEdge("drugbank", "drugbank.id", "drugbank.inchi_key"),
     weight=1.1,
 )
 
 graph_mychem.add_edge(
     "pubchem",
     "inchikey",
-    object=MongoDBEdge("pubchem", "pubchem.cid", "pubchem.inchikey"),
+    object=PreloadedMongoDBEdge("pubchem", "pubchem.cid", "pubchem.inchikey"),
     weight=1.2,
 )
 
 graph_mychem.add_edge(
     "pharmgkb",
     "drugbank",
-    object=MongoDBEdge("pharmgkb", "pharmgkb.id", "pharmgkb.xrefs.drugbank"),
+    object=PreloadedMongoDBEdge("pharmgkb", "pharmgkb.id", "pharmgkb.xrefs.drugbank"),
 )
 
 # self-loops to check looked-up values exist in official collection
@@ -126,7 +447,7 @@ graph_mychem.add_edge(
 graph_mychem.add_edge(
     "drugbank",
     "drugbank",
-    object=MongoDBEdge("drugbank", "drugbank.id", "drugbank.id"),
+    object=PreloadedMongoDBEdge("drugbank", "drugbank.id", "drugbank.id"),
 )
 
 ###############################################################################
@@ -139,7 +460,7 @@ graph_mychem.add_edge(
     "ndc",
     "inchikey",
     #   TODO drugbank_full
-    object=MongoDBEdge(
+    object=PreloadedMongoDBEdge(
         "drugbank_full", "drugbank.products.ndc_product_code", "drugbank.inchi_key"
     ),
 )
@@ -152,19 +473,19 @@ graph_mychem.add_edge(
 graph_mychem.add_edge(
     "chebi",
     "inchikey",
-    object=MongoDBEdge("chebi", "chebi.id", "chebi.inchikey"),
+    object=PreloadedMongoDBEdge("chebi", "chebi.id", "chebi.inchikey"),
     weight=1.1,
 )
 graph_mychem.add_edge(
     "chebi",
     "drugbank",
-    object=MongoDBEdge("drugbank", "drugbank.xrefs.chebi", "drugbank.id"),
+    object=PreloadedMongoDBEdge("drugbank", "drugbank.xrefs.chebi", "drugbank.id"),
     weight=1.0,
 )
 graph_mychem.add_edge(
     "chebi",
     "chembl",
-    object=MongoDBEdge(
+    object=PreloadedMongoDBEdge(
         "chembl", "chembl.chebi_par_id", "chembl.molecule_chembl_id"
     ),
     weight=1.0,
@@ -185,10 +506,12 @@ graph_mychem.add_edge(
 # Unii Edges
 ###############################################################################
 graph_mychem.add_edge(
-    "unii", "inchikey", object=MongoDBEdge("unii", "unii.unii", "unii.inchikey")
+    "unii",
+    "inchikey",
+    object=PreloadedMongoDBEdge("unii", "unii.unii", "unii.inchikey"),
 )
 graph_mychem.add_edge(
-    "unii", "pubchem", object=MongoDBEdge("unii", "unii.unii", "unii.pubchem")
+    "unii", "pubchem", object=PreloadedMongoDBEdge("unii", "unii.unii", "unii.pubchem")
 )
 
 ###############################################################################
@@ -213,19 +536,19 @@ graph_mychem.add_edge(
     "inchikey",
     object=MongoDBEdgeGroup(
         [
-            MongoDBEdge(
+            PreloadedMongoDBEdge(
                 "chebi", "chebi.smiles", "chebi.inchikey", label="chebi.smiles"
             ),
-            MongoDBEdge(
+            PreloadedMongoDBEdge(
                 "chembl", "chembl.smiles", "chembl.inchi_key", label="chembl.smiles"
             ),
-            MongoDBEdge(
+            PreloadedMongoDBEdge(
                 "drugcentral",
                 "drugcentral.structures.smiles",
                 "drugcentral.structures.inchikey",
                 label="drugcentral.structures.smiles",
             ),
-            MongoDBEdge(
+            PreloadedMongoDBEdge(
                 "unii", "unii.smiles", "unii.inchikey", label="unii.smiles"
             ),
         ],
@@ -234,6 +557,23 @@ graph_mychem.add_edge(
 )
 
 
+# {(graph fingerprint, input type, output type): paths, cheapest first}
+_path_plans = {}
+
+
+def graph_fingerprint(graph):
+    """Return the nodes and weighted edges of a graph, its paths depend on."""
+    return (
+        tuple(sorted(graph.nodes())),
+        tuple(
+            sorted(
+                (vert1, vert2, edge.weight)
+                for vert1, vert2, edge in graph.edges(data="object")
+            )
+        ),
+    )
+
+
 class MyChemKeyLookup(DataTransformMDB):
     def __init__(self, input_types, *args, **kwargs):
         super(MyChemKeyLookup, self).__init__(
@@ -266,3 +606,151 @@ class MyChemKeyLookup(DataTransformMDB):
             *args,
             **kwargs
         )
+        self.report = None  # while a wrapped function loads documents
+        self._edge_names = {}
+
+    def _precompute_paths(self):
+        # planned once per process for every input and output type, shared
+        # by all the instances and never modified
+        fingerprint = graph_fingerprint(self.graph)
+        keys = {
+            (input_type[0], output_type): (fingerprint, input_type[0], output_type)
+            for output_type in self.output_types
+            for input_type in self.input_types
+        }
+        if not all(key in _path_plans for key in keys.values()):
+            super()._precompute_paths()
+            for pair, key in keys.items():
+                _path_plans.setdefault(key, self.paths[pair])
+        self.paths = {pair: _path_plans[key] for pair, key in keys.items()}
+
+    def preloaded_edges(self):
+        for _, _, edge in self.graph.edges(data="object"):
+            for edge in getattr(edge, "edges", (edge,)):
+                if isinstance(edge, PreloadedMongoDBEdge):
+                    yield edge
+
+    def edge_name(self, edge_obj):
+        return self._edge_names.get(id(edge_obj)) or edge_obj.label
+
+    def _edge_lookup(self, edge_obj, id_strct):
+        if self.report is None or not len(id_strct):
+            return super()._edge_lookup(edge_obj, id_strct)
+        start = time.time()
+        result = super()._edge_lookup(edge_obj, id_strct)
+        self.report.add_edge(
+            self.edge_name(edge_obj), len(id_strct), len(result), time.time() - start
+        )
+        return result
+
+    def _reported_lookup(self, lookup, input_type, output_type, doc_lst):
+        start = time.time()
+        hit_lst, miss_lst = lookup(input_type, output_type, doc_lst)
+        if self.report is not None and doc_lst:
+            self.report.add_lookup(
+                input_type,
+                output_type,
+                len(doc_lst),
+                len(doc_lst) - len(miss_lst),
+                len(hit_lst),
+                time.time() - start,
+            )
+        return hit_lst, miss_lst
+
+    def travel(self, input_type, target, doc_lst):
+        return self._reported_lookup(super().travel, input_type, target, doc_lst)
+
+    def _copy(self, input_type, output_type, doc_lst):
+        return self._reported_lookup(super()._copy, input_type, output_type, doc_lst)
+
+    def key_lookup_batch(self, batchiter):
+        if self.report is None:
+            yield from super().key_lookup_batch(batchiter)
+            return
+        doc_lst = list(batchiter)
+        # the documents found are copies, or have a new _id when copied from
+        # the document, the others are yielded as they are
+        original_ids = {id(doc): doc["_id"] for doc in doc_lst}
+        for doc in doc_lst:
+            self.report.add_doc("in")
+        for doc in super().key_lookup_batch(doc_lst):
+            if original_ids.get(id(doc)) != doc["_id"]:
+                self.report.add_doc("found")
+            elif self.skip_w_regex and self.skip_w_regex.match(doc["_id"]):
+                self.report.add_doc("skipped")
+            else:
+                self.report.add_doc("fallback", doc["_id"])
+            yield doc
+
+    def __call__(self, func, debug=None, report=None):
+        """
+        Wrap func like a DataTransformMDB, and write the KeyLookupReport of
+        the documents it loads to the path report once they are all loaded.
+        """
+        lookup = super().__call__(func, debug)
+
+        @wraps(func)
+        def wrapped_f(*args):
+            # the collections may have been uploaded again since the last upload
+            for edge in self.preloaded_edges():
+                edge.reset()
+            if report:
+                self.report = KeyLookupReport()
+                self._edge_names = {
+                    id(edge): "%s -> %s" % (vert1, vert2)
+                    for vert1, vert2, edge in self.graph.edges(data="object")
+                }
+            try:
+                yield from lookup(*args)
+            finally:
+                for edge in self.preloaded_edges():
+                    edge.reset()
+                if self.report is not None:
+                    self.write_report(report)
+
+        return wrapped_f
+
+    def write_report(self, path):
+        try:
+            self.report.write(path)
+            self.logger.info("Key lookup report written to %s", path)
+        except OSError as exc:
+            self.logger.warning("Cannot write the key lookup report %s: %s", path, exc)
+        finally:
+            self.report = None
+
+
+def plan_paths():
+    """Plan the paths from every type of graph_mychem, once, at hub startup."""
+    return MyChemKeyLookup(list(graph_mychem.nodes())).paths
+
+
+def describe_paths(input_type=None, output_type=None):
+    """
+    Return the planned paths of graph_mychem from input_type to
+    output_type, all by default, in the order they are tried, with the
+    label, or else the lookup field, and the weight of every edge and
+    the weight of the path. The types without a path are left out.
+    """
+    keylookup = MyChemKeyLookup(list(graph_mychem.nodes()))
+    lines = []
+    for (start, target), paths in keylookup.paths.items():
+        if not paths or input_type not in (None, start):
+            continue
+        if output_type not in (None, target):
+            continue
+        lines.append("%s -> %s" % (start, target))
+        for path in paths:
+            hops = [path[0]]
+            for vert1, vert2 in zip(path, path[1:]):
+                edge = keylookup.graph.edges[vert1, vert2]["object"]
+                name = edge.label or getattr(edge, "lookup", type(edge).__name__)
+                hops.append("-[%s %s]-> %s" % (name, edge.weight, vert2))
+            weight = keylookup._compute_path_weight(path)
+            lines.append("    %s  (weight %s)" % (" ".join(hops), weight))
+    return "\n".join(lines)
+
+
+def print_paths(input_type=None, output_type=None):
+    """Print the planned paths of graph_mychem, see describe_paths."""
+    print(describe_paths(input_type, output_type))
@@ -0,0 +1,72 @@
+import json
+import sqlite3
+
+
+class KeyLookupCache:
+    """
+    A SQLite file of the values key lookup edges found for ids, kept
+    across uploads. Every edge is tagged with a version, that of the
+    collection it reads: the values found for another version are
+    ignored, and deleted the first time the edge is used with the new
+    one, so that the cache is invalidated when the collection is
+    uploaded again, and only then.
+
+    The ids and values are stored as JSON, an id found nowhere with an
+    empty list, so that it is not looked up again either.
+    """
+
+    def __init__(self, path, timeout=60):
+        self.path = path
+        # the uploads of the hub processes share the file
+        self._connection = sqlite3.connect(path, timeout=timeout, isolation_level=None)
+        self._connection.execute("PRAGMA journal_mode=WAL")
+        self._connection.execute(
+            "CREATE TABLE IF NOT EXISTS lookups ("
+            "edge TEXT NOT NULL, version TEXT NOT NULL, id TEXT NOT NULL, "
+            "value_list TEXT NOT NULL, PRIMARY KEY (edge, id))"
+        )
+        self._purged = set()  # of (edge, version)
+        self.hits = self.misses = 0
+
+    def _purge(self, edge, version):
+        if (edge, version) not in self._purged:
+            self._connection.execute(
+                "DELETE FROM lookups WHERE edge = ? AND version != ?", (edge, version)
+            )
+            self._purged.add((edge, version))
+
+    def get_many(self, edge, version, ids):
+        """Return {id: [value, ...]} of the ids cached for this version of the edge."""
+        self._purge(edge, version)
+        keys = {json.dumps(_id): _id for _id in ids}
+        found = {}
+        key_list = list(keys)
+        # below the default limit of 999 SQLite variables
+        for start in range(0, len(key_list), 900):
+            chunk = key_list[start : start + 900]
+            rows = self._connection.execute(
+                "SELECT id, value_list FROM lookups WHERE edge = ? AND version = ? "
+                f"AND id IN ({','.join('?' * len(chunk))})",
+                (edge, version, *chunk),
+            )
+            for key, value_list in rows:
+                found[keys[key]] = json.loads(value_list)
+        self.hits += len(found)
+        self.misses += len(keys) - len(found)
+        return found
+
+    def put_many(self, edge, version, values):
+        """Cache the {id: [value, ...]} found for this version of the edge."""
+        with self._connection:
+            self._connection.execute("BEGIN")
+            self._connection.executemany(
+                "INSERT OR REPLACE INTO lookups (edge, version, id, value_list) "
+                "VALUES (?, ?, ?, ?)",
+                (
+                    (edge, version, json.dumps(_id), json.dumps(value_list))
+                    for _id, value_list in values.items()
+                ),
+            )
+
+    def close(self):
+        self._connection.close()
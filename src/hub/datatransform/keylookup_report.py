@@ -0,0 +1,128 @@
+import json
+import os
+import re
+import threading
+import time
+
+# the upper bounds, in seconds, of the buckets of the timing histograms
+BUCKETS = (0.001, 0.01, 0.1, 1, 10, 60)
+ID_PREFIX = re.compile(r"[A-Za-z_]*")
+
+
+class Timings:
+    """The number, total and histogram of the durations of one step."""
+
+    def __init__(self):
+        self.calls = 0
+        self.seconds = 0.0
+        self.histogram = [0] * (len(BUCKETS) + 1)
+
+    def add(self, seconds):
+        self.calls += 1
+        self.seconds += seconds
+        for index, bound in enumerate(BUCKETS):
+            if seconds <= bound:
+                break
+        else:
+            index = len(BUCKETS)
+        self.histogram[index] += 1
+
+    def as_dict(self):
+        labels = ["<=%ss" % bound for bound in BUCKETS] + [">%ss" % BUCKETS[-1]]
+        return {
+            "calls": self.calls,
+            "seconds": round(self.seconds, 6),
+            "histogram": dict(zip(labels, self.histogram)),
+        }
+
+
+class KeyLookupReport:
+    """
+    The counters and timings of the key lookups of one load_data: for
+    every edge followed, the ids looked up and found, for every input
+    type and output type tried, the documents looked up and found, and
+    the documents kept with their original _id, by _id prefix.
+
+    The edges of a MongoDBEdgeGroup are looked up concurrently, so the
+    report can be added to from several threads.
+    """
+
+    def __init__(self):
+        self.started_at = time.time()
+        self.edges = {}  # {name: [ids in, ids found, Timings]}
+        # {"input field -> output type": [docs in, docs found, ids, Timings]}
+        self.lookups = {}
+        self.docs = {"in": 0, "found": 0, "skipped": 0, "fallback": 0}
+        self.fallbacks = {}  # {_id prefix: number of documents}
+        self._lock = threading.Lock()
+
+    def add_edge(self, name, ids_in, ids_found, seconds):
+        with self._lock:
+            stats = self.edges.setdefault(name, [0, 0, Timings()])
+            stats[0] += ids_in
+            stats[1] += ids_found
+            stats[2].add(seconds)
+
+    def add_lookup(self, input_type, output_type, docs_in, docs_found, ids, seconds):
+        name = "%s -> %s" % (input_type[1], output_type)
+        with self._lock:
+            stats = self.lookups.setdefault(name, [0, 0, 0, Timings()])
+            stats[0] += docs_in
+            stats[1] += docs_found
+            stats[2] += ids
+            stats[3].add(seconds)
+
+    def add_doc(self, status, _id=None):
+        """
+        Count a document looked up, "in", or one output, "found" with a new
+        _id, "skipped" or "fallback" with its original _id.
+        """
+        with self._lock:
+            self.docs[status] += 1
+            if status == "fallback":
+                prefix = ID_PREFIX.match(str(_id)).group() or "-"
+                self.fallbacks[prefix] = self.fallbacks.get(prefix, 0) + 1
+
+    @staticmethod
+    def _rate(found, total):
+        return round(found / total, 4) if total else None
+
+    def as_dict(self):
+        with self._lock:
+            return {
+                "started_at": self.started_at,
+                "seconds": round(time.time() - self.started_at, 6),
+                "docs": dict(self.docs),
+                "fallbacks": dict(sorted(self.fallbacks.items())),
+                "lookups": {
+                    name: {
+                        "docs": docs_in,
+                        "found": docs_found,
+                        "hit_rate": self._rate(docs_found, docs_in),
+                        "ids": ids,
+                        **timings.as_dict(),
+                    }
+                    for name, (
+                        docs_in,
+                        docs_found,
+                        ids,
+                        timings,
+                    ) in self.lookups.items()
+                },
+                "edges": {
+                    name: {
+                        "ids": ids_in,
+                        "found": ids_found,
+                        "hit_rate": self._rate(ids_found, ids_in),
+                        **timings.as_dict(),
+                    }
+                    for name, (ids_in, ids_found, timings) in sorted(self.edges.items())
+                },
+            }
+
+    def write(self, path):
+        """Write the report as JSON, replacing any previous one."""
+        temp_path = path + ".tmp"
+        with open(temp_path, "w") as file:
+            json.dump(self.as_dict(), file, indent=2)
+        os.replace(temp_path, path)
@@ -0,0 +1,183 @@
+import heapq
+import itertools
+import mmap
+import os
+import struct
+import sys
+import tempfile
+from array import array
+
+# the file starts with MAGIC, the number of keys and the position of the
+# offsets, followed by the records, sorted by key, and their offsets.
+# A record is the key and the _ids it maps to, separated by tabs.
+# The numbers are little-endian unsigned 64 bits integers.
+MAGIC = b"MCXWALK1"
+HEADER = struct.Struct("<8sQQ")
+RECORD_BOUNDS = struct.Struct("<QQ")
+
+# the fields the hub writes the crosswalk of, whose ids /normalize maps:
+# those of the annotation ids of config_web, and pharmgkb.id
+CROSSWALK_FIELDS = [
+    "_id",
+    "chebi.id",
+    "chebi.secondary_chebi_id",
+    "chebi.xrefs.drugbank",
+    "chembl.molecule_chembl_id",
+    "drugbank.id",
+    "drugcentral.xrefs.drugbank_id",
+    "pharmgkb.id",
+    "pharmgkb.xrefs.drugbank",
+    "pubchem.cid",
+    "unichem.drugbank",
+    "unii.unii",
+]
+
+
+def crosswalk_key(field, value):
+    """The key of a field value, case-insensitive like the keyword fields."""
+    return f"{field}:{value}".lower()
+
+
+def field_values(doc, field):
+    """The values of a dotted field of a document, through the lists."""
+    values = [doc]
+    for key in field.split("."):
+        found = []
+        for value in values:
+            value = value.get(key) if isinstance(value, dict) else None
+            if isinstance(value, list):
+                found.extend(value)
+            elif value is not None:
+                found.append(value)
+        values = found
+    return [value for value in values if not isinstance(value, (dict, list))]
+
+
+def doc_keys(doc, fields):
+    """The crosswalk keys of the values of the fields of a document."""
+    keys = set()
+    for field in fields:
+        if field == "_id":
+            keys.add(crosswalk_key(field, doc["_id"]))
+            continue
+        for value in field_values(doc, field):
+            key = crosswalk_key(field, value)
+            if "\t" not in key and "\n" not in key:
+                keys.add(key)
+    return keys
+
+
+class CrosswalkWriter:
+    """
+    Write the crosswalk of the documents added in any order. The keys
+    are sorted chunk_size at a time in temporary files, merged when the
+    writer is closed, so that memory does not grow with the index.
+    """
+
+    def __init__(self, path, fields, chunk_size=1000000):
+        self.path = path
+        self.fields = fields
+        self.chunk_size = chunk_size
+        self.keys = None  # once closed
+        self._pairs = []
+        self._chunks = []
+        self._folder = tempfile.TemporaryDirectory(dir=os.path.dirname(os.path.abspath(path)))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, *exc_info):
+        if exc_type is None:
+            self.close()
+        else:
+            self._folder.cleanup()
+
+    def add_doc(self, doc):
+        for key in doc_keys(doc, self.fields):
+            self._pairs.append((key, doc["_id"]))
+        if len(self._pairs) >= self.chunk_size:
+            self._spill()
+
+    def _spill(self):
+        self._pairs.sort()
+        chunk = os.path.join(self._folder.name, f"{len(self._chunks)}.tsv")
+        with open(chunk, "w", encoding="utf-8") as file:
+            file.writelines(f"{key}\t{_id}\n" for key, _id in self._pairs)
+        self._chunks.append(chunk)
+        self._pairs = []
+
+    def _merged(self, files):
+        for line in heapq.merge(*files):
+            yield line.rstrip("\n").split("\t", 1)
+
+    def close(self):
+        """Write the crosswalk file, replacing any previous one, return its number of keys."""
+        self._spill()
+        files = [open(chunk, encoding="utf-8") for chunk in self._chunks]
+        offsets = array("Q", [0])
+        temp_path = self.path + ".tmp"
+        try:
+            with open(temp_path, "wb") as output:
+                output.write(HEADER.pack(MAGIC, 0, 0))
+                for key, pairs in itertools.groupby(self._merged(files), key=lambda pair: pair[0]):
+                    ids = dict.fromkeys(_id for _, _id in pairs)
+                    record = "\t".join((key, *ids)).encode("utf-8")
+                    output.write(record)
+                    offsets.append(offsets[-1] + len(record))
+                offsets_position = output.tell()
+                if sys.byteorder == "big":
+                    offsets.byteswap()
+                offsets.tofile(output)
+                output.seek(0)
+                output.write(HEADER.pack(MAGIC, len(offsets) - 1, offsets_position))
+        finally:
+            for file in files:
+                file.close()
+            self._folder.cleanup()
+        os.replace(temp_path, self.path)
+        self.keys = len(offsets) - 1
+        return self.keys
+
+
+class Crosswalk:
+    """
+    The read-only map of the field values of an index to the _ids of
+    the documents they are found in, memory-mapped from the file a
+    CrosswalkWriter wrote, and searched by bisection.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.mtime = os.stat(path).st_mtime
+        with open(path, "rb") as file:
+            self._map = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, self.size, self._offsets = HEADER.unpack_from(self._map)
+        if magic != MAGIC:
+            raise ValueError(f"{path} is not a crosswalk.")
+
+    def __len__(self):
+        return self.size
+
+    def _record(self, index):
+        start, end = RECORD_BOUNDS.unpack_from(self._map, self._offsets + 8 * index)
+        return HEADER.size + start, HEADER.size + end
+
+    def lookup(self, key):
+        """Return the _ids of the documents of a crosswalk_key, in no particular order."""
+        key = key.encode("utf-8")
+        low, high = 0, self.size
+        while low < high:
+            middle = (low + high) // 2
+            start, end = self._record(middle)
+            tab = self._map.find(b"\t", start, end)
+            record_key = self._map[start:tab]
+            if record_key < key:
+                low = middle + 1
+            elif record_key > key:
+                high = middle
+            else:
+                return self._map[tab + 1:end].decode("utf-8").split("\t")
+        return []
+
+    def close(self):
+        self._map.close()
@@ -0,0 +1,153 @@
+import bisect
+import itertools
+import mmap
+import os
+import re
+import struct
+import sys
+from array import array
+
+# the file starts with MAGIC, the number of drugs and the number of
+# interactions, followed by the offsets of the interactions of every
+# drug, the drugs, sorted, and the drugs they interact with, sorted for
+# every drug. A drug is the number of its DrugBank id, DB00945 -> 945.
+# The offsets are little-endian unsigned 64 bits integers, the drugs
+# unsigned 32 bits integers.
+MAGIC = b"MCDDI001"
+HEADER = struct.Struct("<8sQQ")
+DRUGBANK_ID = re.compile(r"DB(\d{5,9})", re.I)
+
+
+def drug_number(drugbank_id):
+    """The number of a DrugBank id, DB00945 -> 945, or None if it is not one."""
+    match = DRUGBANK_ID.fullmatch(str(drugbank_id).strip())
+    return int(match.group(1)) if match else None
+
+
+def drugbank_id(number):
+    return f"DB{number:05d}"
+
+
+def _as_list(value):
+    if value is None:
+        return []
+    return value if isinstance(value, list) else [value]
+
+
+def doc_interactions(doc):
+    """The (drug, drug) numbers of the drugbank.drug_interactions of a document."""
+    drugbank = doc.get("drugbank") or {}
+    drug = drug_number(drugbank.get("id", ""))
+    if drug is None:
+        return
+    for interaction in _as_list(drugbank.get("drug_interactions")):
+        other = drug_number(interaction.get("drugbank-id", "")) if isinstance(interaction, dict) else None
+        if other is not None and other != drug:
+            yield drug, other
+
+
+class InteractionsWriter:
+    """
+    Write the drug-drug interactions of the documents added in any
+    order. Every interaction is stored both ways, so that one listed by
+    only one of the drugs is found from either.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.drugs = None  # once closed
+        self.interactions = None
+        self._adjacency = {}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, *exc_info):
+        if exc_type is None:
+            self.close()
+
+    def add_doc(self, doc):
+        for drug, other in doc_interactions(doc):
+            self._adjacency.setdefault(drug, array("I")).append(other)
+            self._adjacency.setdefault(other, array("I")).append(drug)
+
+    def close(self):
+        """Write the interactions file, replacing any previous one, return its number of drugs."""
+        drugs = array("I", sorted(self._adjacency))
+        offsets = array("Q", [0])
+        others = array("I")
+        for drug in drugs:
+            others.extend(sorted(set(self._adjacency.pop(drug))))
+            offsets.append(len(others))
+        if sys.byteorder == "big":
+            for values in (drugs, offsets, others):
+                values.byteswap()
+        temp_path = self.path + ".tmp"
+        with open(temp_path, "wb") as output:
+            output.write(HEADER.pack(MAGIC, len(drugs), len(others)))
+            for values in (offsets, drugs, others):
+                values.tofile(output)
+        os.replace(temp_path, self.path)
+        self.drugs, self.interactions = len(drugs), len(others) // 2
+        return self.drugs
+
+
+class Interactions:
+    """
+    The read-only adjacency of the drug-drug interactions, memory-mapped
+    from the file an InteractionsWriter wrote, and searched by bisection.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.mtime = os.stat(path).st_mtime
+        with open(path, "rb") as file:
+            self._map = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, self.size, edges = HEADER.unpack_from(self._map)
+        if magic != MAGIC:
+            raise ValueError(f"{path} is not an interactions file.")
+        if sys.byteorder == "big":  # the arrays cannot be cast then
+            raise ValueError(f"{path} cannot be mapped on a big-endian host.")
+        view = memoryview(self._map)[HEADER.size:]
+        self._offsets = view[: 8 * (self.size + 1)].cast("Q")
+        view = view[8 * (self.size + 1):]
+        self._drugs = view[: 4 * self.size].cast("I")
+        self._others = view[4 * self.size: 4 * (self.size + edges)].cast("I")
+
+    def __len__(self):
+        return self.size
+
+    def _bounds(self, drug):
+        index = bisect.bisect_left(self._drugs, drug)
+        if index == self.size or self._drugs[index] != drug:
+            return None
+        return self._offsets[index], self._offsets[index + 1]
+
+    def __contains__(self, drug_id):
+        drug = drug_number(drug_id)
+        return drug is not None and self._bounds(drug) is not None
+
+    def interacting(self, drug_id):
+        """The sorted DrugBank ids of the drugs a drug interacts with."""
+        drug = drug_number(drug_id)
+        bounds = self._bounds(drug) if drug is not None else None
+        if bounds is None:
+            return []
+        return [drugbank_id(other) for other in self._others[bounds[0]:bounds[1]]]
+
+    def interacts(self, drug_id, other_id):
+        drug, other = drug_number(drug_id), drug_number(other_id)
+        bounds = self._bounds(drug) if drug is not None and other is not None else None
+        if bounds is None:
+            return False
+        index = bisect.bisect_left(self._others, other, *bounds)
+        return index < bounds[1] and self._others[index] == other
+
+    def pairs(self, drug_ids):
+        """The pairs of the drugs that interact among drug_ids, in their order."""
+        return [[a, b] for a, b in itertools.combinations(drug_ids, 2) if self.interacts(a, b)]
+
+    def close(self):
+        for view in (self._offsets, self._drugs, self._others):
+            view.release()
+        self._map.close()
@@ -0,0 +1,50 @@
+import hashlib
+
+try:
+    from rdkit import Chem, RDLogger
+
+    RDLogger.DisableLog("rdApp.*")
+except ImportError:  # only the exact strings are matched then
+    Chem = None
+
+from shared.crosswalk import field_values
+
+# the SMILES of the sources, hashed into smiles_hash by the hub
+SMILES_FIELDS = ["chembl.smiles", "chebi.smiles", "unii.smiles", "drugcentral.structures.smiles"]
+
+
+def canonical_smiles(smiles):
+    """Return the canonical isomeric SMILES RDKit writes for smiles, or None."""
+    if Chem is None:
+        return None
+    molecule = Chem.MolFromSmiles(smiles)
+    if molecule is None:
+        return None
+    return Chem.MolToSmiles(molecule)
+
+
+def smiles_hash(smiles):
+    return hashlib.blake2b(smiles.encode("utf-8"), digest_size=16).hexdigest()
+
+
+def query_hash(smiles):
+    """The smiles_hash to search for a SMILES, of its canonical form if RDKit can parse it."""
+    smiles = smiles.strip()
+    return smiles_hash(canonical_smiles(smiles) or smiles)
+
+
+def doc_hashes(doc):
+    """
+    The smiles_hash values of a document: the hashes of its SMILES as
+    they are, so that they are found without RDKit, and of their
+    canonical forms.
+    """
+    hashes = {}
+    for field in SMILES_FIELDS:
+        for smiles in field_values(doc, field):
+            smiles = str(smiles).strip()
+            hashes[smiles_hash(smiles)] = None
+            canonical = canonical_smiles(smiles)
+            if canonical:
+                hashes[smiles_hash(canonical)] = None
+    return list(hashes)
@@ -0,0 +1,247 @@
+import heapq
+import itertools
+import mmap
+import os
+import struct
+import sys
+import tempfile
+from array import array
+
+from shared.crosswalk import field_values
+
+# the file starts with MAGIC, the number of suggestions kept for every
+# prefix, the number of names and the position of their offsets, and
+# the number of prefixes and the position of their offsets, followed by
+# the names, sorted by key, their offsets, the prefixes, sorted, and
+# their offsets. A name is its key, score, display name and _id, a
+# prefix is its key and the indices of its best names, separated by
+# tabs. The numbers are little-endian unsigned 64 bits integers, the
+# offsets are from the start of the file.
+MAGIC = b"MCSUGG01"
+HEADER = struct.Struct("<8sQQQQQ")
+RECORD_BOUNDS = struct.Struct("<QQ")
+
+# the names the hub writes the suggestions of, those of the fields
+# copied to "name", and the synonyms
+SUGGEST_FIELDS = [
+    "aeolus.drug_name",
+    "chebi.name",
+    "chebi.synonyms",
+    "chembl.molecule_synonyms.molecule_synonym",
+    "chembl.pref_name",
+    "drugbank.name",
+    "drugbank.synonyms",
+    "drugcentral.synonyms",
+    "fda_orphan_drug.generic_name",
+    "ginas.preferred_name",
+    "ndc.nonproprietaryname",
+    "ndc.proprietaryname",
+    "pharmgkb.name",
+    "umls.name",
+    "unii.display_name",
+]
+
+
+def suggest_key(name):
+    """The key of a name, case-insensitive with its spaces collapsed, or "" if it has control characters."""
+    key = " ".join(str(name).split()).lower()
+    return "" if any(char < " " for char in key) else key
+
+
+def _common_length(key, other):
+    length = 0
+    for char, other_char in zip(key, other):
+        if char != other_char:
+            break
+        length += 1
+    return length
+
+
+class SuggestWriter:
+    """
+    Write the names of the fields of the documents added in any order,
+    ranked by their score, the number of sources naming them, summed over
+    the documents. A name is suggested with the _id of the document most
+    sources name it in. The names are sorted chunk_size at a time in
+    temporary files, merged when the writer is closed, like the
+    CrosswalkWriter.
+
+    The best top names of every prefix of at most max_prefix_length
+    characters shared by more than scan_limit names are written too, so
+    that no prefix needs more than scan_limit names read.
+    """
+
+    def __init__(self, path, fields, top=20, scan_limit=128, max_prefix_length=16, chunk_size=1000000):
+        self.path = path
+        self.fields = fields
+        self.top = top
+        self.scan_limit = scan_limit
+        self.max_prefix_length = max_prefix_length
+        self.chunk_size = chunk_size
+        self.names = None  # once closed
+        self._rows = []
+        self._chunks = []
+        self._folder = tempfile.TemporaryDirectory(dir=os.path.dirname(os.path.abspath(path)))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, *exc_info):
+        if exc_type is None:
+            self.close()
+        else:
+            self._folder.cleanup()
+
+    def add_doc(self, doc):
+        names = {}  # {key: [display name, {source, ...}]}
+        for field in self.fields:
+            for value in field_values(doc, field):
+                name = " ".join(str(value).split())
+                key = suggest_key(name)
+                if key:
+                    names.setdefault(key, [name, set()])[1].add(field.split(".", 1)[0])
+        for key, (name, sources) in names.items():
+            self._rows.append((key, len(sources), name, doc["_id"]))
+        if len(self._rows) >= self.chunk_size:
+            self._spill()
+
+    def _spill(self):
+        self._rows.sort()
+        chunk = os.path.join(self._folder.name, f"{len(self._chunks)}.tsv")
+        with open(chunk, "w", encoding="utf-8") as file:
+            file.writelines(f"{key}\t{sources}\t{name}\t{_id}\n" for key, sources, name, _id in self._rows)
+        self._chunks.append(chunk)
+        self._rows = []
+
+    def _merged(self, files):
+        # one (key, score, display name, _id) per key
+        rows = (line.rstrip("\n").split("\t", 3) for line in heapq.merge(*files))
+        for key, group in itertools.groupby(rows, key=lambda row: row[0]):
+            group = [(int(sources), name, _id) for _, sources, name, _id in group]
+            _, name, _id = max(group, key=lambda row: row[0])
+            yield key, sum(sources for sources, _, _ in group), name, _id
+
+    def close(self):
+        """Write the suggestions file, replacing any previous one, return its number of names."""
+        self._spill()
+        files = [open(chunk, encoding="utf-8") for chunk in self._chunks]
+        offsets = array("Q")
+        prefixes = []
+        temp_path = self.path + ".tmp"
+        try:
+            with open(temp_path, "wb") as output:
+                output.write(HEADER.pack(MAGIC, 0, 0, 0, 0, 0))
+                # [prefix, index of its first name, heap of its best (score, -index)]
+                open_prefixes = []
+                previous = ""
+                for index, (key, score, name, _id) in enumerate(self._merged(files)):
+                    common = min(_common_length(previous, key), self.max_prefix_length)
+                    while len(open_prefixes) > common:
+                        self._add_prefix(prefixes, *open_prefixes.pop(), index)
+                    for length in range(len(open_prefixes) + 1, min(len(key), self.max_prefix_length) + 1):
+                        open_prefixes.append((key[:length], index, []))
+                    for _, _, best in open_prefixes:
+                        if len(best) < self.top:
+                            heapq.heappush(best, (score, -index))
+                        else:
+                            heapq.heappushpop(best, (score, -index))
+                    offsets.append(output.tell())
+                    output.write(f"{key}\t{score}\t{name}\t{_id}".encode("utf-8"))
+                    previous = key
+                names = len(offsets)
+                while open_prefixes:
+                    self._add_prefix(prefixes, *open_prefixes.pop(), names)
+                offsets.append(output.tell())
+                offsets_position = self._write_offsets(output, offsets)
+
+                prefixes.sort()
+                offsets = array("Q")
+                for prefix, indices in prefixes:
+                    offsets.append(output.tell())
+                    output.write("\t".join((prefix, *map(str, indices))).encode("utf-8"))
+                offsets.append(output.tell())
+                prefix_offsets_position = self._write_offsets(output, offsets)
+
+                output.seek(0)
+                output.write(HEADER.pack(MAGIC, self.top, names, offsets_position, len(prefixes), prefix_offsets_position))
+        finally:
+            for file in files:
+                file.close()
+            self._folder.cleanup()
+        os.replace(temp_path, self.path)
+        self.names = names
+        return self.names
+
+    def _add_prefix(self, prefixes, prefix, first, best, end):
+        if end - first > self.scan_limit:
+            prefixes.append((prefix, [-index for _, index in sorted(best, reverse=True)]))
+
+    @staticmethod
+    def _write_offsets(output, offsets):
+        position = output.tell()
+        if sys.byteorder == "big":
+            offsets.byteswap()
+        offsets.tofile(output)
+        return position
+
+
+class Suggestions:
+    """
+    The read-only names of an index, memory-mapped from the file a
+    SuggestWriter wrote, suggested for a prefix by bisection, from the
+    best names written for it or else from the names it starts.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.mtime = os.stat(path).st_mtime
+        with open(path, "rb") as file:
+            self._map = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, self.top, self.size, self._offsets, self._prefixes, self._prefix_offsets = HEADER.unpack_from(self._map)
+        if magic != MAGIC:
+            raise ValueError(f"{path} is not a suggestions file.")
+
+    def __len__(self):
+        return self.size
+
+    def _key(self, offsets, index):
+        start, end = RECORD_BOUNDS.unpack_from(self._map, offsets + 8 * index)
+        tab = self._map.find(b"\t", start, end)
+        return self._map[start:tab], tab + 1, end
+
+    def _bisect(self, offsets, count, key):
+        """The index of the first record of offsets whose key is not lower than key."""
+        low, high = 0, count
+        while low < high:
+            middle = (low + high) // 2
+            if self._key(offsets, middle)[0] < key:
+                low = middle + 1
+            else:
+                high = middle
+        return low
+
+    def _suggestion(self, index):
+        key, start, end = self._key(self._offsets, index)
+        score, name, _id = self._map[start:end].decode("utf-8").split("\t")
+        return {"name": name, "_id": _id, "score": int(score)}
+
+    def suggest(self, prefix, size=10):
+        """The size best names starting with prefix, by score, then key."""
+        key = suggest_key(prefix).encode("utf-8")
+        if not key or size < 1:
+            return []
+        low = self._bisect(self._offsets, self.size, key)
+        # no UTF-8 byte is 0xff, every key starting with key is lower
+        high = self._bisect(self._offsets, self.size, key + b"\xff")
+        if high - low > size and size <= self.top:
+            index = self._bisect(self._prefix_offsets, self._prefixes, key)
+            if index < self._prefixes:
+                prefix_key, start, end = self._key(self._prefix_offsets, index)
+                if prefix_key == key:
+                    indices = self._map[start:end].split(b"\t")[:size]
+                    return [self._suggestion(int(name_index)) for name_index in indices]
+        suggestions = (self._suggestion(index) for index in range(low, high))
+        return heapq.nsmallest(size, suggestions, key=lambda suggestion: -suggestion["score"])
+
+    def close(self):
+        self._map.close()
@@ -0,0 +1,151 @@
+"""
+The fake hub config and source collections of the key lookup tests.
+
+The hub modules read their config when imported, so every test of
+test_keylookup runs one of its checks in a new interpreter, with
+
+    python -m keylookup_fakes <check>
+
+which sets the fake config up before importing test_keylookup and
+calling the check.
+"""
+import importlib
+import logging
+import os
+import sys
+import tempfile
+import threading
+import types
+
+
+def setup_hub_config():
+    config = types.ModuleType("keylookup_test_config")
+    config.__file__ = os.path.join(tempfile.gettempdir(), "keylookup_test_config.py")
+    config.HUB_DB_BACKEND = {
+        "module": "biothings.utils.sqlite3",
+        "sqlite_db_folder": tempfile.mkdtemp(prefix="keylookup-hubdb-"),
+    }
+    config.DATA_HUB_DB_DATABASE = "hubdb"
+    config.DATA_SRC_DATABASE = "srcdb"
+    config.DATA_SRC_SERVER = "unused"
+    config.DATA_SRC_PORT = 27017
+    config.DATA_ARCHIVE_ROOT = tempfile.mkdtemp(prefix="keylookup-data-")
+    config.DRUGCENTRAL_PASSWORD = "unused"
+    config.logger = logging.getLogger("keylookup-test")
+    sys.modules[config.__name__] = config
+    sys.modules["config"] = config
+    os.environ["HUB_CONFIG"] = config.__name__
+    return config
+
+
+def hub_config():
+    """The config module of setup_hub_config, the tests change."""
+    return sys.modules["config"]
+
+
+def nested_value(doc, path):
+    value = doc
+    for part in path.split("."):
+        value = value[part]
+    return value
+
+
+class FakeCollection:
+    """A MongoDB collection recording the (lookup field, operator) of its queries."""
+
+    def __init__(self, indexes=(), docs=()):
+        self.indexes = set(indexes)
+        self.docs = list(docs)
+        self.database = None
+        self.queries = []
+
+    def list_indexes(self):
+        return [{"key": {field: 1}} for field in self.indexes]
+
+    def find(self, query, projection):
+        lookup, condition = next(iter(query.items()))
+        self.queries.append((lookup, next(iter(condition))))
+        matches = []
+        for doc in self.docs:
+            try:
+                value = nested_value(doc, lookup)
+            except KeyError:
+                continue
+            values = value if isinstance(value, list) else [value]
+            if "$exists" in condition or set(condition["$in"]).intersection(values):
+                matches.append(doc)
+        return matches
+
+
+class ConcurrentCollection(FakeCollection):
+    """A FakeCollection whose queries wait for those of three other ones."""
+
+    barrier = threading.Barrier(4, timeout=10)
+
+    def find(self, query, projection):
+        self.barrier.wait()
+        return super().find(query, projection)
+
+
+class FakeDatabase:
+    def __init__(self, collections):
+        self.collections = collections
+        for collection in collections.values():
+            collection.database = self
+
+    def collection_names(self):
+        return list(self.collections)
+
+    def __getitem__(self, name):
+        return self.collections[name]
+
+
+def fake_src_db():
+    """
+    Return the FakeDatabase of the collections of the key lookup graph,
+    with two unii documents, now returned by mongo.get_src_db. To call
+    before importing the hub modules, whose edges check the indexes of
+    their collections when created.
+    """
+    from biothings.hub.datatransform import datatransform_mdb
+
+    unii = FakeCollection(
+        indexes={"unii.unii", "unii.preferred_term", "unii.smiles"},
+        docs=[
+            {"unii": {"unii": "UNII3", "inchikey": "CCCCCCCCCCCCCC-DDDDDDDDDD-E"}},
+            {
+                "unii": {
+                    "unii": ["UNII4", "UNII5"],
+                    "inchikey": "EEEEEEEEEEEEEE-FFFFFFFFFF-G",
+                }
+            },
+        ],
+    )
+    fake_db = FakeDatabase(
+        {
+            "unii": unii,
+            "chebi": FakeCollection(indexes={"chebi.id", "chebi.smiles"}),
+            "chembl": FakeCollection(
+                indexes={
+                    "chembl.inchi",
+                    "chembl.molecule_chembl_id",
+                    "chembl.chebi_par_id",
+                    "chembl.smiles",
+                }
+            ),
+            "drugcentral": FakeCollection(indexes={"drugcentral.structures.smiles"}),
+            "drugbank_full": FakeCollection(
+                indexes={"drugbank.inchi", "drugbank.products.ndc_product_code"}
+            ),
+            "pubchem": FakeCollection(indexes={"pubchem.inchi", "pubchem.cid"}),
+            "drugbank": FakeCollection(indexes={"drugbank.id", "drugbank.xrefs.chebi"}),
+            "pharmgkb": FakeCollection(indexes={"pharmgkb.id"}),
+        }
+    )
+    datatransform_mdb.mongo.get_src_db = lambda: fake_db
+    return fake_db
+
+
+if __name__ == "__main__":
+    setup_hub_config()
+    getattr(importlib.import_module("test_keylookup"), sys.argv[1])()
@@ -0,0 +1,312 @@
+import json
+import os
+import subprocess
+import sys
+import tempfile
+from pathlib import Path
+
+from keylookup_fakes import ConcurrentCollection, fake_src_db, hub_config
+
+SOURCE_ROOT = Path(__file__).parents[1]
+TESTS_ROOT = Path(__file__).parent
+
+
+def run_in_hub(check):
+    """Run a check of this module in a new interpreter, see keylookup_fakes."""
+    env = os.environ.copy()
+    env["PYTHONPATH"] = os.pathsep.join(
+        [str(TESTS_ROOT), str(SOURCE_ROOT), env.get("PYTHONPATH", "")]
+    ).rstrip(os.pathsep)
+    result = subprocess.run(
+        [sys.executable, "-m", "keylookup_fakes", check.__name__],
+        check=False,
+        capture_output=True,
+        cwd=TESTS_ROOT,
+        env=env,
+        text=True,
+    )
+    assert result.returncode == 0, result.stdout + result.stderr
+
+
+def drugcentral_docs(*ids):
+    return [
+        {
+            "_id": "DrugCentral:%s" % _id,
+            "drugcentral": {"id": _id, "xrefs": {"unii": "UNII%s" % _id}},
+        }
+        for _id in ids
+    ]
+
+
+def check_edges_preload_their_collection():
+    unii = fake_src_db()["unii"]
+    from hub.dataload.sources.drugcentral import DrugCentralUploader
+    from hub.datatransform.keylookup import PreloadedMongoDBEdge
+
+    config = hub_config()
+    keylookup = DrugCentralUploader.keylookup
+    edge = keylookup.graph.edges["unii", "inchikey"]["object"]
+    assert isinstance(edge, PreloadedMongoDBEdge)
+    docs = drugcentral_docs("3", "5", "6")
+    expected = [
+        "CCCCCCCCCCCCCC-DDDDDDDDDD-E",
+        "EEEEEEEEEEEEEE-FFFFFFFFFF-G",
+        "UNII6",
+    ]
+
+    config.KEYLOOKUP_PRELOAD_MAX_BYTES = 1024 * 1024
+    assert [doc["_id"] for doc in keylookup(lambda: iter(docs))()] == expected
+    assert ("unii.unii", "$in") not in unii.queries
+    # once for unii -> inchikey, once for unii -> pubchem
+    assert unii.queries.count(("unii.unii", "$exists")) == 2
+    # dropped when the upload ends
+    assert edge._state["table"] is None
+
+    # above the cap, MongoDB is queried for every batch
+    unii.queries.clear()
+    config.KEYLOOKUP_PRELOAD_MAX_BYTES = 100
+    assert [doc["_id"] for doc in keylookup(lambda: iter(docs))()] == expected
+    assert ("unii.unii", "$in") in unii.queries
+
+    # and the collection is not read again by the next uploads, but for
+    # unii -> pubchem, with no value to preload
+    unii.queries.clear()
+    assert [doc["_id"] for doc in keylookup(lambda: iter(docs))()] == expected
+    assert unii.queries.count(("unii.unii", "$exists")) == 1
+    assert ("unii.unii", "$in") in unii.queries
+
+
+def test_edges_preload_their_collection():
+    run_in_hub(check_edges_preload_their_collection)
+
+
+def check_edges_share_the_preload_budget_of_the_process():
+    unii = fake_src_db()["unii"]
+    from hub.dataload.sources.drugcentral import DrugCentralUploader
+    from hub.datatransform.keylookup import preload_budget
+
+    config = hub_config()
+    keylookup = DrugCentralUploader.keylookup
+    docs = drugcentral_docs("3", "6")
+    expected = ["CCCCCCCCCCCCCC-DDDDDDDDDD-E", "UNII6"]
+    # for unii -> pubchem to preload as much as unii -> inchikey
+    for doc in unii.docs:
+        doc["unii"]["pubchem"] = 2244
+    inchikey = keylookup.graph.edges["unii", "inchikey"]["object"]
+    pubchem = keylookup.graph.edges["unii", "pubchem"]["object"]
+
+    config.KEYLOOKUP_PRELOAD_MAX_BYTES = 1024 * 1024
+    assert [doc["_id"] for doc in keylookup(lambda: iter(docs))()] == expected
+    assert preload_budget.used == 0
+    # room for the map of one of the two unii edges only
+    inchikey.load_table()
+    sizes = [inchikey._state["reserved"]]
+    inchikey.reset()
+    pubchem.load_table()
+    sizes.append(pubchem._state["reserved"])
+    pubchem.reset()
+    config.KEYLOOKUP_PRELOAD_MAX_BYTES = max(sizes) + min(sizes) // 2
+
+    unii.queries.clear()
+    assert [doc["_id"] for doc in keylookup(lambda: iter(docs))()] == expected
+    assert unii.queries.count(("unii.unii", "$exists")) == 2
+    assert ("unii.unii", "$in") in unii.queries
+    assert preload_budget.used == 0
+
+    # the edge not fitting is remembered, only the other one is read again
+    unii.queries.clear()
+    assert [doc["_id"] for doc in keylookup(lambda: iter(docs))()] == expected
+    assert unii.queries.count(("unii.unii", "$exists")) == 1
+    assert ("unii.unii", "$in") in unii.queries
+
+
+def test_edges_share_the_preload_budget_of_the_process():
+    run_in_hub(check_edges_share_the_preload_budget_of_the_process)
+
+
+def check_cache_lasts_until_the_collection_is_uploaded_again():
+    unii = fake_src_db()["unii"]
+    from biothings.utils import hub_db
+
+    from hub.dataload.sources.drugcentral import DrugCentralUploader
+
+    config = hub_config()
+    keylookup = DrugCentralUploader.keylookup
+    docs = drugcentral_docs("3", "6")
+    expected = ["CCCCCCCCCCCCCC-DDDDDDDDDD-E", "UNII6"]
+
+    def upload_unii(release, status="success"):
+        started_at = "2026-01-0%s" % release
+        job = {"status": status, "release": release, "started_at": started_at}
+        hub_db.get_src_dump().save({"_id": "unii", "upload": {"jobs": {"unii": job}}})
+
+    config.KEYLOOKUP_PRELOAD_MAX_BYTES = 1024 * 1024
+    config.KEYLOOKUP_CACHE = os.path.join(
+        tempfile.mkdtemp(prefix="keylookup-cache-"), "keylookup.sqlite"
+    )
+    upload_unii("1")
+    assert [doc["_id"] for doc in keylookup(lambda: iter(docs))()] == expected
+    assert unii.queries.count(("unii.unii", "$exists")) == 2
+
+    # UNII6, found nowhere, is cached too
+    unii.queries.clear()
+    assert [doc["_id"] for doc in keylookup(lambda: iter(docs))()] == expected
+    assert unii.queries == []
+
+    # not while unii is being uploaded
+    upload_unii("2", status="uploading")
+    assert [doc["_id"] for doc in keylookup(lambda: iter(docs))()] == expected
+    assert unii.queries.count(("unii.unii", "$exists")) == 2
+
+    # nor for the previous upload once it is done
+    unii.queries.clear()
+    upload_unii("2")
+    assert [doc["_id"] for doc in keylookup(lambda: iter(docs))()] == expected
+    assert unii.queries.count(("unii.unii", "$exists")) == 2
+    unii.queries.clear()
+    assert [doc["_id"] for doc in keylookup(lambda: iter(docs))()] == expected
+    assert unii.queries == []
+
+
+def test_cache_lasts_until_the_collection_is_uploaded_again():
+    run_in_hub(check_cache_lasts_until_the_collection_is_uploaded_again)
+
+
+def check_edge_group_looks_its_collections_up_concurrently():
+    fake_db = fake_src_db()
+    from biothings.hub.datatransform import IDStruct
+
+    from hub.dataload.sources.drugcentral import DrugCentralUploader
+    from hub.datatransform.keylookup_report import KeyLookupReport
+
+    config = hub_config()
+    smiles_docs = {
+        "chebi": {"chebi": {"smiles": "C", "inchikey": "CHEBI-KEY"}},
+        "chembl": {"chembl": {"smiles": ["C", "CC"], "inchi_key": "CHEMBL-KEY"}},
+        "drugcentral": {
+            "drugcentral": {
+                "structures": {"smiles": "CC", "inchikey": "DRUGCENTRAL-KEY"}
+            }
+        },
+        "unii": {"unii": {"smiles": "C", "inchikey": "UNII-KEY"}},
+    }
+    # every collection waits for the others to be queried too
+    for name, doc in smiles_docs.items():
+        collection = fake_db[name]
+        collection.__class__ = ConcurrentCollection
+        collection.docs = [doc]
+
+    keylookup = DrugCentralUploader.keylookup
+    group = keylookup.graph.edges["smiles", "inchikey"]["object"]
+    id_strct = IDStruct()
+    id_strct.add("first", "C")
+    id_strct.add("second", "CC")
+
+    config.KEYLOOKUP_PRELOAD_MAX_BYTES = 0
+    config.KEYLOOKUP_EDGE_GROUP_THREADS = 4
+    result = group.edge_lookup(keylookup, id_strct)
+    assert sorted(result) == [
+        ("first", "CHEBI-KEY"),
+        ("first", "CHEMBL-KEY"),
+        ("first", "UNII-KEY"),
+        ("second", "CHEMBL-KEY"),
+        ("second", "DRUGCENTRAL-KEY"),
+    ]
+
+    # the times of every batch are summed for the upload, not logged
+    keylookup.report = KeyLookupReport()
+    for _ in range(3):
+        keylookup._edge_lookup(group, id_strct)
+    edges = keylookup.report.as_dict()["edges"]
+    assert edges["smiles"]["calls"] == 3
+    assert edges["smiles [chembl.smiles]"]["calls"] == 3
+    assert len(edges) == 1 + len(group.edges)
+
+
+def test_edge_group_looks_its_collections_up_concurrently():
+    run_in_hub(check_edge_group_looks_its_collections_up_concurrently)
+
+
+def check_report_counts_edges_and_fallbacks():
+    fake_src_db()
+    from hub.dataload.sources.drugcentral import DrugCentralUploader
+
+    config = hub_config()
+    keylookup = DrugCentralUploader.keylookup
+    docs = drugcentral_docs("3", "6") + [
+        {"_id": "AAAAAAAAAAAAAA-BBBBBBBBBB-C", "drugcentral": {"id": "7"}},
+        {"_id": "DrugCentral:8", "drugcentral": {"id": "8"}},
+    ]
+    uploader = DrugCentralUploader.__new__(DrugCentralUploader)
+    uploader.logfile = os.path.join(tempfile.mkdtemp(), "upload_drugcentral_2026.log")
+    path = uploader.keylookup_report()
+    assert path.endswith("upload_drugcentral_2026_keylookup.json")
+
+    config.KEYLOOKUP_PRELOAD_MAX_BYTES = 1024 * 1024
+    loaded = [doc["_id"] for doc in keylookup(lambda: iter(docs), report=path)()]
+    assert loaded == [
+        "AAAAAAAAAAAAAA-BBBBBBBBBB-C",
+        "CCCCCCCCCCCCCC-DDDDDDDDDD-E",
+        "UNII6",
+        "DrugCentral:8",
+    ]
+    assert keylookup.report is None
+
+    with open(path) as file:
+        report = json.load(file)
+    assert report["docs"] == {"in": 4, "found": 2, "skipped": 1, "fallback": 1}
+    assert report["fallbacks"] == {"DrugCentral": 1}
+    lookup = report["lookups"]["drugcentral.xrefs.unii -> inchikey"]
+    assert (lookup["docs"], lookup["found"], lookup["hit_rate"]) == (3, 1, 0.3333)
+    edge = report["edges"]["unii -> inchikey"]
+    assert (edge["ids"], edge["found"], edge["calls"]) == (2, 1, 1)
+    assert sum(edge["histogram"].values()) == 1
+    # no smiles to look up
+    assert not any(name.startswith("smiles") for name in report["edges"])
+
+
+def test_report_counts_edges_and_fallbacks():
+    run_in_hub(check_report_counts_edges_and_fallbacks)
+
+
+def check_paths_are_planned_once():
+    fake_src_db()
+    from biothings.hub.datatransform import datatransform_mdb
+
+    from hub.datatransform import keylookup
+
+    searches = []
+    all_simple_paths = datatransform_mdb.nx.all_simple_paths
+
+    def counted_simple_paths(graph, source, target):
+        searches.append((source, target))
+        return all_simple_paths(graph, source, target)
+
+    datatransform_mdb.nx.all_simple_paths = counted_simple_paths
+
+    plans = keylookup.plan_paths()
+    assert searches
+    searches.clear()
+    lookup = keylookup.MyChemKeyLookup([("drugname", "x.name"), ("unii", "x.unii")])
+    assert searches == []
+    assert lookup.paths[("unii", "inchikey")] is plans[("unii", "inchikey")]
+    assert set(lookup.paths) == {
+        (input_type, output_type)
+        for input_type in ("unii", "drugname")
+        for output_type in lookup.output_types
+    }
+
+    assert keylookup.describe_paths("drugname", "unii") == (
+        "drugname -> unii\n"
+        "    drugname -[unii.preferred_term 1]-> unii  (weight 1)"
+    )
+    assert keylookup.describe_paths("drugname", "inchikey").splitlines()[1:] == [
+        "    drugname -[unii.preferred_term 1]-> unii -[unii.unii 1]-> inchikey"
+        "  (weight 2)",
+        "    drugname -[unii.preferred_term 1]-> unii -[unii.unii 1]-> pubchem"
+        " -[pubchem.cid 1]-> inchikey  (weight 3)",
+    ]
+
+
+def test_paths_are_planned_once():
+    run_in_hub(check_paths_are_planned_once)
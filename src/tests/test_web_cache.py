@@ -0,0 +1,218 @@
+import asyncio
+import sys
+from pathlib import Path
+from types import SimpleNamespace
+
+SOURCE_ROOT = Path(__file__).parents[1]
+if str(SOURCE_ROOT) not in sys.path:
+    sys.path.insert(0, str(SOURCE_ROOT))
+
+from biothings.utils.common import dotdict  # noqa: E402
+
+from web.cache import AnnotationCache, BuildCheck, SingleFlight  # noqa: E402
+from biothings.web.handlers import QueryHandler  # noqa: E402
+from web.handlers import MyChemBiothingHandler, MyChemQueryHandler  # noqa: E402
+
+
+class StatusClient:
+    """Return the STATUS_CHECK document from the current index."""
+
+    def __init__(self, index):
+        self.index = index
+        self.reads = 0
+
+    async def get(self, index, id):
+        self.reads += 1
+        return {"_index": self.index, "_id": id, "found": True}
+
+
+def test_cache_evicts_least_recently_used():
+    cache = AnnotationCache(max_entries=2, max_bytes=1024, ttl=60)
+    cache.put("a", {"_id": "a"})
+    cache.put("b", {"_id": "b"})
+    assert cache.get("a") == {"_id": "a"}
+
+    cache.put("c", {"_id": "c"})
+
+    assert cache.get("b") is AnnotationCache.MISSING
+    assert cache.get("a") == {"_id": "a"}
+    assert cache.get("c") == {"_id": "c"}
+    assert cache.stats()["hits"] == 3
+    assert cache.stats()["misses"] == 1
+    assert cache.stats()["evictions"] == 1
+
+
+def test_cache_limits_bytes():
+    cache = AnnotationCache(max_entries=100, max_bytes=40, ttl=60)
+    cache.put("a", {"name": "a" * 10})
+    cache.put("b", {"name": "b" * 10})
+    cache.put("too large", {"name": "x" * 100})
+
+    assert len(cache) == 1
+    assert cache.get("b") == {"name": "b" * 10}
+    assert cache.get("too large") is AnnotationCache.MISSING
+    assert cache.bytes <= 40
+
+
+def test_cache_entries_expire():
+    cache = AnnotationCache(max_entries=10, max_bytes=1024, ttl=-1)
+    cache.put("a", {"_id": "a"})
+
+    assert cache.get("a") is AnnotationCache.MISSING
+    assert len(cache) == 0
+
+
+def test_cache_is_cleared_by_a_new_build():
+    status_check = {"index": "mychem_current", "id": "USNINKBPBVKHHZ-CYUUQNCZSA-L"}
+    cache = AnnotationCache(10, 1024, 60, status_check, build_check_interval=0)
+    client = StatusClient("mychem_20240101")
+
+    asyncio.run(cache.check_build(client))
+    cache.put("a", {"_id": "a"})
+    asyncio.run(cache.check_build(client))
+    assert cache.get("a") == {"_id": "a"}
+
+    client.index = "mychem_20240201"
+    asyncio.run(cache.check_build(client))
+    assert cache.get("a") is AnnotationCache.MISSING
+    assert cache.stats()["build"] == "mychem_20240201"
+    assert cache.stats()["invalidations"] == 1
+
+
+def test_cache_checks_the_build_at_intervals():
+    status_check = {"index": "mychem_current", "id": "USNINKBPBVKHHZ-CYUUQNCZSA-L"}
+    cache = AnnotationCache(10, 1024, 60, status_check, build_check_interval=60)
+    client = StatusClient("mychem_20240101")
+
+    for _ in range(3):
+        asyncio.run(cache.check_build(client))
+
+    assert client.reads == 1
+
+
+def test_build_check_keeps_the_last_build_on_errors():
+    build_check = BuildCheck({"index": "mychem_current", "id": "USNINKBPBVKHHZ-CYUUQNCZSA-L"}, interval=0)
+    client = StatusClient("mychem_20240101")
+
+    assert asyncio.run(build_check.check(client)) == "mychem_20240101"
+
+    async def unavailable(**kwargs):
+        raise ConnectionError()
+
+    client.get = unavailable
+    assert asyncio.run(build_check.check(client)) == "mychem_20240101"
+
+
+def test_single_flight_collapses_concurrent_fetches():
+    flights = SingleFlight()
+    fetches = []
+
+    async def fetch():
+        fetches.append(1)
+        await asyncio.sleep(0.01)
+        return {"_id": "a"}
+
+    async def main():
+        return await asyncio.gather(*(flights.run("a", fetch) for _ in range(5)), flights.run("b", fetch))
+
+    results = asyncio.run(main())
+
+    assert results == [{"_id": "a"}] * 6
+    assert len(fetches) == 2
+    assert flights.stats() == {"in_flight": 0, "calls": 6, "collapsed": 4}
+
+
+def test_single_flight_shares_errors_and_fetches_again():
+    flights = SingleFlight()
+    fetches = []
+
+    async def fetch():
+        fetches.append(1)
+        await asyncio.sleep(0)
+        raise ValueError("unavailable")
+
+    async def main():
+        first = await asyncio.gather(*(flights.run("a", fetch) for _ in range(3)), return_exceptions=True)
+        second = await asyncio.gather(flights.run("a", fetch), return_exceptions=True)
+        return first + second
+
+    results = asyncio.run(main())
+
+    assert all(isinstance(result, ValueError) for result in results)
+    assert len(fetches) == 2
+    assert flights.collapsed == 2
+
+
+class ChebiBuilder:
+    def normalize_id(self, q, biothing_type=None):
+        # chebi.id is normalized to lowercase
+        return str(q).lower(), ("chebi.id",)
+
+
+class ChebiPipeline:
+    builder = ChebiBuilder()
+
+    def __init__(self):
+        self.fetched = []
+
+    async def fetch(self, id, **options):
+        self.fetched.append(id)
+        await asyncio.sleep(0.01)
+        return [{"query": _id, "_id": "CHEBI-DOC", "chebi": {"id": _id.upper()}} for _id in id]
+
+
+def annotation_post(pipeline, cache, flights, ids):
+    handler = MyChemBiothingHandler.__new__(MyChemBiothingHandler)
+    handler.pipeline = pipeline
+    handler.annotation_cache = cache
+    handler.annotation_flights = flights
+    handler.biothing_type = "chem"
+    elasticsearch = SimpleNamespace(async_client=None)
+    handler.application = SimpleNamespace(biothings=SimpleNamespace(elasticsearch=elasticsearch))
+    handler.event = {}
+    handler.args = dotdict(id=ids)
+    handler.finish = lambda chunk: setattr(handler, "response", chunk)
+    return handler
+
+
+def test_concurrent_posts_share_a_fetch_across_id_spellings():
+    pipeline = ChebiPipeline()
+    cache = AnnotationCache(10, 1024 * 1024, 60)
+    flights = SingleFlight()
+    first = annotation_post(pipeline, cache, flights, ["CHEBI:57966"])
+    second = annotation_post(pipeline, cache, flights, ["chebi:57966"])
+
+    async def main():
+        await asyncio.gather(first.post(), second.post())
+
+    asyncio.run(main())
+
+    assert len(pipeline.fetched) == 1
+    doc = {"_id": "CHEBI-DOC", "chebi": {"id": "CHEBI:57966"}}
+    assert first.response == [dict(query="CHEBI:57966", **doc)]
+    assert second.response == [dict(query="chebi:57966", **doc)]
+    # and cached for either spelling
+    third = annotation_post(pipeline, cache, flights, ["Chebi:57966"])
+    asyncio.run(third.post())
+    assert third.response == [dict(query="Chebi:57966", **doc)]
+    assert len(pipeline.fetched) == 1
+
+
+def test_query_etag_skips_the_random_document_of_any(monkeypatch):
+    async def search(handler, *args, **kwargs):
+        handler.searched = True
+
+    async def not_modified(*key):
+        etags.append(key)
+        return False
+
+    monkeypatch.setattr(QueryHandler, "get", search)
+    etags = []
+    for q in ("__any__", "aspirin"):
+        handler = MyChemQueryHandler.__new__(MyChemQueryHandler)
+        handler.args = dotdict(q=q)
+        handler.not_modified = not_modified
+        asyncio.run(handler.get())
+        assert handler.searched
+
+    assert [key[1] for key in etags] == [(("q", "aspirin"),)]
@@ -0,0 +1,141 @@
+import json
+import sys
+from pathlib import Path
+
+import pytest
+
+SOURCE_ROOT = Path(__file__).parents[1]
+if str(SOURCE_ROOT) not in sys.path:
+    sys.path.insert(0, str(SOURCE_ROOT))
+
+from biothings.web.query.builder import QStringParser  # noqa: E402
+
+import config_web  # noqa: E402
+from web.pipeline import MyChemQueryBuilder  # noqa: E402
+
+TEST_DATA_DIR = Path(__file__).parent / "test_data"
+
+# the queries of TestAnnotationRegex and TestAnnotationRegexMock
+FIXTURE_IDS = [
+    "db03107",
+    "dB03107",
+    "chembl297569",
+    "CHEMBL297569",
+    "chebi:57966",
+    "ChEBI:57966",
+    "chebi:22821",
+    "11P2JDE17B",
+    "cid:120933777",
+    "Cid:120933777",
+    "120933777",
+    "DEFAULTSCO",
+    "DB01590",
+    "DRUGBANK:DB01590",
+    "DB00001",
+]
+
+PREFIXES = [
+    "INCHIKEY", "CHEMBL.COMPOUND", "PUBCHEM.COMPOUND", "CHEBI", "UNII", "DRUGBANK", "CHEMBL",
+    "PHARMGKB.DRUG", "CID", "SID", "PUBCHEM.SUBSTANCE", "drugbank.id", "pubchem", "unknown",
+]
+
+# malformed or unusual ids, where the order of the patterns matters
+EDGE_CASE_IDS = [
+    "",
+    ":",
+    "chebi:",
+    ":DB00945",
+    "CHEBI:CHEBI:57966",
+    "chembl:compound:CHEMBL25",
+    "pubchem:compound:2244",
+    "pharmgkbxdrug:PA448497",
+    "DB12345678",
+    "1234567890",
+    "CHEMBL1234",
+    "aspirin",
+    "drugbank.id:DB00945:x",
+    "INCHIKEY:BSYNRYMUTXBXSQ-UHFFFAOYSA-N",
+    "BSYNRYMUTXBXSQ-UHFFFAOYSA-N",
+    "unii: R16CO5Y76E",
+]
+
+
+def fixture_ids():
+    """The ids of the TestAnnotationRegex documents, bare and with each prefix."""
+    ids = set(FIXTURE_IDS + EDGE_CASE_IDS)
+    with open(TEST_DATA_DIR / "TestAnnotationRegex" / "mychem_test.ndjson") as ndjson:
+        for line in ndjson:
+            doc = json.loads(line)
+            if "index" in doc:
+                ids.add(doc["index"]["_id"])
+                continue
+            for source, field in [
+                ("chembl", "molecule_chembl_id"),
+                ("chebi", "id"),
+                ("unii", "unii"),
+                ("drugbank", "id"),
+                ("pharmgkb", "id"),
+                ("pubchem", "cid"),
+            ]:
+                values = doc.get(source, {})
+                values = values if isinstance(values, list) else [values]
+                ids.update(str(value[field]) for value in values if field in value)
+    prefixed = {f"{prefix}:{_id}" for _id in ids for prefix in PREFIXES}
+    return sorted(ids | prefixed | {_id.lower() for _id in prefixed})
+
+
+def test_classifier_matches_sequential_patterns():
+    classifier = config_web.ANNOTATION_ID_REGEX_LIST
+    parser = QStringParser(
+        default_scopes=config_web.ANNOTATION_DEFAULT_SCOPES,
+        patterns=list(classifier),
+        default_pattern=config_web.default_chem_regex_pattern,
+    )
+
+    ids = fixture_ids()
+    assert len(ids) > 500
+    for _id in ids:
+        assert classifier.classify(_id) == parser.parse(_id, metadata=None), _id
+
+
+@pytest.mark.parametrize(
+    "_id, term, scopes",
+    [
+        ("120933777", "120933777", ["pubchem.cid"]),
+        ("sid:120933777", "120933777", ["fda_orphan_drug.pubchem_sid"]),
+        ("11P2JDE17B", "11P2JDE17B", ["unii.unii"]),
+        ("ChEBI:57966", "ChEBI:57966", ["chebi.id", "chebi.secondary_chebi_id"]),
+        ("DRUGBANK:DB01590", "DB01590", config_web.DRUGBANK_ID_FIELDS),
+        ("drugbank.id:DB01590", "DB01590", ["drugbank.id"]),
+        ("aspirin", "aspirin", ["_id"]),
+    ],
+)
+def test_builder_classifies_ids(_id, term, scopes):
+    builder = MyChemQueryBuilder(scopes_regexs=config_web.ANNOTATION_ID_REGEX_LIST)
+
+    assert builder.parser.parse(_id, metadata=None) == (term, scopes)
+
+
+class KeywordMetadata:
+    """Map every field as a lowercase normalized keyword."""
+
+    biothing_metadata = {}
+
+    def get_mappings(self, biothing_type):
+        properties = {}
+        for _, fields in config_web.ANNOTATION_ID_REGEX_LIST:
+            for field in fields:
+                *parents, leaf = field.split(".")
+                node = properties
+                for parent in parents:
+                    node = node.setdefault(parent, {"properties": {}})["properties"]
+                node[leaf] = {"type": "keyword", "normalizer": "keyword_lowercase_normalizer"}
+        return properties
+
+
+def test_equivalent_ids_are_normalized_alike():
+    builder = MyChemQueryBuilder(scopes_regexs=config_web.ANNOTATION_ID_REGEX_LIST, metadata=KeywordMetadata())
+
+    assert builder.normalize_id("CHEBI:57966") == builder.normalize_id("chebi:57966")
+    assert builder.normalize_id("DB00945") == builder.normalize_id("DRUGBANK:db00945")
+    assert builder.normalize_id("BSYNRYMUTXBXSQ-UHFFFAOYSA-N") != builder.normalize_id("bsynrymutxbxsq-uhfffaoysa-n")
@@ -0,0 +1,43 @@
+import sys
+from pathlib import Path
+
+SOURCE_ROOT = Path(__file__).parents[1]
+if str(SOURCE_ROOT) not in sys.path:
+    sys.path.insert(0, str(SOURCE_ROOT))
+
+from shared.crosswalk import CROSSWALK_FIELDS, Crosswalk, CrosswalkWriter, crosswalk_key  # noqa: E402
+
+FIELDS = ["_id", "chembl.molecule_chembl_id", "drugbank.id", "unichem.drugbank", "pubchem.cid"]
+DOCS = [
+    {"_id": "BSYNRYMUTXBXSQ-UHFFFAOYSA-N", "chembl": {"molecule_chembl_id": "CHEMBL25"}, "pubchem": {"cid": 2244}},
+    {"_id": "XREF", "unichem": [{"drugbank": "DB00945"}, {"drugbank": "DB00001"}]},
+    {"_id": "OTHER", "drugbank": {"id": "DB00001", "name": "lepirudin"}, "unichem": {"drugbank": "DB00001"}},
+]
+
+
+def test_crosswalk_maps_values_to_ids(tmp_path):
+    path = str(tmp_path / "mychem.crosswalk")
+    # one key per chunk, merged when the writer is closed
+    with CrosswalkWriter(path, FIELDS, chunk_size=1) as writer:
+        for doc in reversed(DOCS):
+            writer.add_doc(doc)
+
+    crosswalk = Crosswalk(path)
+
+    assert len(crosswalk) == 8
+    assert crosswalk.lookup(crosswalk_key("chembl.molecule_chembl_id", "chembl25")) == ["BSYNRYMUTXBXSQ-UHFFFAOYSA-N"]
+    assert crosswalk.lookup(crosswalk_key("pubchem.cid", 2244)) == ["BSYNRYMUTXBXSQ-UHFFFAOYSA-N"]
+    assert sorted(crosswalk.lookup(crosswalk_key("unichem.drugbank", "DB00001"))) == ["OTHER", "XREF"]
+    assert crosswalk.lookup(crosswalk_key("_id", "XREF")) == ["XREF"]
+    assert crosswalk.lookup(crosswalk_key("drugbank.name", "lepirudin")) == []
+    assert crosswalk.lookup(crosswalk_key("drugbank.id", "DB99999")) == []
+    crosswalk.close()
+    assert not list(tmp_path.glob("*.tmp"))
+
+
+def test_crosswalk_fields_cover_the_annotation_id_prefixes():
+    import config_web
+
+    for mapping in config_web.BIOLINK_MODEL_PREFIX_BIOTHINGS_CHEM_MAPPING.values():
+        fields = mapping.get("field", [])
+        assert set([fields] if isinstance(fields, str) else fields) <= set(CROSSWALK_FIELDS)
@@ -0,0 +1,62 @@
+import sys
+from pathlib import Path
+
+import pytest
+
+SOURCE_ROOT = Path(__file__).parents[1]
+if str(SOURCE_ROOT) not in sys.path:
+    sys.path.insert(0, str(SOURCE_ROOT))
+
+from shared.interactions import Interactions, InteractionsWriter  # noqa: E402
+
+DOCS = [
+    {
+        "_id": "BSYNRYMUTXBXSQ-UHFFFAOYSA-N",
+        "drugbank": {
+            "id": "DB00945",
+            "drug_interactions": [
+                {"drugbank-id": "DB00682", "name": "Warfarin"},
+                {"drugbank-id": "DB01050", "name": "Ibuprofen"},
+                {"drugbank-id": "DB00945", "name": "Acetylsalicylic acid"},
+            ],
+        },
+    },
+    # listed again by another document of the same drug
+    {"_id": "DB00945", "drugbank": {"id": "DB00945", "drug_interactions": {"drugbank-id": "DB00682"}}},
+    # the interaction with aspirin is only listed by it
+    {"_id": "PJVWKTKQMONHTI-UHFFFAOYSA-N", "drugbank": {"id": "DB00682", "drug_interactions": []}},
+    {"_id": "OTHER", "drugbank": {"id": "DB01050", "drug_interactions": [{"drugbank-id": "DB100001"}]}},
+    {"_id": "NODRUGBANK", "chembl": {"molecule_chembl_id": "CHEMBL25"}},
+]
+
+
+def test_interactions_are_found_from_either_drug(tmp_path):
+    path = str(tmp_path / "drugbank_full.interactions")
+    with InteractionsWriter(path) as writer:
+        for doc in DOCS:
+            writer.add_doc(doc)
+    assert (writer.drugs, writer.interactions) == (4, 3)
+
+    interactions = Interactions(path)
+
+    assert len(interactions) == 4
+    assert interactions.interacting("DB00945") == ["DB00682", "DB01050"]
+    assert interactions.interacting("db00682") == ["DB00945"]
+    assert interactions.interacting("DB01050") == ["DB00945", "DB100001"]
+    assert interactions.interacting("DB99999") == []
+    assert interactions.interacts("DB00682", "DB00945")
+    assert not interactions.interacts("DB00682", "DB01050")
+    assert not interactions.interacts("DB00945", "CHEMBL25")
+    assert interactions.pairs(["DB01050", "DB00682", "DB00945"]) == [["DB01050", "DB00945"], ["DB00682", "DB00945"]]
+    assert "DB00682" in interactions
+    assert "DB99999" not in interactions
+    interactions.close()
+    assert not list(tmp_path.glob("*.tmp"))
+
+
+def test_interactions_file_is_checked(tmp_path):
+    path = tmp_path / "drugbank_full.interactions"
+    path.write_bytes(b"MCXWALK1" + bytes(16))
+
+    with pytest.raises(ValueError):
+        Interactions(str(path))
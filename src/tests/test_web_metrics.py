@@ -0,0 +1,55 @@
+import asyncio
+import sys
+from pathlib import Path
+
+SOURCE_ROOT = Path(__file__).parents[1]
+if str(SOURCE_ROOT) not in sys.path:
+    sys.path.insert(0, str(SOURCE_ROOT))
+
+from web.metrics import StageMetrics, StageTimings, timed  # noqa: E402
+
+
+def test_stages_are_untimed_by_default():
+    async def request():
+        with timed("es"):
+            pass
+
+    asyncio.run(request())
+
+
+def test_stage_timings_are_summed_per_request():
+    async def request():
+        timings = StageMetrics.start()
+        with timed("classify"):
+            pass
+        with timed("classify"):
+            pass
+        with timed("es"):
+            await asyncio.sleep(0.01)
+        return timings
+
+    async def main():
+        return await asyncio.gather(request(), request())
+
+    first, second = asyncio.run(main())
+
+    assert first is not second
+    assert list(first.durations) == ["classify", "es"]
+    assert first.durations["es"] >= 0.01
+    assert first.server_timing().startswith("classify;dur=")
+
+
+def test_histograms_render_in_prometheus_text_format():
+    metrics = StageMetrics(buckets=(0.01, 0.1))
+    for es in (0.005, 0.05, 0.5):
+        timings = StageTimings()
+        timings.durations = {"es": es}
+        metrics.observe("annotation", timings)
+
+    text = metrics.render()
+
+    assert "# TYPE mychem_request_stage_seconds histogram" in text
+    assert 'mychem_request_stage_seconds_bucket{endpoint="annotation",stage="es",le="0.01"} 1' in text
+    assert 'mychem_request_stage_seconds_bucket{endpoint="annotation",stage="es",le="0.1"} 2' in text
+    assert 'mychem_request_stage_seconds_bucket{endpoint="annotation",stage="es",le="+Inf"} 3' in text
+    assert 'mychem_request_stage_seconds_count{endpoint="annotation",stage="es"} 3' in text
@@ -0,0 +1,544 @@
+import asyncio
+import sys
+from pathlib import Path
+
+import pytest
+
+SOURCE_ROOT = Path(__file__).parents[1]
+if str(SOURCE_ROOT) not in sys.path:
+    sys.path.insert(0, str(SOURCE_ROOT))
+
+from biothings.utils.common import dotdict  # noqa: E402
+from biothings.web.handlers import QueryHandler  # noqa: E402
+from biothings.web.options import OptionError  # noqa: E402
+from biothings.web.query.engine import RawResultInterrupt  # noqa: E402
+from biothings.web.query.pipeline import QueryPipelineException, QueryPipelineInterrupt  # noqa: E402
+from biothings.web.services.metadata import BiothingsMetadata  # noqa: E402
+
+import config_web  # noqa: E402
+
+from web.handlers import MyChemQueryHandler  # noqa: E402
+from web.pipeline import (  # noqa: E402
+    ListFilter,
+    ListPage,
+    MyChemESQueryBackend,
+    MyChemESResultFormatter,
+    MyChemQueryBuilder,
+    MyChemQueryPipeline,
+    NestedListFilter,
+    ScriptListPage,
+)
+
+
+def es_response(*sources):
+    return {
+        "took": 1,
+        "hits": {
+            "total": len(sources),
+            "max_score": 1.0,
+            "hits": [
+                {"_id": str(index), "_score": 1.0, "_source": source}
+                for index, source in enumerate(sources)
+            ],
+        },
+    }
+
+
+def test_to_json_matches_the_biothings_serializer():
+    from biothings.utils import serializer
+    from biothings.utils.common import dotdict
+
+    for result in (
+        {"_id": "XREF", "name": "β-lactam", "sider": [{"frequency": 0.01}], "score": None},
+        [{"query": "DB00945", "notfound": True}],
+        {"counts": {1: "one"}, "meta": dotdict(build="20240101")},
+    ):
+        assert MyChemESResultFormatter.to_json(result) == serializer.to_json(result, return_bytes=True)
+
+
+def test_list_filter_is_parsed_once():
+    list_filter = ListFilter.parse("drugbank.products:route=Oral,Topical|approved=True")
+
+    assert list_filter.parent_path == "drugbank"
+    assert list_filter.list_field == "products"
+    assert list_filter.sub_field_filters == (
+        ("route", frozenset({"Oral", "Topical"})),
+        ("approved", frozenset({"True"})),
+    )
+    assert ListFilter.parse(list_filter) is list_filter
+
+
+@pytest.mark.parametrize(
+    "value", ["drugbank.products", "products:route=Oral", "drugbank.products:route"]
+)
+def test_invalid_list_filter(value):
+    with pytest.raises(OptionError):
+        ListFilter.parse(value)
+
+
+def test_list_filter_keeps_matching_items_in_order():
+    products = [
+        {"name": "a", "route": "Oral", "approved": True},
+        {"name": "b", "route": "Oral", "approved": False},
+        "not a dict",
+        {"name": "c", "route": "Topical", "approved": True},
+        {"name": "d", "approved": True},
+    ]
+    response = es_response(
+        {"drugbank": {"products": products}},
+        {"drugbank": {"products": {"name": "e", "route": "Oral", "approved": True}}},
+        {"chembl": {"products": products}},
+    )
+
+    result = MyChemESResultFormatter().transform(
+        response, list_filter="drugbank.products:route=Oral,Topical|approved=True"
+    )
+
+    assert [p["name"] for p in result["hits"][0]["drugbank"]["products"]] == ["a", "c"]
+    assert [p["name"] for p in result["hits"][1]["drugbank"]["products"]] == ["e"]
+    assert result["hits"][2]["chembl"]["products"] == products
+
+
+def test_list_filter_descends_through_lists():
+    response = es_response(
+        {
+            "chembl": [
+                {"drug_indications": [{"max_phase": 4}, {"max_phase": 2}]},
+                {"drug_indications": {"max_phase": 2}},
+            ]
+        }
+    )
+
+    result = MyChemESResultFormatter().transform(
+        response, list_filter="chembl.drug_indications:max_phase=4"
+    )
+
+    chembl = result["hits"][0]["chembl"]
+    assert chembl[0]["drug_indications"] == [{"max_phase": 4}]
+    assert chembl[1]["drug_indications"] == []
+
+
+class NestedMetadata:
+    def get_mappings(self, biothing_type):
+        return {
+            "drugbank": {
+                "properties": {
+                    "products": {
+                        "type": "nested",
+                        "properties": {"route": {"type": "keyword"}, "dosage": {"type": "text"}},
+                    },
+                    "targets": {"properties": {"actions": {"type": "keyword"}}},
+                }
+            }
+        }
+
+
+@pytest.mark.parametrize(
+    "value, options, nested",
+    [
+        ("drugbank.products:route=Oral", {}, True),
+        ("drugbank.products:route=Oral", {"_source": ["drugbank"]}, True),
+        ("drugbank.products:route=Oral", {"_source": ["chembl"]}, False),
+        ("drugbank.products:route=Oral,", {}, False),
+        ("drugbank.products:dosage=Tablet", {}, False),
+        ("drugbank.targets:actions=inhibitor", {}, False),
+    ],
+)
+def test_nested_list_filter_pushdown(value, options, nested):
+    builder = MyChemQueryBuilder(metadata=NestedMetadata())
+
+    list_filter = builder.nested_list_filter(ListFilter.parse(value), options)
+
+    assert isinstance(list_filter, NestedListFilter) is nested
+
+
+def test_nested_list_filter_query():
+    builder = MyChemQueryBuilder(metadata=NestedMetadata())
+    list_filter = builder.nested_list_filter(ListFilter.parse("drugbank.products:route=Oral,Topical"), {})
+
+    search = builder.build("aspirin", list_filter=list_filter, _source=["drugbank", "-drugbank.packagers"])
+    query = search.to_dict()
+
+    assert query["_source"]["excludes"] == ["drugbank.packagers", "drugbank.products"]
+    nested = query["query"]["bool"]["should"][0]["nested"]
+    assert nested["path"] == "drugbank.products"
+    assert nested["query"] == {"bool": {"filter": [{"terms": {"drugbank.products.route": ["Oral", "Topical"]}}]}}
+    assert nested["inner_hits"] == {"name": "drugbank.products", "size": 100}
+
+
+def test_nested_list_filter_restores_inner_hits_in_order():
+    response = es_response({"name": "aspirin", "drugbank": {"id": "DB00945"}})
+    response["hits"]["hits"][0]["inner_hits"] = {
+        "drugbank.products": {
+            "hits": {
+                "total": {"value": 2, "relation": "eq"},
+                "hits": [
+                    {"_nested": {"field": "products", "offset": 7}, "_source": {"name": "b", "route": "Oral"}},
+                    {"_nested": {"field": "products", "offset": 2}, "_source": {"name": "a", "route": "Oral"}},
+                ],
+            }
+        }
+    }
+    list_filter = NestedListFilter("drugbank", "products", [("route", frozenset({"Oral"}))], 100)
+
+    result = MyChemESResultFormatter().transform(response, list_filter=list_filter)
+
+    assert "inner_hits" not in result["hits"][0]
+    assert [p["name"] for p in result["hits"][0]["drugbank"]["products"]] == ["a", "b"]
+
+
+def test_list_page_follows_list_filter():
+    products = [{"name": str(index), "route": "Oral" if index % 2 else "Topical"} for index in range(10)]
+    response = es_response({"drugbank": {"products": products}}, {"drugbank": [{"products": products[:3]}, {}]})
+
+    result = MyChemESResultFormatter().transform(
+        response, list_filter="drugbank.products:route=Oral", list_offset=1, list_limit=2
+    )
+
+    assert [p["name"] for p in result["hits"][0]["drugbank"]["products"]] == ["3", "5"]
+    assert result["hits"][0]["_list_total"] == 5
+    assert [p["name"] for p in result["hits"][1]["drugbank"][0]["products"]] == []
+    assert result["hits"][1]["_list_total"] == 1
+
+
+@pytest.mark.parametrize(
+    "options",
+    [{"list_offset": 1}, {"list_limit": 1, "list_field": "a.b", "list_offset": -1}],
+)
+def test_invalid_list_page(options):
+    with pytest.raises(OptionError):
+        ListPage.parse(options)
+
+
+def test_script_list_page():
+    builder = MyChemQueryBuilder(metadata=NestedMetadata())
+    options = {"list_field": "drugbank.products", "list_offset": 100, "list_limit": 50, "_source": ["drugbank"]}
+    list_page = builder.script_list_page(ListPage.parse(options), options)
+    assert isinstance(list_page, ScriptListPage)
+    for other in ({**options, "_source": ["chembl"]}, {**options, "list_filter": "drugbank.products:route=Oral"}):
+        assert not isinstance(builder.script_list_page(ListPage.parse(other), other), ScriptListPage)
+
+    query = builder.build("aspirin", list_page=list_page, _source=["drugbank"]).to_dict()
+
+    assert query["_source"]["excludes"] == ["drugbank.products"]
+    params = query["script_fields"]["_list_page"]["script"]["params"]
+    assert params == {"parent_path": ["drugbank"], "list_field": "products", "offset": 100, "limit": 50}
+
+    response = es_response({"drugbank": {"id": "DB00945"}})
+    response["hits"]["hits"][0]["fields"] = {"_list_page": [{"total": 120, "items": [{"name": "a"}]}]}
+    result = MyChemESResultFormatter().transform(response, list_page=list_page)
+
+    assert result["hits"][0]["drugbank"]["products"] == [{"name": "a"}]
+    assert result["hits"][0]["_list_total"] == 120
+    assert "fields" not in result["hits"][0]
+
+
+DOCS = [
+    {"_id": "BSYNRYMUTXBXSQ-UHFFFAOYSA-N", "chembl": {"molecule_chembl_id": "CHEMBL25"}, "drugbank": {"id": "DB00945"}},
+    {"_id": "XREF", "unichem": {"drugbank": "DB00945"}},
+    {
+        "_id": "OTHER",
+        "drugbank": {"id": "DB00001", "name": "lepirudin", "products": [{"name": "a"}, {"name": "b"}, {"name": "c"}]},
+    },
+]
+
+
+def lookup(doc, field):
+    values = [doc]
+    for key in field.split("."):
+        values = [value[key] for value in values if isinstance(value, dict) and key in value]
+    return [str(value) for value in values]
+
+
+def matches(doc, query):
+    (kind, params), = query.items()
+    if kind == "bool":
+        return all(matches(doc, q) for q in params.get("must", ())) and any(
+            matches(doc, q) for q in params.get("should", ())
+        )
+    if kind == "terms":
+        (field, terms), = params.items()
+        return any(value.lower() in terms or value in terms for value in lookup(doc, field))
+    if kind == "multi_match":
+        return any(value.lower() == params["query"].lower() for f in params["fields"] for value in lookup(doc, f))
+    raise NotImplementedError(kind)
+
+
+class BatchBackend:
+    """Execute the searches of a multisearch on DOCS, recording them."""
+
+    def __init__(self):
+        self.searches = []
+
+    async def execute(self, query, **options):
+        searches = query.to_dict()[1::2]
+        self.searches.extend(searches)
+        responses = []
+        for search in searches:
+            hits = []
+            for doc in DOCS:
+                if matches(doc, search["query"]):
+                    source = {key: value for key, value in doc.items() if key != "_id"}
+                    hit = {"_id": doc["_id"], "_score": 1.0, "_source": source}
+                    if "script_fields" in search:
+                        # the ScriptListPage of a list of a top-level object
+                        params = search["script_fields"]["_list_page"]["script"]["params"]
+                        (parent_key,) = params["parent_path"]
+                        parent = source[parent_key] = dict(source[parent_key])
+                        items = parent.pop(params["list_field"])
+                        page = items[params["offset"]:params["offset"] + params["limit"]]
+                        hit["fields"] = {"_list_page": [{"total": len(items), "items": page}]}
+                    if "docvalue_fields" in search:
+                        values = {f: [v.lower() for v in lookup(doc, f)] for f in search["docvalue_fields"]}
+                        hit.setdefault("fields", {}).update((f, v) for f, v in values.items() if v)
+                    hits.append(hit)
+            total = {"value": len(hits), "relation": "eq"}
+            responses.append({"took": 1, "hits": {"total": total, "hits": hits[: search.get("size", 10)]}})
+        if options.get("raw"):
+            raise RawResultInterrupt(responses)
+        return responses
+
+
+def batch_pipeline():
+    keyword = {"type": "keyword", "normalizer": "keyword_lowercase_normalizer"}
+    metadata = BiothingsMetadata()
+    metadata.biothing_metadata["chem"] = {"_biothing": "chem"}
+    metadata.biothing_mappings["chem"] = {
+        "chembl": {"properties": {"molecule_chembl_id": keyword}},
+        "drugbank": {"properties": {"id": keyword, "name": {"type": "text"}}},
+        "unichem": {"properties": {"drugbank": keyword}},
+        "chebi": {"properties": {"xrefs": {"properties": {"drugbank": keyword}}}},
+        "drugcentral": {"properties": {"xrefs": {"properties": {"drugbank_id": keyword}}}},
+        "pharmgkb": {"properties": {"xrefs": {"properties": {"drugbank": keyword}}}},
+    }
+    builder = MyChemQueryBuilder(scopes_regexs=config_web.ANNOTATION_ID_REGEX_LIST, metadata=metadata)
+    return MyChemQueryPipeline(builder, BatchBackend(), MyChemESResultFormatter())
+
+
+def test_batch_ids_are_grouped_by_fields():
+    pipeline = batch_pipeline()
+    ids = [
+        "DB00945",
+        "chembl25",
+        "DRUGBANK:DB00001",
+        "BSYNRYMUTXBXSQ-UHFFFAOYSA-N",
+        "db00002",
+        "drugbank.name:lepirudin",
+        "CHEMBL.COMPOUND:CHEMBL25",
+    ]
+
+    result = asyncio.run(pipeline.fetch(ids, biothing_type="chem", _source=["drugbank.id"]))
+
+    # drugbank ids, chembl ids, _id and the text field
+    assert len(pipeline.backend.searches) == 4
+    assert pipeline.backend.searches[0]["query"]["bool"]["should"][0] == {
+        "terms": {"drugbank.id": ["db00945", "db00001", "db00002"]}
+    }
+    assert [(hit["query"], hit.get("_id")) for hit in result] == [
+        ("DB00945", "BSYNRYMUTXBXSQ-UHFFFAOYSA-N"),
+        ("DB00945", "XREF"),
+        ("chembl25", "BSYNRYMUTXBXSQ-UHFFFAOYSA-N"),
+        ("DRUGBANK:DB00001", "OTHER"),
+        ("BSYNRYMUTXBXSQ-UHFFFAOYSA-N", "BSYNRYMUTXBXSQ-UHFFFAOYSA-N"),
+        ("db00002", None),
+        ("drugbank.name:lepirudin", "OTHER"),
+        ("CHEMBL.COMPOUND:CHEMBL25", "BSYNRYMUTXBXSQ-UHFFFAOYSA-N"),
+    ]
+    assert result[5]["notfound"] is True
+    assert "fields" not in result[0]
+    assert result[2] is not result[7]
+
+
+def test_batch_ids_keep_their_script_list_page():
+    pipeline = batch_pipeline()
+    options = {"list_field": "drugbank.products", "list_offset": 1, "list_limit": 1, "list_filter_mode": "es"}
+
+    result = asyncio.run(pipeline.fetch(["DB00001", "db00001"], biothing_type="chem", _source=["drugbank"], **options))
+
+    # both ids in one group search, paged by Elasticsearch
+    assert len(pipeline.backend.searches) == 1
+    assert "_list_page" in pipeline.backend.searches[0]["script_fields"]
+    for hit in result:
+        assert hit["drugbank"]["products"] == [{"name": "b"}]
+        assert hit["_list_total"] == 3
+        assert "fields" not in hit
+
+
+def test_raw_batch_is_searched_per_id():
+    pipeline = batch_pipeline()
+    ids = ["DB00945", "chembl25", "DB00001"]
+
+    with pytest.raises(QueryPipelineInterrupt) as exc:
+        asyncio.run(pipeline.fetch(ids, biothing_type="chem", raw=True))
+
+    # one raw response per id, in their order, not per group
+    assert len(pipeline.backend.searches) == 3
+    assert [[hit["_id"] for hit in res["hits"]["hits"]] for res in exc.value.details] == [
+        ["BSYNRYMUTXBXSQ-UHFFFAOYSA-N", "XREF"],
+        ["BSYNRYMUTXBXSQ-UHFFFAOYSA-N"],
+        ["OTHER"],
+    ]
+
+    with pytest.raises(QueryPipelineInterrupt) as exc:
+        asyncio.run(pipeline.fetch(ids, biothing_type="chem", rawquery=True))
+    assert len(exc.value.details) == 2 * len(ids)
+
+
+def test_batch_group_overflow_is_searched_per_id():
+    pipeline = batch_pipeline()
+
+    result = asyncio.run(pipeline.search(["DB00945", "DB00001"], biothing_type="chem", autoscope=True, size=1))
+
+    # three hits do not fit in the group search, sized for one hit per id
+    assert len(pipeline.backend.searches) == 3
+    assert [(hit["query"], hit["_id"]) for hit in result] == [
+        ("DB00945", "BSYNRYMUTXBXSQ-UHFFFAOYSA-N"),
+        ("DB00001", "OTHER"),
+    ]
+
+
+def test_stream_yields_chunks_in_query_order():
+    pipeline = batch_pipeline()
+    ids = ["DB00945", "chembl25", "DRUGBANK:DB00001", "db00002", "CHEMBL.COMPOUND:CHEMBL25"]
+    options = dict(biothing_type="chem", autoscope=True)
+
+    async def stream():
+        return [result async for result in pipeline.search_stream(ids, chunk_size=2, **options)]
+
+    chunks = asyncio.run(stream())
+
+    assert [sorted({hit["query"] for hit in chunk}, key=ids.index) for chunk in chunks] == [
+        ["DB00945", "chembl25"],
+        ["DRUGBANK:DB00001", "db00002"],
+        ["CHEMBL.COMPOUND:CHEMBL25"],
+    ]
+    assert [hit for chunk in chunks for hit in chunk] == asyncio.run(pipeline.search(ids, **options))
+
+
+def test_ndjson_post_with_total_is_answered_as_json(monkeypatch):
+    async def post(handler, *args, **kwargs):
+        handler.posted = handler.format
+
+    monkeypatch.setattr(QueryHandler, "post", post)
+    handler = MyChemQueryHandler.__new__(MyChemQueryHandler)
+    handler.format = "ndjson"
+    # the totals wrap the hits of the queries in a dict, not lines
+    handler.args = dotdict(q=["DB00945", "chembl25"], with_total=True)
+    handler.pipeline = batch_pipeline()
+    asyncio.run(handler.post())
+
+    assert handler.posted == "json"
+    assert handler.pipeline.backend.searches == []
+
+
+class PitClient:
+    """Page through DOCS sorted by position with points in time, like Elasticsearch."""
+
+    def __init__(self):
+        self.pits = {}
+        self.searches = []
+
+    async def open_point_in_time(self, index, keep_alive):
+        pit_id = f"pit{len(self.pits)}"
+        self.pits[pit_id] = True
+        return {"id": pit_id}
+
+    async def close_point_in_time(self, body):
+        self.pits[body["id"]] = False
+        return {"succeeded": True}
+
+    async def search(self, body, **params):
+        from elasticsearch import NotFoundError
+
+        self.searches.append(body)
+        if not self.pits.get(body["pit"]["id"]):
+            raise NotFoundError("search_context_missing_exception", None, None)
+        start = body["search_after"][0] + 1 if "search_after" in body else 0
+        sliced = body.get("slice", {"id": 0, "max": 1})
+        hits = [
+            {"_id": doc["_id"], "_score": None, "_source": {}, "sort": [position]}
+            for position, doc in enumerate(DOCS)
+            if position >= start and position % sliced["max"] == sliced["id"]
+        ][:body["size"]]
+        return {"pit_id": body["pit"]["id"], "hits": {"total": len(DOCS), "hits": hits}}
+
+
+def test_fetch_all_pages_through_a_point_in_time():
+    client = PitClient()
+    backend = MyChemESQueryBackend(client, {"chem": "mychem_current"}, scroll_size=2)
+    backend.token_secret = "secret"
+    pipeline = MyChemQueryPipeline(batch_pipeline().builder, backend, MyChemESResultFormatter())
+    options = dict(biothing_type="chem", fields=["_id"])
+
+    async def fetch_all():
+        ids = []
+        result = await pipeline.search("__all__", fetch_all=True, **options)
+        while True:
+            ids.extend(hit["_id"] for hit in result["hits"])
+            try:
+                result = await pipeline.search(None, scroll_id=result["_scroll_id"], **options)
+            except QueryPipelineInterrupt as exc:
+                return ids, exc.details
+
+    ids, end = asyncio.run(fetch_all())
+
+    assert ids == [doc["_id"] for doc in DOCS]
+    assert end == {"success": False, "error": "No more results to return."}
+    assert client.searches[0]["sort"] == ["_shard_doc"]
+    assert client.searches[0]["pit"]["keep_alive"] == "1m"
+    # closed with the last page, without searching it again
+    assert client.pits == {"pit0": False}
+    assert len(client.searches) == len(DOCS) // 2 + 1
+
+
+def test_fetch_all_stale_token():
+    client = PitClient()
+    backend = MyChemESQueryBackend(client, {"chem": "mychem_current"}, scroll_size=1)
+    backend.token_secret = "secret"
+    pipeline = MyChemQueryPipeline(batch_pipeline().builder, backend, MyChemESResultFormatter())
+
+    result = asyncio.run(pipeline.search("__all__", fetch_all=True, biothing_type="chem"))
+    client.pits["pit0"] = False  # expired
+
+    for scroll_id in (result["_scroll_id"], "pit:invalid"):
+        with pytest.raises(QueryPipelineException) as exc:
+            asyncio.run(pipeline.search(None, scroll_id=scroll_id, biothing_type="chem"))
+        assert exc.value.details == "Invalid or stale scroll_id."
+
+
+def test_fetch_all_tampered_token():
+    client = PitClient()
+    backend = MyChemESQueryBackend(client, {"chem": "mychem_current"}, scroll_size=1)
+    backend.token_secret = "secret"
+    pipeline = MyChemQueryPipeline(batch_pipeline().builder, backend, MyChemESResultFormatter())
+
+    token = asyncio.run(pipeline.search("__all__", fetch_all=True, biothing_type="chem"))["_scroll_id"]
+    body, pit_id, search_after = backend.decode_token(token)
+    backend.token_secret = "another secret"
+    forged = backend.encode_token(dict(body, size=10000), pit_id, search_after)
+    backend.token_secret = "secret"
+    # the search of the token, with the signature of the original one
+    edited = forged.split(".")[0] + "." + token.split(".")[1]
+
+    for scroll_id in (forged, edited, forged.split(".")[0]):
+        with pytest.raises(QueryPipelineException) as exc:
+            asyncio.run(pipeline.search(None, scroll_id=scroll_id, biothing_type="chem"))
+        assert exc.value.code == 400
+        assert exc.value.details == "Invalid or stale scroll_id."
+    assert len(client.searches) == 1
+
+
+def test_export_scans_slices_of_a_point_in_time():
+    client = PitClient()
+    backend = MyChemESQueryBackend(client, {"chem": "mychem_current"})
+    pipeline = MyChemQueryPipeline(batch_pipeline().builder, backend, MyChemESResultFormatter())
+
+    async def export():
+        return [hits async for hits in pipeline.export("__all__", slices=2, size=1, biothing_type="chem")]
+
+    pages = asyncio.run(export())
+
+    assert all(len(hits) == 1 for hits in pages)
+    assert sorted(hits[0]["_id"] for hits in pages) == sorted(doc["_id"] for doc in DOCS)
+    assert {search["slice"]["id"] for search in client.searches} == {0, 1}
+    assert client.pits == {"pit0": False}
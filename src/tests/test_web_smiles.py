@@ -0,0 +1,36 @@
+import sys
+from pathlib import Path
+
+import pytest
+
+SOURCE_ROOT = Path(__file__).parents[1]
+if str(SOURCE_ROOT) not in sys.path:
+    sys.path.insert(0, str(SOURCE_ROOT))
+
+from shared.smiles import doc_hashes, query_hash, smiles_hash  # noqa: E402
+
+ASPIRIN = "CC(=O)OC1=CC=CC=C1C(=O)O"
+
+
+def test_doc_hashes_cover_all_sources():
+    doc = {
+        "chembl": {"smiles": ASPIRIN},
+        "unii": [{"smiles": f" {ASPIRIN} "}],
+        "drugcentral": {"structures": {"smiles": "CCO"}},
+    }
+
+    hashes = doc_hashes(doc)
+
+    assert smiles_hash(ASPIRIN) in hashes
+    assert smiles_hash("CCO") in hashes
+    assert query_hash(ASPIRIN) in hashes
+    assert query_hash(" CCO\n") in hashes
+    assert len(hashes) == len(set(hashes))
+
+
+def test_equivalent_smiles_have_the_same_hash():
+    pytest.importorskip("rdkit")
+    doc = {"chebi": {"smiles": ASPIRIN}}
+
+    assert query_hash("OC(=O)c1ccccc1OC(C)=O") in doc_hashes(doc)
+    assert query_hash("OC(=O)c1ccccc1OC(C)=O") == query_hash(ASPIRIN)
@@ -0,0 +1,66 @@
+import random
+import sys
+from collections import Counter
+from pathlib import Path
+
+SOURCE_ROOT = Path(__file__).parents[1]
+if str(SOURCE_ROOT) not in sys.path:
+    sys.path.insert(0, str(SOURCE_ROOT))
+
+from shared.suggest import SuggestWriter, Suggestions, suggest_key  # noqa: E402
+
+FIELDS = ["chembl.pref_name", "drugbank.name", "drugbank.synonyms", "unii.display_name"]
+DOCS = [
+    {
+        "_id": "BSYNRYMUTXBXSQ-UHFFFAOYSA-N",
+        "chembl": {"pref_name": "ASPIRIN"},
+        "drugbank": {"name": "Acetylsalicylic acid", "synonyms": ["Aspirin", "acetylsalicylic  acid"]},
+        "unii": {"display_name": "ASPIRIN"},
+    },
+    {"_id": "ASPIRIN-ALUMINUM", "chembl": {"pref_name": "ASPIRIN ALUMINUM"}},
+    {"_id": "OTHER", "drugbank": {"name": "Aspirin"}},
+    {"_id": "CONTROL", "drugbank": {"name": "Aspi\x01rin"}},
+]
+
+
+def test_suggestions_are_ranked_by_sources(tmp_path):
+    path = str(tmp_path / "mychem.suggest")
+    # one name per chunk, merged when the writer is closed
+    with SuggestWriter(path, FIELDS, chunk_size=1) as writer:
+        for doc in reversed(DOCS):
+            writer.add_doc(doc)
+
+    suggestions = Suggestions(path)
+
+    assert len(suggestions) == 3
+    assert suggestions.suggest("asp") == [
+        # chembl, drugbank and unii in the first document, drugbank in the other
+        {"name": "ASPIRIN", "_id": "BSYNRYMUTXBXSQ-UHFFFAOYSA-N", "score": 4},
+        {"name": "ASPIRIN ALUMINUM", "_id": "ASPIRIN-ALUMINUM", "score": 1},
+    ]
+    assert suggestions.suggest(" ASPIRIN  a", size=1) == [
+        {"name": "ASPIRIN ALUMINUM", "_id": "ASPIRIN-ALUMINUM", "score": 1}
+    ]
+    assert suggestions.suggest("acetylsalicylic a")[0]["score"] == 1
+    assert suggestions.suggest("b") == []
+    assert suggestions.suggest("") == []
+    suggestions.close()
+    assert not list(tmp_path.glob("*.tmp"))
+
+
+def test_suggestions_of_long_prefixes_match_a_scan(tmp_path):
+    rng = random.Random(0)
+    names = ["".join(rng.choice("abc") for _ in range(rng.randint(1, 8))) for _ in range(3000)]
+    path = str(tmp_path / "mychem.suggest")
+    with SuggestWriter(path, ["drugbank.synonyms"], top=5, scan_limit=10, max_prefix_length=3) as writer:
+        for index, name in enumerate(names):
+            writer.add_doc({"_id": str(index), "drugbank": {"synonyms": [name]}})
+    scores = Counter(names)
+
+    suggestions = Suggestions(path)
+
+    for prefix in ["a", "ab", "abc", "abca", "cc", "abcabc", "d"]:
+        expected = sorted((name for name in scores if name.startswith(prefix)), key=lambda name: (-scores[name], name))
+        for size in (1, 5, 8):
+            assert [suggestion["name"] for suggestion in suggestions.suggest(prefix, size)] == expected[:size]
+    assert suggest_key("Aspi\trin") == "aspi rin"
@@ -0,0 +1,101 @@
+import asyncio
+import sys
+from pathlib import Path
+from types import SimpleNamespace
+
+SOURCE_ROOT = Path(__file__).parents[1]
+if str(SOURCE_ROOT) not in sys.path:
+    sys.path.insert(0, str(SOURCE_ROOT))
+
+from biothings.web.query.pipeline import QueryPipelineException  # noqa: E402
+
+from web.warmup import WarmUp  # noqa: E402
+
+
+class Client:
+    def __init__(self, status_error=None):
+        self.infos = 0
+        self.gets = []
+        self.status_error = status_error
+
+    async def info(self):
+        self.infos += 1
+        return {}
+
+    async def get(self, index, id):
+        if self.status_error:
+            raise self.status_error
+        self.gets.append((index, id))
+        return {"_index": index, "_id": id, "found": True}
+
+
+class Metadata:
+    types = ("chem", "drug")
+
+    def __init__(self):
+        self.refreshed = []
+
+    async def refresh(self, biothing_type):
+        self.refreshed.append(biothing_type)
+
+
+class Pipeline:
+    def __init__(self, found):
+        self.found = found
+        self.fetched = []
+
+    async def fetch(self, id):
+        self.fetched.append(id)
+        if isinstance(id, list):
+            return [{"query": _id, "_id": _id} if _id in self.found else {"query": _id, "notfound": True} for _id in id]
+        if id not in self.found:
+            raise QueryPipelineException(404, "NotFound", id)
+        return {"_id": id}
+
+
+def biothings_namespace(client, ids):
+    config = SimpleNamespace(
+        STATUS_CHECK={"id": "penicillin", "index": "mychem_current"},
+        ES_INDICES={"chem": "mychem_test"},
+        WARMUP_CONNECTIONS=3,
+        WARMUP_IDS=ids,
+    )
+    return SimpleNamespace(
+        config=config,
+        elasticsearch=SimpleNamespace(async_client=client),
+        metadata=Metadata(),
+        pipeline=Pipeline(found={"DB00945"}),
+    )
+
+
+def test_warm_up_runs_every_step_once():
+    biothings = biothings_namespace(Client(), ["DB00945", "CHEMBL0"])
+    warm_up = WarmUp.of(biothings)
+    assert WarmUp.of(biothings) is warm_up
+
+    async def run():
+        assert not warm_up.done
+        task = warm_up.start()
+        assert warm_up.start() is task
+        await task
+
+    asyncio.run(run())
+
+    assert warm_up.done
+    assert biothings.elasticsearch.async_client.infos == 3
+    assert biothings.elasticsearch.async_client.gets == [("mychem_test", "penicillin")]
+    assert biothings.metadata.refreshed == ["chem", "drug"]
+    # the id missing from the build does not stop the others
+    assert biothings.pipeline.fetched == ["DB00945", "CHEMBL0", ["DB00945", "CHEMBL0"]]
+    assert set(warm_up.timings) == {"connections", "status_check", "metadata", "ids", "total"}
+
+
+def test_warm_up_skips_failed_steps():
+    biothings = biothings_namespace(Client(status_error=ConnectionError("refused")), ["DB00945"])
+    warm_up = WarmUp(biothings)
+
+    asyncio.run(warm_up.run())
+
+    assert "status_check" in warm_up.timings
+    assert biothings.metadata.refreshed == ["chem", "drug"]
+    assert biothings.pipeline.fetched == ["DB00945", ["DB00945"]]
@@ -0,0 +1,180 @@
+import asyncio
+import logging
+import time
+from collections import OrderedDict
+
+from biothings.utils import serializer
+
+logger = logging.getLogger(__name__)
+
+
+class BuildCheck:
+    """
+    The build of the index behind ES_INDICES["chem"], told by the index
+    the STATUS_CHECK document is read from, as the alias points to a new
+    index for every build. It is read again at most every interval
+    seconds.
+    """
+
+    def __init__(self, status_check, interval=60):
+        self.status_check = status_check
+        self.interval = interval
+        self.build = None
+        self._checked = float("-inf")
+
+    async def check(self, client):
+        """Return the current build, None until it could be read."""
+        now = time.monotonic()
+        if now - self._checked < self.interval:
+            return self.build
+        self._checked = now
+        try:
+            document = await client.get(**self.status_check)
+        except Exception as exc:  # keep serving, the next check may succeed
+            logger.warning("Cannot check the build of %s: %s", self.status_check["index"], exc)
+            return self.build
+        self.build = document["_index"]
+        return self.build
+
+
+class AnnotationCache:
+    """
+    A bounded LRU cache of annotation results, with a time to live,
+    cleared when the index behind ES_INDICES["chem"] is replaced by
+    another build, see BuildCheck.
+    """
+
+    MISSING = object()
+
+    def __init__(self, max_entries, max_bytes, ttl, status_check=None, build_check_interval=60):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.build_check = BuildCheck(status_check, build_check_interval) if status_check else None
+
+        self.build = None
+        # {key: (expiry, size, value)}, least recently used first
+        self._entries = OrderedDict()
+        self.bytes = 0
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+
+    @classmethod
+    def from_config(cls, config):
+        """Return the AnnotationCache configured in config_web, or None if it is disabled."""
+        if not getattr(config, "ANNOTATION_CACHE_SIZE", 0):
+            return None
+        return cls(
+            config.ANNOTATION_CACHE_SIZE,
+            config.ANNOTATION_CACHE_MAX_BYTES,
+            config.ANNOTATION_CACHE_TTL,
+            dict(config.STATUS_CHECK, index=config.ES_INDICES["chem"]),
+            config.ANNOTATION_CACHE_BUILD_CHECK_INTERVAL,
+        )
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, key):
+        """Return the value cached for key, or AnnotationCache.MISSING."""
+        entry = self._entries.get(key)
+        if entry is not None and entry[0] < time.monotonic():
+            self._remove(key)
+            entry = None
+        if entry is None:
+            self.misses += 1
+            return self.MISSING
+        self._entries.move_to_end(key)
+        self.hits += 1
+        return entry[2]
+
+    def put(self, key, value):
+        # the size of the serialized value, as an estimate of its memory use
+        size = len(serializer.to_json(value))
+        if size > self.max_bytes:
+            return
+        if key in self._entries:
+            self._remove(key)
+        self._entries[key] = (time.monotonic() + self.ttl, size, value)
+        self.bytes += size
+        while len(self._entries) > self.max_entries or self.bytes > self.max_bytes:
+            self._remove(next(iter(self._entries)))
+            self.evictions += 1
+
+    def _remove(self, key):
+        _, size, _ = self._entries.pop(key)
+        self.bytes -= size
+
+    def clear(self):
+        self._entries.clear()
+        self.bytes = 0
+
+    async def check_build(self, client):
+        """Clear the cache if the index has changed since the last check."""
+        if self.build_check is None:
+            return
+        build = await self.build_check.check(client)
+        if build is not None and build != self.build:
+            if self.build is not None:
+                logger.info("Index changed from %s to %s, clearing the annotation cache.", self.build, build)
+                self.invalidations += 1
+            self.build = build
+            self.clear()
+
+    def stats(self):
+        return {
+            "build": self.build,
+            "entries": len(self._entries),
+            "bytes": self.bytes,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "invalidations": self.invalidations,
+        }
+
+
+class SingleFlight:
+    """
+    Share one in-flight fetch between the identical concurrent requests,
+    keyed like the AnnotationCache. The requests arriving while the
+    first one is waiting for Elasticsearch wait for its result, or its
+    error, instead of sending the same query again.
+    """
+
+    def __init__(self):
+        # {key: future of the fetch}
+        self._flights = {}
+        self.calls = 0
+        self.collapsed = 0
+
+    def __len__(self):
+        return len(self._flights)
+
+    async def run(self, key, fetch):
+        """Return the result of fetch(), a coroutine function, or of the same fetch in flight for key."""
+        self.calls += 1
+        future = self._flights.get(key)
+        if future is not None:
+            self.collapsed += 1
+        else:
+            future = asyncio.ensure_future(fetch())
+            self._flights[key] = future
+            future.add_done_callback(lambda future: self._land(key, future))
+        # a cancelled request must not cancel the fetch of the others
+        return await asyncio.shield(future)
+
+    def _land(self, key, future):
+        self._flights.pop(key, None)
+        # retrieved here too, in case all the requests waiting for it are gone
+        if not future.cancelled():
+            future.exception()
+
+    def stats(self):
+        return {
+            "in_flight": len(self._flights),
+            "calls": self.calls,
+            "collapsed": self.collapsed,
+        }
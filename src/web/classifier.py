@@ -0,0 +1,83 @@
+import re
+
+from biothings.web.query.builder import Query
+
+
+def _as_list(fields):
+    if isinstance(fields, str):
+        return [fields]
+    return list(fields)
+
+
+class AnnotationIdClassifier:
+    """
+    Route annotation ids to the fields they are searched in, with the
+    same result as trying the ANNOTATION_ID_REGEX_LIST patterns in turn.
+
+    Ids like "<prefix>:<term>" are dispatched on their case-insensitive
+    prefix and only try the term patterns registered for it, bare ids
+    try the bare patterns as a single alternation, in order. Any other
+    id, e.g. with an unknown prefix, goes through the patterns in turn.
+
+    It iterates over the patterns, so that it can be configured as
+    ANNOTATION_ID_REGEX_LIST and still be used as a list of patterns.
+    """
+
+    def __init__(self, patterns, prefixes, bare_patterns, default_pattern, default_scopes=("_id",)):
+        # [(compiled regex, [field, ...]), ...] as QStringParser builds them
+        self.patterns = [(re.compile(regex), _as_list(fields)) for regex, fields in patterns]
+        # {prefix: [(compiled term regex, [field, ...]), ...]}
+        self.prefixes = {
+            prefix.lower(): [(re.compile(term_regex, re.I), _as_list(fields)) for term_regex, fields in term_patterns]
+            for prefix, term_patterns in prefixes.items()
+        }
+        # one alternation of the bare patterns, the group of each alternative is its index
+        self.bare_regex = re.compile(
+            "|".join(f"(?P<_{index}>{regex})" for index, (regex, _) in enumerate(bare_patterns)), re.I
+        )
+        self.bare_fields = [_as_list(fields) for _, fields in bare_patterns]
+        self.default_regex = re.compile(default_pattern[0])
+        self.default_scopes = list(default_scopes)
+
+    def __iter__(self):
+        return iter(self.patterns)
+
+    def __len__(self):
+        return len(self.patterns)
+
+    def _query(self, query, match, fields):
+        # the same precedence as QStringParser: term group over the whole id,
+        # scope group over the pattern fields over the default scopes.
+        named_groups = match.groupdict()
+        scopes = named_groups.get("scope") or fields or self.default_scopes
+        if not isinstance(scopes, (list, tuple)):
+            scopes = [scopes]
+        return Query(named_groups.get("term") or query, scopes)
+
+    def classify(self, query):
+        """Return the Query, i.e. (term, scopes), an annotation id is searched with."""
+        prefix, colon, term = query.partition(":")
+        if not colon:
+            match = self.bare_regex.fullmatch(query)
+            if match:
+                return Query(query, self.bare_fields[int(match.lastgroup[1:])])
+            return Query(query, self.default_scopes)
+
+        term_patterns = self.prefixes.get(prefix.lower())
+        # a dot in a registered prefix pattern also matches a colon,
+        # so only the patterns in turn tell where such an id belongs.
+        if term_patterns is not None and ":" not in term:
+            for term_regex, fields in term_patterns:
+                match = term_regex.fullmatch(term)
+                if match:
+                    return self._query(query, match, fields)
+            match = self.default_regex.fullmatch(query)
+            if match:
+                return self._query(query, match, ())
+            return Query(query, self.default_scopes)
+
+        for regex, fields in self.patterns:
+            match = regex.fullmatch(query)
+            if match:
+                return self._query(query, match, fields)
+        return Query(query, self.default_scopes)
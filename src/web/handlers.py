@@ -0,0 +1,554 @@
+import hashlib
+import os
+import re
+import zlib
+
+from biothings.web.handlers import BaseAPIHandler, BaseHandler, BiothingHandler, MetadataSourceHandler, QueryHandler
+from biothings.web.handlers.query import BaseQueryHandler, capture_exceptions, ensure_awaitable
+from biothings.web.handlers.services import StatusHandler
+from biothings.web.query.pipeline import QueryPipelineException
+from tornado.web import HTTPError, RequestHandler
+
+try:
+    import zstandard
+except ImportError:  # compression=zstd is refused then
+    zstandard = None
+
+from shared.crosswalk import Crosswalk, crosswalk_key
+from shared.interactions import Interactions, drug_number
+from shared.smiles import query_hash
+from shared.suggest import Suggestions
+from web.cache import AnnotationCache, BuildCheck, SingleFlight
+from web.metrics import StageMetrics, timed
+from web.pipeline import MyChemESResultFormatter
+from web.warmup import WarmUp
+
+to_json = MyChemESResultFormatter.to_json
+
+
+def _freeze(value):
+    if isinstance(value, dict):
+        return tuple(sorted((key, _freeze(val)) for key, val in value.items()))
+    if isinstance(value, (list, tuple, set)):
+        return tuple(_freeze(val) for val in value)
+    return value
+
+
+def _stage_metrics(biothings):
+    # shared by all the requests of an application, created by its first one
+    if not hasattr(biothings, "stage_metrics"):
+        biothings.stage_metrics = StageMetrics() if getattr(biothings.config, "STAGE_METRICS", False) else None
+    return biothings.stage_metrics
+
+
+class StageMetricsMixin:
+    """
+    Time the stages of the requests of a handler, when STAGE_METRICS is
+    set, in the histograms served at /metrics, and in a Server-Timing
+    response header when STAGE_METRICS_SERVER_TIMING is set too.
+    """
+
+    stage_timings = None
+
+    def prepare(self):
+        super().prepare()
+        if _stage_metrics(self.biothings) is not None:
+            self.stage_timings = StageMetrics.start()
+
+    def write(self, chunk):
+        with timed("serialize"):
+            super().write(chunk)
+
+    def flush(self, include_footers=False):
+        if (
+            self.stage_timings is not None
+            and not self._headers_written
+            and getattr(self.biothings.config, "STAGE_METRICS_SERVER_TIMING", False)
+        ):
+            self.set_header("Server-Timing", self.stage_timings.server_timing())
+        return super().flush(include_footers)
+
+    def on_finish(self):
+        if self.stage_timings is not None:
+            self.biothings.stage_metrics.observe(self.name, self.stage_timings)
+        super().on_finish()
+
+
+class JSONWriteMixin:
+    """Serialize the JSON responses of a handler with MyChemESResultFormatter.to_json."""
+
+    def write(self, chunk):
+        if self.format != "json" or not isinstance(chunk, (dict, list)):
+            return super().write(chunk)
+        self.set_header("Content-Type", "application/json; charset=UTF-8")
+        # past BaseAPIHandler.write, which would serialize it again
+        RequestHandler.write(self, to_json(chunk))
+
+
+def _build_check(biothings):
+    # shared by all the requests of an application, created by its first one
+    if not hasattr(biothings, "build_check"):
+        config = biothings.config
+        biothings.build_check = (
+            BuildCheck(
+                dict(config.STATUS_CHECK, index=config.ES_INDICES["chem"]),
+                getattr(config, "ANNOTATION_CACHE_BUILD_CHECK_INTERVAL", 60),
+            )
+            if getattr(config, "BUILD_ETAGS", False)
+            else None
+        )
+    return biothings.build_check
+
+
+class BuildETagMixin:
+    """
+    Tag the GET responses of a handler, when BUILD_ETAGS is set, with an
+    ETag computed before searching from the build and the request, so
+    that a request whose If-None-Match matches is answered with a 304
+    without searching. The responses of a request only change with the
+    build, except for "took" in those of /query, whose ETags are weak.
+    """
+
+    weak_etag = False
+
+    async def not_modified(self, *key):
+        """Set the ETag of the request identified by key, return True if a 304 was sent."""
+        build_check = _build_check(self.biothings)
+        if build_check is None:
+            return False
+        build = await build_check.check(self.biothings.elasticsearch.async_client)
+        if build is None:
+            return False
+        digest = hashlib.blake2b(repr((build, self.biothing_type, *key)).encode("utf-8"), digest_size=16)
+        self.set_header("Etag", f'{"W/" if self.weak_etag else ""}"{digest.hexdigest()}"')
+        if not self.check_etag_header():
+            return False
+        self.set_status(304)
+        self.finish()
+        return True
+
+
+class MyChemBiothingHandler(BuildETagMixin, StageMetricsMixin, JSONWriteMixin, BiothingHandler):
+    """
+    Subclass of BiothingHandler to serve repeated annotation lookups
+    from the AnnotationCache when ANNOTATION_CACHE_SIZE is set, and to
+    share one fetch between identical concurrent lookups.
+    """
+
+    def initialize(self, *args, **kwargs):
+        super().initialize(*args, **kwargs)
+        # shared by all the requests of an application, created by its first one
+        if not hasattr(self.biothings, "annotation_cache"):
+            self.biothings.annotation_cache = AnnotationCache.from_config(self.biothings.config)
+            self.biothings.annotation_flights = (
+                SingleFlight() if getattr(self.biothings.config, "ANNOTATION_COALESCING", False) else None
+            )
+        self.annotation_cache = self.biothings.annotation_cache
+        self.annotation_flights = self.biothings.annotation_flights
+
+    def annotation_key(self, form, _id):
+        """
+        The cache key of an annotation id, for a GET ("one") or POST
+        ("batch") request, with all the other parameters, such as the
+        fields, list_filter and dotfield.
+        """
+        normalized_id = self.pipeline.builder.normalize_id(_id, self.biothing_type)
+        options = {key: value for key, value in self.args.items() if key != "id"}
+        return form, normalized_id, _freeze(options)
+
+    def _shareable(self):
+        if self.annotation_cache is None and self.annotation_flights is None:
+            return False
+        return bool(self.args.get("id")) and not self.args.raw and not self.args.rawquery
+
+    async def _fetch(self, key, **args):
+        # identical concurrent fetches wait for the first one
+        if self.annotation_flights is None:
+            return await ensure_awaitable(self.pipeline.fetch(**args))
+        return await self.annotation_flights.run(key, lambda: ensure_awaitable(self.pipeline.fetch(**args)))
+
+    @capture_exceptions
+    async def post(self, *args, **kwargs):
+        if not self._shareable():
+            return await super().post(*args, **kwargs)
+        self.event["value"] = len(self.args.id)
+
+        keys = [self.annotation_key("batch", _id) for _id in self.args.id]
+        results = dict.fromkeys(keys, AnnotationCache.MISSING)
+        if self.annotation_cache is not None:
+            await self.annotation_cache.check_build(self.biothings.elasticsearch.async_client)
+            results = {key: self.annotation_cache.get(key) for key in results}
+        missing = {}  # {key: the first id with this key}
+        for _id, key in zip(self.args.id, keys):
+            if results[key] is AnnotationCache.MISSING:
+                missing.setdefault(key, _id)
+
+        if missing:
+            result = await self._fetch(tuple(missing), **dict(self.args, id=list(missing.values())))
+            for key in missing:
+                results[key] = []
+            # the fetch may be shared with a request spelling the ids
+            # differently, its entries are matched by key, not by id
+            for entry in result:
+                key = self.annotation_key("batch", entry["query"])
+                if key in missing:
+                    results[key].append({field: value for field, value in entry.items() if field != "query"})
+            if self.annotation_cache is not None:
+                for key in missing:
+                    self.annotation_cache.put(key, results[key])
+
+        self.finish([dict(query=_id, **entry) for _id, key in zip(self.args.id, keys) for entry in results[key]])
+
+    @capture_exceptions
+    async def get(self, *args, **kwargs):
+        if not self.args.raw and not self.args.rawquery:
+            if await self.not_modified(*self.annotation_key("one", self.args.id)):
+                return
+        if not self._shareable():
+            return await super().get(*args, **kwargs)
+        self.event["value"] = 1
+
+        key = self.annotation_key("one", self.args.id)
+        result = AnnotationCache.MISSING
+        if self.annotation_cache is not None:
+            await self.annotation_cache.check_build(self.biothings.elasticsearch.async_client)
+            result = self.annotation_cache.get(key)
+        if result is AnnotationCache.MISSING:
+            result = await self._fetch(key, **self.args)
+            if self.annotation_cache is not None:
+                self.annotation_cache.put(key, result)
+        self.finish(result)
+
+
+class MyChemQueryHandler(BuildETagMixin, StageMetricsMixin, JSONWriteMixin, QueryHandler):
+    """
+    Subclass of QueryHandler to answer a repeated GET query with a 304,
+    see BuildETagMixin, and to stream the results of a POST query as
+    newline delimited JSON with format=ndjson.
+
+    Each line is one entry of the JSON list of the other formats, in the
+    same order: the entries of a query are consecutive and the queries
+    keep the order they were sent in. The queries are searched
+    QUERY_STREAM_CHUNK_SIZE at a time and every chunk is written as soon
+    as it is found. An error after the first chunk cannot change the
+    response status anymore, it is written as the last line instead.
+    The raw responses, and the totals of with_total, which wrap the
+    list in a dict, are answered as JSON.
+    """
+
+    weak_etag = True
+
+    def initialize(self, *args, **kwargs):
+        super().initialize(*args, **kwargs)
+        # the backend is created without the config, see MyChemESQueryBackend
+        self.pipeline.backend.token_secret = getattr(self.biothings.config, "SCROLL_TOKEN_SECRET", None)
+
+    @capture_exceptions
+    async def get(self, *args, **kwargs):
+        # the scroll ids, the raw responses and the random document of
+        # q=__any__ change with every request
+        if self.args.get("q") != "__any__" and not any(
+            self.args.get(key) for key in ("fetch_all", "scroll_id", "raw", "rawquery")
+        ):
+            if await self.not_modified("query", _freeze(self.args)):
+                return
+        return await super().get(*args, **kwargs)
+
+    @capture_exceptions
+    async def post(self, *args, **kwargs):
+        if self.format != "ndjson" or any(self.args.get(key) for key in ("raw", "rawquery", "with_total")):
+            if self.format == "ndjson":
+                self.format = "json"
+            return await super().post(*args, **kwargs)
+        self.event["value"] = len(self.args.q)
+
+        chunk_size = getattr(self.biothings.config, "QUERY_STREAM_CHUNK_SIZE", 1000)
+        chunks = self.pipeline.search_stream(chunk_size=chunk_size, **self.args)
+        try:
+            async for result in chunks:
+                self.set_header("Content-Type", "application/x-ndjson; charset=UTF-8")
+                self.write(b"".join(to_json(entry) + b"\n" for entry in result))
+                # wait for the client to read the chunk before sending the next one
+                await self.flush()
+        except QueryPipelineException as exc:
+            if not self._headers_written:
+                raise
+            error = {"code": exc.code, "success": False, "error": exc.summary}
+            if isinstance(exc.details, dict):
+                error.update(exc.details)
+            elif exc.details:
+                error["details"] = exc.details
+            self.write(to_json(error) + b"\n")
+        finally:
+            await chunks.aclose()
+        self.finish()
+
+
+class MyChemMetadataSourceHandler(MetadataSourceHandler):
+    """Subclass of MetadataSourceHandler to report the annotation cache counters with dev=true"""
+
+    def extras(self, _meta):
+        if self.args.dev:
+            for name in ("annotation_cache", "annotation_flights"):
+                service = getattr(self.biothings, name, None)
+                if service is not None:
+                    _meta[name] = service.stats()
+        return _meta
+
+
+class MyChemStatusHandler(StatusHandler):
+    """
+    Subclass of StatusHandler to report the worker unavailable, with a
+    503, until it is warmed up, when WARMUP is set, see WarmUp. The
+    warm-up starts with the first check, the first readiness probe.
+    """
+
+    async def _check(self, dev=False):
+        if getattr(self.biothings.config, "WARMUP", False):
+            warm_up = WarmUp.of(self.biothings)
+            if not warm_up.done:
+                warm_up.start()
+                raise HTTPError(503, reason="Warming up.")
+        return await super()._check(dev)
+
+
+class MetricsHandler(BaseHandler):
+    """Serve the StageMetrics histograms in the Prometheus text format."""
+
+    def get(self):
+        stage_metrics = _stage_metrics(self.biothings)
+        if stage_metrics is None:
+            raise HTTPError(404, reason="STAGE_METRICS is not enabled.")
+        self.set_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+        self.finish(stage_metrics.render())
+
+
+def _mapped_file(biothings, name, setting, file_class):
+    # the file of a setting, opened by the first request, and again when replaced
+    path = getattr(biothings.config, setting, None)
+    if not path:
+        raise HTTPError(404, reason=f"{setting} is not configured.")
+    mapped = getattr(biothings, name, None)
+    try:
+        if mapped is None or os.stat(path).st_mtime != mapped.mtime:
+            # requests still using the former file keep it mapped
+            mapped = file_class(path)
+            setattr(biothings, name, mapped)
+    except (OSError, ValueError) as exc:
+        raise HTTPError(503, reason=f"Cannot read the {name}: {exc}")
+    return mapped
+
+
+class NormalizeHandler(JSONWriteMixin, BaseAPIHandler):
+    """
+    Map annotation ids, as accepted by /chem, to the _id of the
+    documents they are found in, from the NORMALIZE_CROSSWALK file
+    instead of Elasticsearch. The file is opened again when replaced.
+
+        GET /{ver}/normalize/<id> -> {"query": ..., "_id": ...}
+        POST /{ver}/normalize, ids=... -> [{...}, ...]
+
+    An id found in several documents is reported with "ambiguous" and
+    the sorted "candidates" instead of "_id", one found in none of them
+    with "notfound".
+    """
+
+    name = "normalize"
+
+    def crosswalk(self):
+        return _mapped_file(self.biothings, "crosswalk", "NORMALIZE_CROSSWALK", Crosswalk)
+
+    def normalize(self, crosswalk, _id):
+        query = self.biothings.config.ANNOTATION_ID_REGEX_LIST.classify(_id)
+        ids = set()
+        for field in query.scopes:
+            if field in self.biothings.config.NORMALIZE_FIELDS:
+                ids.update(crosswalk.lookup(crosswalk_key(field, query.term)))
+        if not ids:
+            return {"query": _id, "notfound": True}
+        if len(ids) > 1:
+            return {"query": _id, "ambiguous": True, "candidates": sorted(ids)}
+        return {"query": _id, "_id": ids.pop()}
+
+    def get(self, *args, **kwargs):
+        result = self.normalize(self.crosswalk(), self.args.id)
+        if result.get("notfound"):
+            raise HTTPError(404, reason="Not Found.")
+        self.finish(result)
+
+    def post(self, *args, **kwargs):
+        crosswalk = self.crosswalk()
+        self.finish([self.normalize(crosswalk, _id) for _id in self.args.id])
+
+
+class InteractionsHandler(JSONWriteMixin, BaseAPIHandler):
+    """
+    Tell which drugs interact among a few DrugBank ids, from the
+    INTERACTIONS_FILE adjacency the hub writes, instead of reading the
+    drugbank.drug_interactions of every drug from Elasticsearch.
+
+        GET /{ver}/interactions?ids=DB00945,DB00682,...
+        POST /{ver}/interactions, ids=...
+            -> {"pairs": [["DB00945", "DB00682"], ...], "notfound": [...]}
+
+    Every pair of the ids is checked, in their order, the ids the file
+    has no interaction of are reported in "notfound".
+    """
+
+    name = "interactions"
+
+    def get(self, *args, **kwargs):
+        ids = list(dict.fromkeys(_id.strip().upper() for _id in self.args.ids))
+        invalid = [_id for _id in ids if drug_number(_id) is None]
+        if invalid:
+            raise HTTPError(400, reason=f"Not DrugBank ids: {', '.join(invalid)}.")
+        interactions = _mapped_file(self.biothings, "interactions", "INTERACTIONS_FILE", Interactions)
+        self.finish({
+            "pairs": interactions.pairs(ids),
+            "notfound": [_id for _id in ids if _id not in interactions],
+        })
+
+    post = get
+
+
+class SuggestHandler(JSONWriteMixin, BaseAPIHandler):
+    """
+    Complete the name of a chemical, for typeahead, from the SUGGEST_FILE
+    names of the index instead of a wildcard query.
+
+        GET /{ver}/suggest?q=aspi&size=10
+            -> [{"name": "Aspirin", "_id": ..., "score": ...}, ...]
+
+    The names start with q, case-insensitive, the most sources name the
+    first ones.
+    """
+
+    name = "suggest"
+
+    def get(self, *args, **kwargs):
+        suggestions = _mapped_file(self.biothings, "suggestions", "SUGGEST_FILE", Suggestions)
+        self.finish(suggestions.suggest(self.args.q, self.args.size))
+
+
+class SkeletonHandler(StageMetricsMixin, JSONWriteMixin, BaseQueryHandler):
+    """
+    Find the documents whose InChIKey _id has the same first block, i.e.
+    the same connectivity, like stereoisomers, isotopologues and charge
+    variants, with a term query on the inchikey_skeleton field set at
+    index time. A whole InChIKey stands for its first block.
+
+        GET /{ver}/chem/skeleton/<block> -> {"total": ..., "hits": [...]}
+    """
+
+    name = "skeleton"
+    skeleton = re.compile(r"([A-Z]{14})(-[A-Z]{10}-[A-Z])?")
+
+    @capture_exceptions
+    async def get(self, *args, **kwargs):
+        self.event["value"] = 1
+        match = self.skeleton.fullmatch(self.args.block.upper())
+        if not match:
+            raise HTTPError(400, reason="The block must be the first 14 letters of an InChIKey.")
+        options = {key: value for key, value in self.args.items() if key not in ("block", "protonation")}
+        if self.args.protonation:
+            if not re.fullmatch(r"[A-Za-z]", self.args.protonation):
+                raise HTTPError(400, reason="The protonation flag must be one letter, like N.")
+            filters = [f"inchikey_protonation:{self.args.protonation.upper()}", options.get("filter")]
+            options["filter"] = " AND ".join(f"({value})" for value in filters if value)
+        result = await ensure_awaitable(self.pipeline.search(match.group(1), scopes=["inchikey_skeleton"], **options))
+        self.finish(result)
+
+
+class SmilesHandler(StageMetricsMixin, JSONWriteMixin, BaseQueryHandler):
+    """
+    Find the documents of a chemical structure with a term query on
+    smiles_hash, set by the hub from the SMILES of all the sources.
+    The SMILES is canonicalized first when RDKit is installed, so that
+    any SMILES of the structure matches, otherwise it must be exact.
+
+        GET /{ver}/chem/smiles?q=<SMILES> -> {"total": ..., "hits": [...]}
+        POST /{ver}/chem/smiles, {"q": [<SMILES>, ...]} -> [{"query": ..., ...}, ...]
+
+    A "+" must be sent as %2B in a URL, and a batch as a JSON list, as
+    the other encodings split the list on "+" and spaces too.
+    """
+
+    name = "smiles"
+
+    def search_options(self):
+        return {key: value for key, value in self.args.items() if key != "q"}
+
+    @capture_exceptions
+    async def get(self, *args, **kwargs):
+        self.event["value"] = 1
+        result = await ensure_awaitable(
+            self.pipeline.search(query_hash(self.args.q), scopes=["smiles_hash"], **self.search_options())
+        )
+        self.finish(result)
+
+    @capture_exceptions
+    async def post(self, *args, **kwargs):
+        self.event["value"] = len(self.args.q)
+        hashes = [query_hash(smiles) for smiles in self.args.q]
+        result = await ensure_awaitable(
+            self.pipeline.search(list(dict.fromkeys(hashes)), scopes=["smiles_hash"], **self.search_options())
+        )
+        entries = {}
+        for entry in result:
+            entries.setdefault(entry.pop("query"), []).append(entry)
+        self.finish([dict(query=smiles, **entry) for smiles, _hash in zip(self.args.q, hashes) for entry in entries[_hash]])
+
+
+class ExportHandler(BaseQueryHandler):
+    """
+    Stream every document of the index, or only those having all the
+    fields of "has", like has=chembl, as JSON lines compressed with gzip,
+    or zstd when zstandard is installed, to mirror MyChem without paging
+    through /query.
+
+        GET /{ver}/chem/export?fields=...&has=... -> chem.jsonl.gz
+
+    The index is scanned in EXPORT_SLICES slices of a point in time at
+    the same time, and a slice only searches its next page once the
+    client has read the previous ones. An error after the first page
+    cannot change the response status anymore, the compressed stream
+    is left incomplete instead.
+    """
+
+    name = "export"
+    compressors = {
+        "gzip": lambda: zlib.compressobj(6, zlib.DEFLATED, 16 + zlib.MAX_WBITS),
+        "zstd": lambda: zstandard.ZstdCompressor().compressobj(),
+    }
+    extensions = {"gzip": "gz", "zstd": "zst"}
+
+    @capture_exceptions
+    async def get(self, *args, **kwargs):
+        compression = self.args.compression
+        if compression == "zstd" and zstandard is None:
+            raise HTTPError(400, reason="zstd compression is not available, use gzip.")
+        options = {key: value for key, value in self.args.items() if key not in ("has", "compression")}
+        if self.args.has:
+            if not all(re.fullmatch(r"[\w.-]+", field) for field in self.args.has):
+                raise HTTPError(400, reason="has must be a list of field names.")
+            options["filter"] = " AND ".join(f"_exists_:{field}" for field in self.args.has)
+
+        config = self.biothings.config
+        slices = getattr(config, "EXPORT_SLICES", 4)
+        pages = self.pipeline.export("__all__", slices=slices, size=getattr(config, "EXPORT_PAGE_SIZE", None), **options)
+        compressor = self.compressors[compression]()
+        # the compressed chunks are written as they are, not serialized
+        self.format = compression
+        self.set_header("Content-Type", f"application/{compression}")
+        filename = f"{self.biothing_type or 'chem'}.jsonl.{self.extensions[compression]}"
+        self.set_header("Content-Disposition", f'attachment; filename="{filename}"')
+        try:
+            async for hits in pages:
+                lines = b"".join(to_json({"_id": hit["_id"], **hit["_source"]}) + b"\n" for hit in hits)
+                self.write(compressor.compress(lines))
+                # wait for the client to read the page before taking the next one
+                await self.flush()
+        finally:
+            await pages.aclose()
+        self.write(compressor.flush())
+        self.finish()
@@ -0,0 +1,101 @@
+import time
+from contextlib import nullcontext
+from contextvars import ContextVar
+
+# the StageTimings of the request being handled, None when the metrics are disabled
+_timings = ContextVar("stage_timings", default=None)
+_untimed = nullcontext()
+
+# seconds, from a cached lookup to a large batch
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+class _Stage:
+    __slots__ = ("timings", "name", "start")
+
+    def __init__(self, timings, name):
+        self.timings = timings
+        self.name = name
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+
+    def __exit__(self, *exc_info):
+        durations = self.timings.durations
+        durations[self.name] = durations.get(self.name, 0.0) + time.perf_counter() - self.start
+
+
+class StageTimings:
+    """The time spent in each stage of a request, summed over the times it is entered."""
+
+    def __init__(self):
+        self.durations = {}
+
+    def stage(self, name):
+        return _Stage(self, name)
+
+    def server_timing(self):
+        """Return the value of a Server-Timing header, in milliseconds."""
+        return ", ".join(f"{name};dur={duration * 1000:.2f}" for name, duration in self.durations.items())
+
+
+def timed(stage):
+    """
+    Return a context manager timing the stage of the current request,
+    which does nothing unless StageMetrics.start was called for it.
+    """
+    timings = _timings.get()
+    if timings is None:
+        return _untimed
+    return timings.stage(stage)
+
+
+class StageMetrics:
+    """
+    Histograms of the time spent in each stage of the requests, like
+    the id classification, Elasticsearch and the result transform,
+    rendered in the Prometheus text format.
+    """
+
+    name = "mychem_request_stage_seconds"
+
+    def __init__(self, buckets=DEFAULT_BUCKETS):
+        self.buckets = tuple(sorted(buckets))
+        # {(endpoint, stage): [count per bucket..., count], sum}
+        self._histograms = {}
+
+    @staticmethod
+    def start():
+        """Time the stages of the current request, return its StageTimings."""
+        timings = StageTimings()
+        _timings.set(timings)
+        return timings
+
+    def observe(self, endpoint, timings):
+        for stage, duration in timings.durations.items():
+            histogram = self._histograms.get((endpoint, stage))
+            if histogram is None:
+                histogram = self._histograms[endpoint, stage] = [[0] * (len(self.buckets) + 1), 0.0]
+            counts = histogram[0]
+            for index, bound in enumerate(self.buckets):
+                if duration <= bound:
+                    counts[index] += 1
+                    break
+            else:
+                counts[-1] += 1
+            histogram[1] += duration
+
+    def render(self):
+        lines = [
+            f"# HELP {self.name} Time spent in each stage of the requests.",
+            f"# TYPE {self.name} histogram",
+        ]
+        for (endpoint, stage), (counts, total) in sorted(self._histograms.items()):
+            labels = f'endpoint="{endpoint}",stage="{stage}"'
+            cumulative = 0
+            for bound, count in zip((*self.buckets, "+Inf"), counts):
+                cumulative += count
+                lines.append(f'{self.name}_bucket{{{labels},le="{bound}"}} {cumulative}')
+            lines.append(f"{self.name}_sum{{{labels}}} {total}")
+            lines.append(f"{self.name}_count{{{labels}}} {cumulative}")
+        return "\n".join(lines) + "\n"
@@ -1,41 +1,852 @@
-from biothings.web.query.formatter import ESResultFormatter
+import asyncio
+import base64
+import binascii
+import copy
+import hashlib
+import hmac
+import json
+import logging
+import zlib
+from collections import UserDict
+
 from biothings.web.options import OptionError
+from biothings.utils.common import dotdict
+from biothings.web.query.builder import (
+    MAX_RESULT_WINDOW,
+    ESQueryBuilder,
+    ESScrollID,
+    Query,
+    QStringParser,
+    RawQueryInterrupt,
+)
+from biothings.web.query.engine import AsyncESQueryBackend, EndScrollInterrupt, RawResultInterrupt
+from biothings.web.query.formatter import ESResultFormatter, ResultFormatterException
+from biothings.web.query.pipeline import AsyncESQueryPipeline, QueryPipelineException, capturesESExceptions
+from biothings.web.settings.default import ANNOTATION_DEFAULT_REGEX_PATTERN
+from biothings.utils.common import BiothingsJSONEncoder
+from biothings.utils.serializer import orjson_default
+from elasticsearch import NotFoundError, RequestError
+from elasticsearch.dsl import MultiSearch, Q, Search
 
+try:
+    import orjson
+except ImportError:  # serialized with the standard encoder then
+    orjson = None
 
-class MyChemESResultFormatter(ESResultFormatter):
-    """Subclass of ESResultFormatter to add list_filter transformation"""
+from web.classifier import AnnotationIdClassifier
+from web.metrics import timed
 
-    def transform_hit(self, path, doc, hit, options):
-        super().transform_hit(path, doc, hit, options)
-        # process list_filter, e.g. list_filter=aaa.bbb:sub_a=val_a,val_aa|sub_b=val_b
-        if options.list_filter:
-            try:
-                list_field_path, sub_field_filters = options.list_filter.split(':')
-            except ValueError as err:
-                raise OptionError("Invalid value for list_filter parameter") from err
+logger = logging.getLogger(__name__)
+
+
+class ListOption:
+    """An option transforming the list at list_field of the objects at parent_path."""
+
+    def __init__(self, parent_path, list_field):
+        self.parent_path = parent_path
+        self.list_field = list_field
+
+    @property
+    def path(self):
+        return ".".join(filter(None, (self.parent_path, self.list_field)))
+
+    def find_parents(self, doc):
+        """
+        Return every object found at parent_path,
+        descending through the lists on the way.
+        """
+        parents = [doc]
+        for key in self.parent_path.split(".") if self.parent_path else ():
+            parents = [parent[key] for parent in parents if key in parent]
+            parents = [
+                obj for value in parents for obj in (value if isinstance(value, list) else (value,))
+                if isinstance(obj, (dict, UserDict))
+            ]
+        return parents
+
+
+class ListFilter(ListOption):
+    """
+    A compiled list_filter parameter, e.g. aaa.bbb:sub_a=val_a,val_aa|sub_b=val_b
+
+    Keep the items of the list at "aaa.bbb" whose "sub_a" is one of
+    "val_a" or "val_aa" and whose "sub_b" is "val_b". Values are
+    compared as strings, so that numbers match their string form.
+    """
+
+    def __init__(self, parent_path, list_field, sub_field_filters):
+        super().__init__(parent_path, list_field)
+        # [(sub_field, frozenset of accepted values), ...]
+        self.sub_field_filters = tuple(sub_field_filters)
+
+    @classmethod
+    def parse(cls, value):
+        if isinstance(value, cls):
+            return value
+        try:
+            list_field_path, sub_field_filters = value.split(':')
             parent_path, list_field = list_field_path.rsplit(".", maxsplit=1)
-            if path == parent_path and list_field in doc:
-                # we handle list_filter at its parent field level,
-                # so that we can set a filtered list value
-                _list = doc[list_field]
+            sub_field_filters = [sub_field.split("=") for sub_field in sub_field_filters.split('|')]
+            sub_field_filters = [
+                (fld.strip(), frozenset(v.strip() for v in val.split(","))) for fld, val in sub_field_filters
+            ]
+        except ValueError as err:
+            raise OptionError("Invalid value for list_filter parameter") from err
+        return cls(parent_path, list_field, sub_field_filters)
+
+    def match(self, item):
+        if not isinstance(item, dict):
+            return False
+        for sub_field, values in self.sub_field_filters:
+            # cast the value to str, so we only compare its string value for numbers
+            if str(item.get(sub_field, '')) not in values:
+                return False
+        return True
+
+    def apply(self, doc):
+        for parent in self.find_parents(doc):
+            if self.list_field in parent:
+                _list = parent[self.list_field]
                 if not isinstance(_list, list):
                     _list = [_list]
-                sub_field_filters = [sub_field.split("=") for sub_field in sub_field_filters.split('|')]
-                try:
-                    sub_field_filters = [
-                        (fld.strip(), [v.strip() for v in val.split(",")]) for fld, val in sub_field_filters
-                    ]
-                except ValueError as err:
-                    raise OptionError("Invalid value for list_filter parameter") from err
-                # list(_list) below creates a copy of _list for the loop,
-                # because we will modify _list itself in the loop
-                for item in list(_list):
-                    if isinstance(item, dict):
-                        for sub_field, val_list in sub_field_filters:
-                            if str(item.get(sub_field, '')) not in val_list:
-                                # cast the value to str, so we only compare its string value for numbers
-                                _list.remove(item)
-                                break
-                    else:
-                        _list.remove(item)
-                doc[list_field] = _list
+                parent[self.list_field] = [item for item in _list if self.match(item)]
+
+
+class NestedListFilter(ListFilter):
+    """
+    A list_filter executed by Elasticsearch on a field mapped as nested.
+
+    The list is excluded from _source and the matching items come back
+    as inner_hits, which are put back in place, in their original order.
+    """
+
+    def __init__(self, parent_path, list_field, sub_field_filters, size):
+        super().__init__(parent_path, list_field, sub_field_filters)
+        self.size = size  # at most index.max_inner_result_window
+
+    def to_query(self):
+        filters = [
+            Q("terms", **{f"{self.path}.{sub_field}": sorted(values)})
+            for sub_field, values in self.sub_field_filters
+        ]
+        inner_hits = {"name": self.path, "size": self.size}
+        return Q("nested", path=self.path, query=Q("bool", filter=filters), score_mode="none", inner_hits=inner_hits)
+
+    def apply(self, doc):
+        inner_hits = doc.pop("inner_hits", {}).get(self.path, {}).get("hits", {})
+        total = inner_hits.get("total", 0)
+        if isinstance(total, dict):
+            total = total["value"]
+        items = sorted(inner_hits.get("hits", ()), key=lambda hit: hit["_nested"]["offset"])
+        if total > len(items):
+            raise ResultFormatterException(
+                f"More than {self.size} items of {self.path} match list_filter, use list_filter_mode=python."
+            )
+        parents = self.find_parents(doc)
+        if len(parents) > 1:
+            # inner hit offsets cannot be attributed to the objects of an array
+            raise ResultFormatterException(
+                f"{self.parent_path} is an array in {doc.get('_id')}, use list_filter_mode=python."
+            )
+        for parent in parents:
+            parent[self.list_field] = [hit["_source"] for hit in items]
+
+
+class ListPage(ListOption):
+    """
+    The list_offset and list_limit parameters, to page through a list:
+    the one at list_field, or else the one list_filter filters, after
+    it is filtered.
+
+    Keep the items of the list from list_offset on, at most list_limit
+    of them, and report the length of the list in _list_total, of the
+    longest one when the list is under an array of objects.
+    """
+
+    def __init__(self, parent_path, list_field, offset=0, limit=None):
+        super().__init__(parent_path, list_field)
+        self.offset = offset
+        self.limit = limit
+
+    @classmethod
+    def parse(cls, options):
+        """Return the ListPage of the options, None if they do not page a list."""
+        if isinstance(options.get("list_page"), cls):
+            return options["list_page"]
+        offset, limit = options.get("list_offset") or 0, options.get("list_limit")
+        if not offset and limit is None:
+            return None
+        if offset < 0 or (limit is not None and limit < 0):
+            raise OptionError("list_offset and list_limit cannot be negative")
+        path = options.get("list_field")
+        if not path and options.get("list_filter"):
+            path = ListFilter.parse(options["list_filter"]).path
+        if not path:
+            raise OptionError("list_offset and list_limit need list_field, or list_filter")
+        parent_path, _, list_field = path.rpartition(".")
+        return cls(parent_path, list_field, offset, limit)
+
+    def apply(self, doc):
+        end = None if self.limit is None else self.offset + self.limit
+        total = None
+        for parent in self.find_parents(doc):
+            if self.list_field in parent:
+                _list = parent[self.list_field]
+                if not isinstance(_list, list):
+                    _list = [_list]
+                total = max(total or 0, len(_list))
+                parent[self.list_field] = _list[self.offset:end]
+        if total is not None:
+            doc["_list_total"] = total
+
+
+class ScriptListPage(ListPage):
+    """
+    A ListPage executed by Elasticsearch, so that only the page of the
+    list is sent. The list is excluded from _source and a script field
+    returns the page of every object at parent_path, in the order
+    find_parents finds them, which are put back in place.
+    """
+
+    name = "_list_page"
+    script = """
+        List parents = [params['_source']];
+        for (String key : params.parent_path) {
+            List found = [];
+            for (def parent : parents) {
+                def value = parent.get(key);
+                if (value instanceof List) {
+                    for (def item : value) {
+                        if (item instanceof Map) {
+                            found.add(item);
+                        }
+                    }
+                } else if (value instanceof Map) {
+                    found.add(value);
+                }
+            }
+            parents = found;
+        }
+        int offset = (int) params.offset;
+        int limit = (int) params.limit;
+        List pages = [];
+        for (def parent : parents) {
+            if (!parent.containsKey(params.list_field)) {
+                pages.add([:]);
+                continue;
+            }
+            def list = parent.get(params.list_field);
+            if (!(list instanceof List)) {
+                list = [list];
+            }
+            int start = Math.min(list.size(), offset);
+            int end = limit < 0 ? list.size() : (int) Math.min((long) list.size(), (long) start + limit);
+            pages.add(['total': list.size(), 'items': new ArrayList(list.subList(start, end))]);
+        }
+        return pages;
+    """
+
+    def to_script_field(self):
+        params = {
+            "parent_path": self.parent_path.split(".") if self.parent_path else [],
+            "list_field": self.list_field,
+            "offset": self.offset,
+            "limit": -1 if self.limit is None else self.limit,
+        }
+        return {"script": {"lang": "painless", "source": self.script, "params": params}}
+
+    def apply(self, doc):
+        fields = doc.get("fields") or {}
+        pages = fields.pop(self.name, [])
+        if not fields:
+            doc.pop("fields", None)
+        total = None
+        for parent, page in zip(self.find_parents(doc), pages):
+            if page:
+                parent[self.list_field] = page["items"]
+                total = max(total or 0, page["total"])
+        if total is not None:
+            doc["_list_total"] = total
+
+
+class MyChemQStringParser(QStringParser):
+    """Subclass of QStringParser to classify ids in a single pass"""
+
+    def __init__(self, *args, patterns=None, **kwargs):
+        super().__init__(*args, patterns=patterns, **kwargs)
+        self.classifier = patterns if isinstance(patterns, AnnotationIdClassifier) else None
+        self._metadata_fields = (None, None)  # (mappings, fields)
+
+    def _build_endpoint_metadata_fields(self, metadata):
+        # mappings are replaced, not updated, when the metadata is refreshed
+        if metadata is None:
+            return None
+        mappings = [metadata.get_mappings(info.get("_biothing")) for info in list(metadata.biothing_metadata.values())]
+        cached_mappings, fields = self._metadata_fields
+        if cached_mappings is None or len(cached_mappings) != len(mappings) or any(
+            cached is not mapping for cached, mapping in zip(cached_mappings, mappings)
+        ):
+            fields = super()._build_endpoint_metadata_fields(metadata)
+            self._metadata_fields = (mappings, fields)
+        return fields
+
+    def parse(self, query, metadata):
+        if self.classifier is None:
+            return super().parse(query, metadata)
+        with timed("classify"):
+            query_object = self.classifier.classify(query)
+        query_metadata = self._build_endpoint_metadata_fields(metadata)
+        if query_metadata is not None and not set(query_object.scopes) <= query_metadata:
+            query_object = Query(query, self.default_scopes)
+        return query_object
+
+
+def _lowercase(term):
+    return str(term).lower()
+
+
+class IdGroup:
+    """
+    The ids of a batch that resolve to the same keyword fields,
+    searched by one terms query and matched back to their hits by
+    the values of these fields.
+    """
+
+    def __init__(self, scopes, normalizers):
+        self.scopes = scopes
+        # how each field normalizes a term, e.g. str.lower
+        self.normalizers = normalizers
+        # [{normalized term: [position in the batch, ...]} for each field]
+        self.positions = [{} for _ in scopes]
+
+    def __len__(self):
+        return len(self.positions[0])
+
+    def add(self, term, position):
+        for normalize, positions in zip(self.normalizers, self.positions):
+            positions.setdefault(normalize(term), []).append(position)
+
+    def to_search(self):
+        fields = [field for field in self.scopes if field != "_id"]
+        search = Search().query(
+            "bool",
+            should=[Q("terms", **{field: list(terms)}) for field, terms in zip(self.scopes, self.positions)],
+            minimum_should_match=1,
+        )
+        return search.extra(docvalue_fields=fields) if fields else search
+
+    def fan_out(self, response, responses, size):
+        """
+        Put in responses, at the position of each id, the part of the
+        response it matches, like its own search would have returned.
+        Return False if the response does not hold all the hits.
+        """
+        positions = sorted({p for index in self.positions[0].values() for p in index})
+        if "error" in response:
+            for position in positions:
+                responses[position] = response
+            return True
+        total = response["hits"]["total"]
+        if isinstance(total, dict):
+            total = total["value"]
+        if total > len(response["hits"]["hits"]):
+            return False
+
+        matches = {position: [] for position in positions}
+        for hit in response["hits"]["hits"]:
+            # only the docvalue fields of the grouping, not the script fields
+            fields = hit.get("fields") or {}
+            values = {field: fields.pop(field) for field in self.scopes if field in fields}
+            if not fields:
+                hit.pop("fields", None)
+            matched = set()
+            # hits are listed by the first field they match in, as
+            # the most specific fields come first in the scopes.
+            for rank, (field, index) in enumerate(zip(self.scopes, self.positions)):
+                for value in [hit["_id"]] if field == "_id" else values.get(field, ()):
+                    for position in index.get(value, ()):
+                        if position not in matched:
+                            matched.add(position)
+                            matches[position].append((rank, hit))
+
+        used = set()
+        for position, _matches in matches.items():
+            hits = [hit for _, hit in sorted(_matches, key=lambda match: match[0])[:size]]
+            # the formatter transforms every hit in place
+            hits = [copy.deepcopy(hit) if id(hit) in used else hit for hit in hits]
+            used.update(id(hit) for hit in hits)
+            responses[position] = {
+                "took": response.get("took"),
+                "timed_out": response.get("timed_out", False),
+                "hits": {"total": {"value": len(_matches), "relation": "eq"}, "max_score": None, "hits": hits},
+            }
+        return True
+
+
+class MyChemQueryBuilder(ESQueryBuilder):
+    """
+    Subclass of ESQueryBuilder to classify ids in a single pass, group
+    batch annotation ids and execute list_filter and the list paging in
+    Elasticsearch.
+    """
+
+    # must not exceed the index.max_inner_result_window setting
+    list_filter_inner_hits_size = 100
+    # the most ids searched by one terms query in a batch
+    batch_group_size = 1000
+    # keyword normalizers that only lowercase the values
+    lowercase_normalizers = ("keyword_lowercase_normalizer",)
+
+    def __init__(
+        self,
+        user_query=None,
+        scopes_regexs=None,
+        scopes_default=("_id",),
+        pattern_default=ANNOTATION_DEFAULT_REGEX_PATTERN,
+        allow_random_query=True,
+        allow_nested_query=False,
+        metadata=None,
+        formatter=None,
+    ):
+        super().__init__(
+            user_query,
+            scopes_regexs,
+            scopes_default,
+            pattern_default,
+            allow_random_query,
+            allow_nested_query,
+            metadata,
+            formatter,
+        )
+        self.parser = MyChemQStringParser(
+            default_scopes=scopes_default,
+            patterns=scopes_regexs,
+            default_pattern=pattern_default,
+            gpnames=("term", "scope"),
+            formatter=self.parser.metadata_field_formatter,
+        )
+
+    def nested_list_filter(self, list_filter, options):
+        """
+        Return a NestedListFilter if list_filter can be executed by
+        Elasticsearch with the same result, otherwise list_filter.
+
+        That is when its list is mapped as nested under plain objects,
+        every sub field it tests is a keyword, the empty string is not
+        an accepted value (it also matches a missing sub field) and the
+        list is part of the requested fields.
+        """
+        if self.metadata is None:
+            return list_filter
+        properties = self.metadata.get_mappings(options.get("biothing_type"))
+        mapping = {}
+        for key in list_filter.path.split("."):
+            if not properties or mapping.get("type") == "nested":
+                return list_filter
+            mapping = properties.get(key) or {}
+            properties = mapping.get("properties")
+        if mapping.get("type") != "nested":
+            return list_filter
+        for sub_field, values in list_filter.sub_field_filters:
+            if properties.get(sub_field, {}).get("type") != "keyword" or "" in values:
+                return list_filter
+        if not self._requested(list_filter.path, options):
+            return list_filter
+        list_page = options.get("list_page")
+        if list_page is not None and list_page.path == list_filter.path:
+            # paged after it is filtered, in python
+            return list_filter
+        return NestedListFilter(
+            list_filter.parent_path,
+            list_filter.list_field,
+            list_filter.sub_field_filters,
+            self.list_filter_inner_hits_size,
+        )
+
+    def script_list_page(self, list_page, options):
+        """
+        Return a ScriptListPage if list_page can be executed by
+        Elasticsearch, that is when its list is not filtered by
+        list_filter and is part of the requested fields.
+        """
+        list_filter = options.get("list_filter")
+        if list_filter is not None and ListFilter.parse(list_filter).path == list_page.path:
+            return list_page
+        if not self._requested(list_page.path, options):
+            return list_page
+        return ScriptListPage(list_page.parent_path, list_page.list_field, list_page.offset, list_page.limit)
+
+    @staticmethod
+    def _requested(path, options):
+        fields = options.get("_source")
+        return not fields or "all" in fields or any(path == field or path.startswith(field + ".") for field in fields)
+
+    def field_normalizer(self, field, biothing_type=None):
+        """
+        Return how a terms query normalizes the values it matches in
+        a field, or None when they are not matched as a whole.
+        """
+        if field == "_id":
+            return str
+        if self.metadata is None:
+            return None
+        mapping = {"properties": self.metadata.get_mappings(biothing_type)}
+        for key in field.split("."):
+            mapping = (mapping.get("properties") or {}).get(key) or {}
+        if mapping.get("type") != "keyword":
+            return None
+        if not mapping.get("normalizer"):
+            return str
+        if mapping["normalizer"] in self.lowercase_normalizers:
+            return _lowercase
+        return None
+
+    def normalize_id(self, q, biothing_type=None):
+        """
+        Return the (term, scopes) an annotation id is searched with,
+        its term normalized like its fields normalize their values,
+        so that ids matching the same documents compare equal.
+        """
+        term, scopes = self.parser.parse(str(q), self.metadata)
+        normalizers = {self.field_normalizer(field, biothing_type) for field in scopes}
+        if len(normalizers) == 1 and None not in normalizers:
+            term = normalizers.pop()(term)
+        return term, tuple(scopes)
+
+    def build_batch(self, q, **options):
+        """
+        Build a batch annotation query, where the ids that resolve
+        to the same keyword fields are searched by one terms query.
+
+        Return the multisearch and, for each of its searches, the
+        IdGroup it searches or the position of its single id in q.
+        """
+        options = dotdict(options)
+        entries = []
+        groups = {}  # {scopes: IdGroup}
+        for position, _q in enumerate(q):
+            term, scopes = self.parser.parse(str(_q), self.metadata)
+            normalizers = [self.field_normalizer(field, options.biothing_type) for field in scopes]
+            if not term or None in normalizers:
+                entries.append(position)
+                continue
+            group = groups.get(tuple(scopes))
+            if group is None or len(group) >= self.batch_group_size:
+                group = groups[tuple(scopes)] = IdGroup(scopes, normalizers)
+                entries.append(group)
+            group.add(term, position)
+
+        search = MultiSearch()
+        for entry in entries:
+            if isinstance(entry, IdGroup):
+                # room for the hits of every id, as if each was searched
+                size = min(MAX_RESULT_WINDOW, (options.size or 10) * len(entry))
+                search = search.add(self.apply_extras(entry.to_search(), options).extra(size=size))
+            else:
+                search = search.add(self._build_one(q[entry], options))
+        if options.get("rawquery"):
+            raise RawQueryInterrupt(search.to_dict())
+        return search, entries
+
+    def apply_extras(self, search, options):
+        search = super().apply_extras(search, options)
+        if isinstance(options.list_filter, NestedListFilter):
+            # match the list items without filtering out the documents
+            search = search.query(Q("bool", should=[options.list_filter.to_query()], minimum_should_match=0))
+            source = search._source if isinstance(search._source, dict) else {}
+            search = search.source(excludes=[*source.get("excludes", ()), options.list_filter.path])
+        if isinstance(options.list_page, ScriptListPage):
+            search = search.script_fields(**{ScriptListPage.name: options.list_page.to_script_field()})
+            source = search._source if isinstance(search._source, dict) else {}
+            search = search.source(excludes=[*source.get("excludes", ()), options.list_page.path])
+        return search
+
+
+class MyChemESQueryBackend(AsyncESQueryBackend):
+    """
+    Subclass of AsyncESQueryBackend to page through fetch_all queries
+    with a point in time and search_after instead of a scroll. The
+    _scroll_id returned is a continuation token holding the search, the
+    point in time and the sort values of the last hit, so that any
+    worker can answer the next page, and Elasticsearch only keeps the
+    point in time open, for scroll_time after each page.
+
+    The token is signed with token_secret, SCROLL_TOKEN_SECRET, set by
+    MyChemQueryHandler, and rejected if it does not match, as the search
+    it holds is run as it is. Without a secret, fetch_all scrolls.
+    Scroll ids that are not such tokens are still scrolled.
+    """
+
+    token_prefix = "pit:"
+    token_secret = None
+
+    def token_signature(self, data):
+        secret = self.token_secret.encode("utf-8") if isinstance(self.token_secret, str) else self.token_secret
+        return hmac.new(secret, data, hashlib.sha256).digest()
+
+    def encode_token(self, body, pit_id, search_after):
+        state = {"body": body, "pit": pit_id, "after": search_after}
+        data = zlib.compress(json.dumps(state, separators=(",", ":")).encode("utf-8"))
+        return (
+            self.token_prefix
+            + base64.urlsafe_b64encode(data).decode("ascii")
+            + "."
+            + base64.urlsafe_b64encode(self.token_signature(data)).decode("ascii")
+        )
+
+    def decode_token(self, token):
+        try:
+            data, signature = token[len(self.token_prefix):].split(".")
+            data = base64.urlsafe_b64decode(data)
+            if not self.token_secret or not hmac.compare_digest(
+                base64.urlsafe_b64decode(signature), self.token_signature(data)
+            ):
+                raise ValueError("Unsigned scroll_id.")
+            state = json.loads(zlib.decompress(data))
+            return state["body"], state["pit"], state["after"]
+        except (binascii.Error, zlib.error, ValueError, TypeError, KeyError):
+            raise ValueError("Invalid or stale scroll_id.")
+
+    async def close_pit(self, pit_id):
+        try:
+            await self.client.close_point_in_time(body={"id": pit_id})
+        except NotFoundError as exc:
+            logger.warning("Point in time not found (ID: %s): %s", pit_id, str(exc))
+
+    async def search_pit(self, body, pit_id, search_after=None):
+        """Search a page of a point in time, return the response with its continuation token."""
+        body = dict(body, pit={"id": pit_id, "keep_alive": self.scroll_time})
+        if search_after is not None:
+            body["search_after"] = search_after
+        res = await self.client.search(body=body, rest_total_hits_as_int=self.total_hits_as_int)
+        res = dict(res.body if hasattr(res, "body") else res)
+        # ES may return a new id for the same point in time
+        pit_id = res.pop("pit_id", pit_id)
+        hits = res["hits"]["hits"]
+        if len(hits) < body["size"]:
+            # the last page, no need to keep the point in time
+            await self.close_pit(pit_id)
+            pit_id = None
+        res["_scroll_id"] = self.encode_token(
+            {key: value for key, value in body.items() if key not in ("pit", "search_after")},
+            pit_id,
+            hits[-1]["sort"] if hits else search_after,
+        )
+        return res
+
+    async def execute(self, query, **options):
+        if isinstance(query, ESScrollID) and query.data.startswith(self.token_prefix):
+            body, pit_id, search_after = self.decode_token(query.data)
+            if pit_id is None:
+                raise EndScrollInterrupt()
+            try:
+                res = await self.search_pit(body, pit_id, search_after)
+            except (RequestError, NotFoundError):
+                raise ValueError("Invalid or stale scroll_id.")
+            if options.get("raw"):
+                raise RawResultInterrupt(res)
+            if not res["hits"]["hits"]:
+                raise EndScrollInterrupt()
+            return res
+
+        if isinstance(query, Search) and options.get("fetch_all") and self.token_secret:
+            index = self.indices[options.get("biothing_type")]
+            index = self.adjust_index(index, query, **options)
+            body = query.extra(size=self.scroll_size).to_dict()
+            # the tiebreaker of search_after, the cheapest sort of a point in time
+            body["sort"] = [*body.get("sort", ()), "_shard_doc"]
+            pit = await self.client.open_point_in_time(index=index, keep_alive=self.scroll_time)
+            try:
+                res = await self.search_pit(body, pit["id"])
+            except Exception:
+                await self.close_pit(pit["id"])
+                raise
+            if options.get("raw"):
+                raise RawResultInterrupt(res)
+            return res
+
+        return await super().execute(query, **options)
+
+    async def scan(self, query, slices=1, size=None, **options):
+        """
+        Yield the hits of a search a page at a time, in no particular
+        order, searching the slices of a point in time at the same time.
+        A slice searches its next page once its previous one is taken,
+        so that at most about two pages per slice are held.
+        """
+        index = self.indices[options.get("biothing_type")]
+        index = self.adjust_index(index, query, **options)
+        body = query.to_dict()
+        body.update(size=size or self.scroll_size, sort=["_shard_doc"], track_total_hits=False)
+        pit = await self.client.open_point_in_time(index=index, keep_alive=self.scroll_time)
+        pages = asyncio.Queue(slices)
+
+        async def scan_slice(slice_id):
+            page = dict(body, pit={"id": pit["id"], "keep_alive": self.scroll_time})
+            if slices > 1:
+                page["slice"] = {"id": slice_id, "max": slices}
+            try:
+                while True:
+                    res = await self.client.search(body=page)
+                    hits = res["hits"]["hits"]
+                    if hits:
+                        await pages.put(hits)
+                    if len(hits) < page["size"]:
+                        break
+                    page = dict(page, search_after=hits[-1]["sort"])
+            except Exception as exc:
+                await pages.put(exc)
+            else:
+                await pages.put(None)
+
+        tasks = [asyncio.ensure_future(scan_slice(slice_id)) for slice_id in range(slices)]
+        try:
+            running = slices
+            while running:
+                hits = await pages.get()
+                if hits is None:
+                    running -= 1
+                elif isinstance(hits, Exception):
+                    raise hits
+                else:
+                    yield hits
+        finally:
+            for task in tasks:
+                task.cancel()
+            await self.close_pit(pit["id"])
+
+
+class MyChemESResultFormatter(ESResultFormatter):
+    """Subclass of ESResultFormatter to add list_filter and list paging transformations and a faster serialization"""
+
+    @staticmethod
+    def to_json(result):
+        """
+        Serialize a result to UTF-8 JSON bytes, like the biothings
+        serializer but without decoding them to a str Tornado encodes
+        again, and only allowing non-string keys, which orjson is about
+        twice slower with, for the results that have some.
+        """
+        if orjson is None:
+            return json.dumps(result, cls=BiothingsJSONEncoder, ensure_ascii=False, separators=(",", ":")).encode()
+        try:
+            return orjson.dumps(result, default=orjson_default, option=orjson.OPT_NAIVE_UTC)
+        except TypeError:
+            return orjson.dumps(
+                result, default=orjson_default, option=orjson.OPT_NAIVE_UTC | orjson.OPT_NON_STR_KEYS
+            )
+
+    def transform(self, response, **options):
+        # parse list_filter once for all the hits of a request
+        if options.get("list_filter"):
+            options["list_filter"] = ListFilter.parse(options["list_filter"])
+        options["list_page"] = ListPage.parse(options)
+        return super().transform(response, **options)
+
+    def _transform_hit(self, doc, options):
+        # process list_filter, e.g. list_filter=aaa.bbb:sub_a=val_a,val_aa|sub_b=val_b
+        # before the other transformations, so that they only traverse the kept items.
+        if options.list_filter:
+            options.list_filter.apply(doc)
+        if options.list_page:
+            options.list_page.apply(doc)
+        super()._transform_hit(doc, options)
+
+
+class MyChemQueryPipeline(AsyncESQueryPipeline):
+    """
+    Subclass of AsyncESQueryPipeline to parse list_filter and the list
+    paging before any query stage, to group the ids of batch annotation queries and to
+    time the Elasticsearch and transform stages.
+    """
+
+    @capturesESExceptions
+    async def search(self, q, **options):
+        options["list_page"] = ListPage.parse(options)
+        if options["list_page"] and options.get("list_filter_mode") == "es":
+            options["list_page"] = self.builder.script_list_page(options["list_page"], options)
+        if options.get("list_filter"):
+            options["list_filter"] = ListFilter.parse(options["list_filter"])
+            if options.get("list_filter_mode") == "es":
+                options["list_filter"] = self.builder.nested_list_filter(options["list_filter"], options)
+        # the raw queries and responses stay those of every id
+        if (
+            isinstance(q, list)
+            and q
+            and options.get("autoscope")
+            and not options.get("scopes")
+            and not (options.get("raw") or options.get("rawquery"))
+        ):
+            return await self.search_batch(q, **options)
+        if isinstance(q, list):  # multisearch
+            options["templates"] = (dict(query=_q) for _q in q)
+            options["template_miss"] = dict(notfound=True)
+            options["template_hit"] = dict()
+
+        query = self.builder.build(q, **options)
+        with timed("es"):
+            response = await self.backend.execute(query, **options)
+        with timed("transform"):
+            return self.formatter.transform(response, **options)
+
+    async def search_stream(self, q, chunk_size=1000, **options):
+        """
+        Search a batch of queries chunk_size at a time and yield the
+        result of every chunk, in the order of the queries, so that only
+        about two chunks are held in memory. The next chunk is searched
+        while the result of the current one is consumed.
+        """
+        if options.get("list_filter"):
+            options["list_filter"] = ListFilter.parse(options["list_filter"])
+        chunks = (q[start:start + chunk_size] for start in range(0, len(q), chunk_size))
+        pending = asyncio.ensure_future(self.search(next(chunks, []), **options))
+        try:
+            for chunk in chunks:
+                current, pending = pending, asyncio.ensure_future(self.search(chunk, **options))
+                yield await current
+            yield await pending
+        finally:
+            pending.cancel()
+
+    async def export(self, q, slices=1, size=None, **options):
+        """
+        Yield every hit of a query a page at a time, in no particular
+        order, see MyChemESQueryBackend.scan.
+        """
+        try:
+            query = self.builder.build(q, **options)
+        except (ValueError, TypeError) as exc:
+            raise QueryPipelineException(400, type(exc).__name__, str(exc))
+        async for hits in self.backend.scan(query, slices=slices, size=size, **options):
+            yield hits
+
+    async def search_batch(self, q, **options):
+        """
+        Search a batch of annotation ids with a terms query for each
+        group of ids resolving to the same fields, then give every id
+        its own result, in the input order, like a multisearch would.
+        """
+        query, entries = self.builder.build_batch(q, **options)
+        with timed("es"):
+            response = await self.backend.execute(query, **options)
+
+        responses, overflow = [None] * len(q), []
+        for entry, res in zip(entries, response):
+            if not isinstance(entry, IdGroup):
+                responses[entry] = res
+            elif not entry.fan_out(res, responses, options.get("size") or 10):
+                overflow.extend(p for positions in entry.positions[0].values() for p in positions)
+        if overflow:
+            # ids matching too many documents together, search them one by one
+            overflow.sort()
+            query = self.builder.build([q[p] for p in overflow], **options)
+            with timed("es"):
+                overflow_responses = await self.backend.execute(query, **options)
+            for position, res in zip(overflow, overflow_responses):
+                responses[position] = res
+
+        options["templates"] = (dict(query=_q) for _q in q)
+        options["template_miss"] = dict(notfound=True)
+        options["template_hit"] = dict()
+        with timed("transform"):
+            return self.formatter.transform(responses, **options)
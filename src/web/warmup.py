@@ -0,0 +1,94 @@
+import asyncio
+import logging
+import time
+
+from biothings.utils.common import get_loop
+from biothings.web.query.pipeline import QueryPipelineException
+
+from web.pipeline import MyChemESResultFormatter
+
+logger = logging.getLogger(__name__)
+
+
+class WarmUp:
+    """
+    Warm a web worker up before it reports ready on /status: open
+    WARMUP_CONNECTIONS connections to Elasticsearch, read the
+    STATUS_CHECK document and the index metadata, and annotate the
+    WARMUP_IDS, one at a time and as a batch, through the whole query
+    pipeline, so that the first requests do not pay for the connections,
+    the id classification, the first imports and the caches. The time of
+    every step is logged. A step that fails is logged and skipped, the
+    health check tells whether Elasticsearch can be reached.
+    """
+
+    def __init__(self, biothings):
+        self.biothings = biothings
+        self.task = None
+        self.timings = {}  # {step: seconds}
+
+    @classmethod
+    def of(cls, biothings):
+        # shared by all the requests of an application, created by its first one
+        if not hasattr(biothings, "warm_up"):
+            biothings.warm_up = cls(biothings)
+        return biothings.warm_up
+
+    @property
+    def done(self):
+        return self.task is not None and self.task.done()
+
+    def start(self):
+        """Schedule the warm-up on the event loop, once, return its task."""
+        if self.task is None:
+            self.task = get_loop().create_task(self.run())
+        return self.task
+
+    async def run(self):
+        config = self.biothings.config
+        steps = [
+            ("connections", self.open_connections(getattr(config, "WARMUP_CONNECTIONS", 10))),
+            ("status_check", self.read_status_check()),
+            ("metadata", self.read_metadata()),
+            ("ids", self.annotate(getattr(config, "WARMUP_IDS", []))),
+        ]
+        start = time.perf_counter()
+        for name, step in steps:
+            step_start = time.perf_counter()
+            try:
+                await step
+            except Exception as exc:  # the worker still serves, only slower at first
+                logger.warning("Warm-up step %s failed: %s", name, exc)
+            self.timings[name] = time.perf_counter() - step_start
+        self.timings["total"] = time.perf_counter() - start
+        logger.info(
+            "Warmed up in %.3fs (%s)",
+            self.timings["total"],
+            ", ".join(f"{name} {seconds:.3f}s" for name, seconds in self.timings.items() if name != "total"),
+        )
+
+    async def open_connections(self, count):
+        # as many requests at once as connections are to be kept in the pool
+        client = self.biothings.elasticsearch.async_client
+        await asyncio.gather(*(client.info() for _ in range(count)))
+
+    async def read_status_check(self):
+        config = self.biothings.config
+        await self.biothings.elasticsearch.async_client.get(
+            **dict(config.STATUS_CHECK, index=config.ES_INDICES["chem"])
+        )
+
+    async def read_metadata(self):
+        metadata = self.biothings.metadata
+        await asyncio.gather(*(metadata.refresh(biothing_type) for biothing_type in metadata.types))
+
+    async def annotate(self, ids):
+        pipeline = self.biothings.pipeline
+        for _id in ids:
+            try:
+                MyChemESResultFormatter.to_json(await pipeline.fetch(_id))
+            except QueryPipelineException as exc:
+                if exc.code != 404:  # not in this build
+                    raise
+        if ids:
+            MyChemESResultFormatter.to_json(await pipeline.fetch(list(ids)))